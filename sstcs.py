@@ -1,24 +1,32 @@
 #!/usr/bin/python
+from array import array
+import atexit
 import codecs
 import collections
-from datetime import datetime
+import cPickle as pickle
+import cProfile
 import getopt
+import hashlib
+import heapq
+from io import BytesIO
+import json
 import logging
+import mmap
 import os
+import Queue
+import random
 import re
-from struct import unpack
+import socket
+from struct import Struct
 import sys
+import threading
 import time
+import traceback
+import unicodedata
+import urlparse
+import zlib
 
-from twisted.internet import reactor
-from twisted.python.failure import Failure
-import twisted.web.client
-
-from coherence.base import Coherence
-from coherence.upnp.devices.control_point import ControlPoint
-
-import coherence.extern.log.log as coherence_log
-
+from xml.etree import cElementTree as ElementTree
 from xml.sax.saxutils import escape
 
 # Channel list types to use as fallbacks if designated channel is not in
@@ -27,6 +35,40 @@ from xml.sax.saxutils import escape
 # And it's literally the string, 0xXY.
 CL_TYPE_FALLBACKS = '0x11 0x12 0x13 0x14 0x15 0x03 0x04 0x06 0x01'.split(' ')
 
+# The UPnP service we're talking to for everything channel-related.
+MAIN_TV_AGENT_SERVICE_ID = 'urn:samsung.com:serviceId:MainTVAgent2'
+
+# The actions of MainTVAgent2 we need.
+REQUIRED_ACTIONS = ['GetChannelListURL', 'SetMainTVChannel']
+
+# The in arguments of the actions we use (REQUIRED_ACTIONS, and GetCurrentMainTVChannel for
+# --verify), in the order MainTVAgent2's service description lists them, so we can call them
+# before we have (or without ever fetching) the description.
+MAIN_TV_AGENT_ACTIONS = {
+    'GetChannelListURL'      : (),
+    'SetMainTVChannel'       : ('ChannelListType', 'SatelliteID', 'Channel'),
+    'GetCurrentMainTVChannel': (),
+}
+
+# Delays between polls of GetCurrentMainTVChannel when verifying a switch (see verify_switch).
+# Tuning usually takes a fraction of a second, so the first polls come quickly; the last delay
+# repeats until opts['verify_timeout_s'] is up.
+VERIFY_POLL_DELAYS_S = [0.02, 0.05, 0.1, 0.1, 0.2]
+
+# UPnP error codes for "Invalid Action" and "Invalid Args": the TV doesn't know an action the
+# way we called it, so our idea of its service description is out of date.
+UPNP_INVALID_ACTION_ERRORS = frozenset(['401', '402'])
+
+# XML namespaces of UPnP device and service descriptions.
+UPNP_DEVICE_NS  = 'urn:schemas-upnp-org:device-1-0'
+UPNP_SERVICE_NS = 'urn:schemas-upnp-org:service-1-0'
+SOAP_ENVELOPE_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+UPNP_CONTROL_NS = 'urn:schemas-upnp-org:control-1-0'
+UPNP_EVENT_NS = 'urn:schemas-upnp-org:event-1-0'
+
+SSDP_ADDR = '239.255.255.250'
+SSDP_PORT = 1900
+
 # Maps Coherence log levels to 'logging' log levels
 COHERENCE_LOG_LEVEL_MAP = {
     'ERROR': logging.ERROR,
@@ -36,19 +78,17 @@ COHERENCE_LOG_LEVEL_MAP = {
     'LOG'  : logging.DEBUG,
 }
 
-# Log levels to colors.
-try:
-    from coherence.extern.log import termcolor
-    t = termcolor.TerminalController()
+# Log levels to colors, as plain ANSI escape codes so that logging doesn't need Coherence.
+if sys.stderr.isatty():
     LOG_LEVEL_COLORS = {
-        logging.CRITICAL: t.BOLD+t.MAGENTA,
-        logging.ERROR   : t.BOLD+t.RED,
-        logging.WARNING : t.BOLD+t.YELLOW,
-        logging.INFO    : t.BOLD+t.GREEN,
-        logging.DEBUG   : t.BOLD+t.BLUE,
+        logging.CRITICAL: '\033[1m\033[35m',
+        logging.ERROR   : '\033[1m\033[31m',
+        logging.WARNING : '\033[1m\033[33m',
+        logging.INFO    : '\033[1m\033[32m',
+        logging.DEBUG   : '\033[1m\033[34m',
     }
-    LOG_LEVEL_COLOR_RESET = t.NORMAL
-except ImportError:
+    LOG_LEVEL_COLOR_RESET = '\033[0m'
+else:
     LOG_LEVEL_COLORS = {}
     LOG_LEVEL_COLOR_RESET = ''
 
@@ -58,14 +98,83 @@ LOG = None
 # Code to exit with at the end of the program
 EXITCODE = 0
 
+def _default_cache_dir():
+    """Returns the directory to keep our caches in, following the XDG base directory spec."""
+
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'sstcs')
+
 # Default options
 opts = {
-    'loglevels': 'info,coherence=critical',
-    'devtype'  : 'urn:samsung.com:device:MainTVServer2:1',
-    'channel'  : None,
-    'do_list'  : False,
+    'loglevels'  : 'info,coherence=critical',
+    'devtype'    : 'urn:samsung.com:device:MainTVServer2:1',
+    'channel'    : None,
+    'do_list'    : False,
+    'search'     : None,
+    'use_cache'  : True,
+    'flush_cache': False,
+    'cache_dir'  : _default_cache_dir(),
+    'cache_ttl_s': 7*24*60*60,
+    'list_max_age_s': 60*60,
+    'daemon'     : False,
+    'client'     : False,
+    'socket'     : None,
+    'tvs'        : [],
+    'concurrency': 8,
+    'deadline_s' : 30,
+    'discovery_s': 5,
+    'discovery_deadline_s': 20,
+    'host'       : None,
+    'location'   : None,
+    'timings_json': None,
+    'prom_textfile': None,
+    'offline'    : False,
+    'channel_list': None,
+    'batch'      : None,
+    'diff'       : None,
+    'diff_json'  : False,
+    'db'         : None,
+    'export_db'  : None,
+    'import_db'  : None,
+    'engine'     : 'twisted',
+    'verify'     : False,
+    'verify_timeout_s': 5,
+    'zap_bench'  : None,
+    'events'     : True,
+    'event_port' : 0,
+    'profile'    : None,
+    'lag_threshold_s': None,
+    'hedge'      : True,
+    'hedge_percentile': 95,
 }
 
+# Twisted and Coherence take a lot longer to import than listing a local channel list takes
+# (see --offline), so they're only imported by _import_networking when we actually need them.
+defer = protocol = reactor = Failure = Headers = UNKNOWN_LENGTH = twisted = None
+Coherence = ControlPoint = coherence_log = None
+
+def _import_networking():
+    """Imports Twisted and Coherence into the module namespace. Must be called before anything
+    talking to the network (or using Deferreds) is."""
+
+    global defer, protocol, reactor, Failure, Headers, UNKNOWN_LENGTH, twisted
+    global Coherence, ControlPoint, coherence_log
+
+    if reactor is not None:
+        return
+
+    from twisted.internet import defer, protocol, reactor
+    from twisted.python.failure import Failure
+    import twisted.web.client
+    import twisted.web.error
+    from twisted.web.http_headers import Headers
+    from twisted.web.iweb import UNKNOWN_LENGTH
+
+    from coherence.base import Coherence
+    from coherence.upnp.devices.control_point import ControlPoint
+
+    import coherence.extern.log.log as coherence_log
+
 def fatal(msg, failure=None):
     """This writes an error message to stderr and stops reactor, if it's running.
     Note that you must still return yourself from a Twisted callback or call
@@ -77,7 +186,7 @@ def fatal(msg, failure=None):
                  can use it as errback for Twisted.
     """
 
-    if isinstance(failure, Failure):
+    if Failure and isinstance(failure, Failure):
         failure = failure.value
 
     log_str = 'FATAL ERROR: %s' % msg
@@ -89,91 +198,639 @@ def fatal(msg, failure=None):
     else:
         sys.stderr.write(log_str + '\n')
 
-    if reactor.running:
+    if reactor and reactor.running:
         reactor.stop()
 
     global EXITCODE
     EXITCODE = 2
 
 
-RetrySpec = collections.namedtuple('RetrySpec', ['retries', 'initial_delay_s',
-                                                 'backoff_factor'])
-DEFAULT_RETRY_SPEC = RetrySpec(retries=10, initial_delay_s=0.5, backoff_factor=1.5)
+def fatal_failure(failure):
+    """Errback calling fatal with the message of one of our ContextExceptions, or with the
+    failure as additional information for anything unexpected."""
 
+    if failure.check(ContextException):
+        fatal(failure.getErrorMessage())
+    else:
+        fatal('Unexpected error', failure)
+
+
+def _write_file_atomically(path, data):
+    """Writes 'data' to 'path' via a temporary file and a rename, so concurrent runs never
+    see a half-written file. Creates the containing directory if necessary."""
+
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+def with_deadline(d, timeout_s, what):
+    """Cancels the Deferred 'd' if it hasn't fired after 'timeout_s' seconds, failing it with a
+    DeadlineException mentioning 'what'. Returns 'd'."""
+
+    call = reactor.callLater(timeout_s, d.cancel)
+
+    def _done(result):
+        if call.active():
+            call.cancel()
+        elif isinstance(result, Failure) and result.check(defer.CancelledError):
+            raise DeadlineException('%s took longer than %.1f seconds' % (what, timeout_s))
+        return result
+    return d.addBoth(_done)
+
+
+def percentile(values, p):
+    """Returns the 'p'th percentile of the sorted list 'values'. Nearest rank, so it's always
+    one of the values."""
+
+    return values[max(0, int(-(-len(values) * p // 100)) - 1)]
+
+
+# How each call to the TV is made, see call_with_policy. 'deadline_s' bounds the whole call,
+# 'attempt_timeout_s' each attempt. An attempt the TV didn't answer (in time) is retried up to
+# 'retries' times, 'backoff_s' later the first time and twice as long each time after that.
+# Idempotent calls are hedged: if an attempt hasn't been answered after the
+# opts['hedge_percentile']th percentile of the call's recent latencies (or 'hedge_after_s'
+# until there are enough of them, None for not at all), the same request is sent again and
+# whichever answer comes first is used. Latencies are kept in the cache directory, so single
+# runs hedge by those of earlier runs; with --no-cache they always hedge after 'hedge_after_s'.
+CallPolicy = collections.namedtuple('CallPolicy', 'deadline_s attempt_timeout_s retries backoff_s '
+                                                  'idempotent hedge_after_s')
+
+CALL_POLICIES = {
+    # The unicast M-SEARCHs of --host. An attempt resends them itself, see search_host.
+    'search_host'                : CallPolicy(deadline_s=8, attempt_timeout_s=3, retries=1,
+                                              backoff_s=0.5, idempotent=True, hedge_after_s=None),
+    # The device and service descriptions.
+    'get_description'            : CallPolicy(deadline_s=10, attempt_timeout_s=3, retries=3,
+                                              backoff_s=0.2, idempotent=True, hedge_after_s=1),
+    'get_channel_list_url'       : CallPolicy(deadline_s=10, attempt_timeout_s=3, retries=3,
+                                              backoff_s=0.2, idempotent=True, hedge_after_s=1),
+    # Even a big list is there within a few seconds, so there's no point in waiting forever
+    # for a TV that stopped sending it.
+    'fetch_channel_list'         : CallPolicy(deadline_s=60, attempt_timeout_s=20, retries=2,
+                                              backoff_s=0.5, idempotent=True, hedge_after_s=None),
+    # Not idempotent: two switches racing each other might be answered NOTOK by the TV for the
+    # one that lost. Retrying an unanswered one is fine, it switches to the same channel.
+    'set_main_tv_channel'        : CallPolicy(deadline_s=10, attempt_timeout_s=4, retries=2,
+                                              backoff_s=0.2, idempotent=False, hedge_after_s=None),
+    'get_current_main_tv_channel': CallPolicy(deadline_s=5, attempt_timeout_s=2, retries=2,
+                                              backoff_s=0.1, idempotent=True, hedge_after_s=None),
+    # Not idempotent either: each answered SUBSCRIBE is a subscription. One we retried after
+    # not hearing back just times out on the TV.
+    'subscribe'                  : CallPolicy(deadline_s=15, attempt_timeout_s=5, retries=2,
+                                              backoff_s=1, idempotent=False, hedge_after_s=None),
+    'unsubscribe'                : CallPolicy(deadline_s=5, attempt_timeout_s=2, retries=1,
+                                              backoff_s=0.2, idempotent=True, hedge_after_s=None),
+}
 
-class Retrier(object):
-    """A Retrier is a class encapsulating generic retry logic. Users can set handlers
-    to be called for retrying and aborting and cancel the retrier."""
 
-    def __init__(self, retry_handler, timeout_handler, retry_spec):
-        """Initialize the Retrier.
+class LatencyTracker(object):
+    """Remembers how long the last WINDOW successful attempts of each call took, to hedge
+    after a percentile of them, see call_with_policy."""
 
-        Args:
-            retry_handler: Handler to be called with (retrier, handler) when the RetrySpec's
-                           timeout elapses. Shall schedule a call to 'handler' after
-                           retrier.next_call_s seconds.
-            timeout_handler: The handler to call with the Retrier as an argument when the
-                             maximum number of retries have been reached.
-            retry_spec: A RetrySpec specifying how and when to call retry_handler."""
-
-        self._retry_handler   = retry_handler
-        self._timeout_handler = timeout_handler
-        self._retry_spec      = retry_spec
+    WINDOW = 100
 
-        self._next_call_s     = retry_spec.initial_delay_s
-        self._remaining_tries = retry_spec.retries
+    # Fewer latencies than that say nothing about the tail.
+    MIN_SAMPLES = 10
 
-        self._cancelled       = False
-        self._started         = datetime.now()
+    FILENAME = 'latencies.json'
 
-    @property
-    def next_call_s(self):
-        """Return the number of seconds when the next call to the retry handler is due."""
+    def __init__(self):
+        self._latencies = {}
 
-        return self._next_call_s
+    def load(self, cache_dir):
+        """Adds the latencies kept in 'cache_dir' by earlier runs, see save."""
 
-    @property
-    def remaining_tries(self):
-        """Return the number of remaining tries."""
+        path = os.path.join(cache_dir, self.FILENAME)
+        try:
+            with open(path, 'rb') as f:
+                saved = json.load(f)
+        except IOError:
+            return
+        except ValueError as e:
+            LOG.warning('Ignoring corrupt latencies %s: %s', path, e)
+            return
+        for name, latencies in saved.iteritems():
+            for latency_s in latencies:
+                self.add(name, latency_s)
 
-        return self._remaining_tries
+    def save(self, cache_dir):
+        """Keeps the latencies in 'cache_dir' for the next run."""
 
-    @property
-    def elapsed_s(self):
-        """Returns the number of elapsed seconds since creation of this Retrier."""
+        path = os.path.join(cache_dir, self.FILENAME)
+        try:
+            _write_file_atomically(path, json.dumps(dict(
+                (name, list(latencies)) for name, latencies in self._latencies.iteritems())))
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to write latencies %s: %s', path, e)
 
-        delta = datetime.now() - self._started
-        return delta.seconds + (delta.microseconds / 1000000)
+    def add(self, name, latency_s):
+        """Records that an attempt of the call 'name' was answered after 'latency_s' seconds."""
 
-    def cancel(self):
-        """Cancels calling the retry_handler again."""
+        self._latencies.setdefault(name, collections.deque(maxlen=self.WINDOW)).append(latency_s)
 
-        self._cancelled = True
+    def percentile(self, name, p):
+        """Returns the 'p'th percentile of the recent latencies of the call 'name', or None if
+        there aren't enough of them yet."""
 
-    @property
-    def retrier(self):
-        """Returns a function to be called without arguments after self.next_call_s seconds."""
+        latencies = self._latencies.get(name, ())
+        if len(latencies) < self.MIN_SAMPLES:
+            return None
+        return percentile(sorted(latencies), p)
 
-        def _retrier():
-            if self._cancelled:
-                return
+# Latencies of the calls to the TV(s) made by this process.
+LATENCIES = LatencyTracker()
+
+
+def hedge_delay_s(name, policy):
+    """Returns after how many seconds an unanswered attempt of the call 'name' (with the
+    CallPolicy 'policy') is to be hedged, or None if it isn't."""
+
+    if not policy.idempotent or not opts['hedge']:
+        return None
+    delay_s = LATENCIES.percentile(name, opts['hedge_percentile'])
+    if delay_s is None:
+        delay_s = policy.hedge_after_s
+    # Hedging when the attempt is about to time out anyway is what retrying is for.
+    if delay_s is None or delay_s >= policy.attempt_timeout_s:
+        return None
+    return delay_s
+
+def is_retryable(e):
+    """Returns whether a call that failed with the exception 'e' is worth another attempt:
+    it is if the TV didn't answer (in time), but not if it answered with an error."""
+
+    if isinstance(e, DeadlineException):
+        return True
+    if isinstance(e, ContextException):
+        return False
+    # twisted.web.error.Error has the status as a str, the asyncio engine's HTTPError as code.
+    status = str(getattr(e, 'status', None) or getattr(e, 'code', None) or '')
+    return not (status.isdigit() and int(status) < 500)
+
+def _count(name):
+    TIMINGS.set(name, TIMINGS.counters.get(name, 0) + 1)
+
+
+def call_with_policy(name, attempt, latency_name=None):
+    """Makes the call 'name' to the TV according to CALL_POLICIES[name]. 'attempt' is called
+    without arguments for each attempt and returns a Deferred firing with its result. The
+    latency of a successful attempt is recorded under 'name' for hedging, or under what
+    'latency_name' (if given) returns for its result.
+
+    Returns a Deferred firing with the result of the first attempt that succeeds. It fails
+    with the last attempt's failure if that isn't worth retrying (see is_retryable) or the
+    retries are used up, and with a DeadlineException once the policy's deadline has passed.
+    Whatever attempts are still running then are cancelled, as they are if the returned
+    Deferred is."""
+
+    policy  = CALL_POLICIES[name]
+    started = time.time()
+    running = []
+    state   = {'done': False, 'retries': 0, 'retry': None, 'hedge': None}
+
+    def _cancel():
+        state['done'] = True
+        for call in [deadline, state['retry'], state['hedge']]:
+            if call and call.active():
+                call.cancel()
+        for d in running[:]:
+            d.cancel()
+
+    result = defer.Deferred(lambda _: _cancel())
+
+    def _finish(outcome):
+        if state['done']:
+            return
+        _cancel()
+        if isinstance(outcome, Failure):
+            result.errback(outcome)
+        else:
+            result.callback(outcome)
+
+    def _start(hedge=False):
+        # Before the attempt, which might fail right away and cancel it again.
+        delay_s = None if hedge else hedge_delay_s(name, policy)
+        if delay_s is not None:
+            state['hedge'] = reactor.callLater(delay_s, _hedge, delay_s)
+
+        _count('%s_attempts' % name)
+        attempt_started = time.time()
+        d = defer.maybeDeferred(attempt)
+        running.append(d)
+        timeout = reactor.callLater(policy.attempt_timeout_s, d.cancel)
+        d.addBoth(_attempt_done, d, timeout, attempt_started)
+
+    def _hedge(delay_s):
+        if running:
+            LOG.debug('%s not answered after %.3f seconds, hedging', name, delay_s)
+            _count('%s_hedges' % name)
+            _start(hedge=True)
+
+    def _attempt_done(outcome, d, timeout, attempt_started):
+        running.remove(d)
+        timed_out = not timeout.active()
+        if not timed_out:
+            timeout.cancel()
+        if state['done']:
+            return None
+        if timed_out and isinstance(outcome, Failure) and outcome.check(defer.CancelledError):
+            outcome = Failure(DeadlineException('%s attempt took longer than %.1f seconds' %
+                                                (name, policy.attempt_timeout_s)))
+
+        if not isinstance(outcome, Failure):
+            LATENCIES.add(latency_name(outcome) if latency_name else name,
+                          time.time() - attempt_started)
+            _finish(outcome)
+            return None
+
+        LOG.debug('%s attempt failed: %s', name, outcome.getErrorMessage())
+        if running:
+            return None  # The hedged attempt might still make it.
+        if state['hedge'] and state['hedge'].active():
+            state['hedge'].cancel()
+
+        delay_s = policy.backoff_s * 2 ** state['retries']
+        if (not is_retryable(outcome.value) or state['retries'] >= policy.retries or
+                time.time() + delay_s >= started + policy.deadline_s):
+            _finish(outcome)
+            return None
+        state['retries'] += 1
+        _count('%s_retries' % name)
+        LOG.info('%s failed (%s), retrying in %.1f seconds', name, outcome.getErrorMessage(),
+                 delay_s)
+        state['retry'] = reactor.callLater(delay_s, _start)
+        return None
+
+    def _deadline():
+        _finish(Failure(DeadlineException('%s took longer than %.1f seconds' %
+                                          (name, policy.deadline_s))))
+
+    deadline = reactor.callLater(policy.deadline_s, _deadline)
+    _start()
+    return result
+
+
+class HedgedChannels(object):
+    """Passes the channels of several attempts at fetching the same channel list (see
+    call_with_policy) on to 'on_channel' once each: each attempt gets a callback of its own
+    from for_attempt(), and a channel is only passed on if no attempt has got that far into
+    the list before."""
+
+    def __init__(self, on_channel):
+        self._on_channel = on_channel
+        self._passed     = 0
+
+    def for_attempt(self):
+        """Returns the on_channel callback for the next attempt."""
+
+        if not self._on_channel:
+            return None
+        received = [0]
+        def _on_channel(channel):
+            received[0] += 1
+            if received[0] > self._passed:
+                self._passed = received[0]
+                self._on_channel(channel)
+        return _on_channel
+
+class Span(object):
+    """A timed phase of a run, see Timings."""
+
+    def __init__(self, name, started, attrs):
+        self.name       = name
+        self.started    = started
+        self.duration_s = None
+        self.ok         = None
+        self.attrs      = attrs
+
+    def finish(self, ok=True, **attrs):
+        """Ends the span, adding 'attrs' to its attributes."""
+
+        if self.duration_s is None:
+            self.duration_s = time.time() - self.started
+            self.ok = ok
+            self.attrs.update(attrs)
+
+
+class Timings(object):
+    """Records how long each phase of a run (discovery, GetChannelListURL, fetching and
+    parsing the channel list, each SetMainTVChannel attempt) took, plus a few counters, and
+    exports them as JSON lines and in the Prometheus text format for the node exporter's
+    textfile collector. Does nothing unless enabled."""
+
+    # Upper bounds of the buckets of the run duration histogram in the Prometheus export.
+    HISTOGRAM_BUCKETS_S = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+    def __init__(self, enabled=False):
+        self.enabled  = enabled
+        self.started  = time.time()
+        self.spans    = []
+        self.counters = {}
+
+    def span(self, name, **attrs):
+        """Returns a new Span called 'name' with the attributes 'attrs' which starts now."""
+
+        span = Span(name, time.time(), attrs)
+        if self.enabled:
+            self.spans.append(span)
+        return span
+
+    def track(self, d, name, **attrs):
+        """Records a Span called 'name' lasting until the Deferred 'd' fires. Returns 'd'."""
+
+        span = self.span(name, **attrs)
+        def _done(result):
+            span.finish(ok=not isinstance(result, Failure))
+            return result
+        return d.addBoth(_done)
+
+    def set(self, name, value):
+        """Sets the counter 'name' to 'value'."""
+
+        self.counters[name] = value
+
+    def write_json_lines(self, path, ok):
+        """Appends a line for each span and one for the whole run to the file 'path'."""
+
+        run_id = '%x-%d' % (int(self.started * 1000), os.getpid())
+        lines = []
+        for span in self.spans:
+            lines.append({
+                'type'      : 'span',
+                'run'       : run_id,
+                'name'      : span.name,
+                'start_s'   : round(span.started - self.started, 6),
+                'duration_s': span.duration_s,
+                'ok'        : span.ok,
+                'attrs'     : span.attrs,
+            })
+        lines.append({
+            'type'      : 'run',
+            'run'       : run_id,
+            'timestamp' : self.started,
+            'duration_s': time.time() - self.started,
+            'ok'        : ok,
+            'counters'  : self.counters,
+        })
+        with open(path, 'ab') as f:
+            for line in lines:
+                f.write(json.dumps(line, sort_keys=True) + '\n')
+
+    def write_prometheus(self, path, ok):
+        """Writes the metrics of this run to 'path' for the textfile collector. The run duration
+        histogram accumulates over runs; its state is kept in 'path'.json."""
+
+        duration_s = time.time() - self.started
+        result = 'success' if ok else 'failure'
+
+        state_path = path + '.json'
+        try:
+            with open(state_path, 'rb') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = {}
+        histogram = state.setdefault(result, {'buckets': [0] * len(self.HISTOGRAM_BUCKETS_S),
+                                              'count': 0, 'sum': 0.0})
+        for i, bound in enumerate(self.HISTOGRAM_BUCKETS_S):
+            if duration_s <= bound:
+                histogram['buckets'][i] += 1
+        histogram['count'] += 1
+        histogram['sum']   += duration_s
+
+        lines = [
+            '# HELP sstcs_run_duration_seconds Duration of sstcs runs.',
+            '# TYPE sstcs_run_duration_seconds histogram',
+        ]
+        for run_result, h in sorted(state.iteritems()):
+            for bound, count in zip(self.HISTOGRAM_BUCKETS_S, h['buckets']):
+                lines.append('sstcs_run_duration_seconds_bucket{result="%s",le="%g"} %d' %
+                             (run_result, bound, count))
+            lines.append('sstcs_run_duration_seconds_bucket{result="%s",le="+Inf"} %d' %
+                         (run_result, h['count']))
+            lines.append('sstcs_run_duration_seconds_sum{result="%s"} %f' % (run_result, h['sum']))
+            lines.append('sstcs_run_duration_seconds_count{result="%s"} %d' %
+                         (run_result, h['count']))
+
+        lines += [
+            '# HELP sstcs_last_run_timestamp_seconds When the last run started.',
+            '# TYPE sstcs_last_run_timestamp_seconds gauge',
+            'sstcs_last_run_timestamp_seconds %f' % self.started,
+            '# HELP sstcs_last_run_success Whether the last run succeeded.',
+            '# TYPE sstcs_last_run_success gauge',
+            'sstcs_last_run_success %d' % ok,
+            '# HELP sstcs_last_run_phase_seconds Total duration of each phase of the last run.',
+            '# TYPE sstcs_last_run_phase_seconds gauge',
+        ]
+        phases = collections.OrderedDict()
+        for span in self.spans:
+            if span.duration_s is not None:
+                phases[span.name] = phases.get(span.name, 0) + span.duration_s
+        for name, phase_s in phases.iteritems():
+            lines.append('sstcs_last_run_phase_seconds{phase="%s"} %f' % (name, phase_s))
+
+        lines += [
+            '# HELP sstcs_last_run_count Counters of the last run.',
+            '# TYPE sstcs_last_run_count gauge',
+        ]
+        for name, value in sorted(self.counters.iteritems()):
+            if isinstance(value, (int, long, float)):
+                lines.append('sstcs_last_run_count{counter="%s"} %s' % (name, value))
+
+        _write_file_atomically(state_path, json.dumps(state, sort_keys=True))
+        _write_file_atomically(path, '\n'.join(lines) + '\n')
+
+    def write(self, ok):
+        """Writes the timings to wherever the options say."""
+
+        if not self.enabled:
+            return
+
+        LOG.debug('Timings: %s', ', '.join('%s=%.3fs' % (span.name, span.duration_s)
+                                           for span in self.spans
+                                           if span.duration_s is not None))
+        for path, write in [(opts['timings_json'], self.write_json_lines),
+                            (opts['prom_textfile'], self.write_prometheus)]:
+            if not path:
+                continue
+            try:
+                write(path, ok)
+            except (IOError, OSError) as e:
+                LOG.warning('Unable to write timings to %s: %s', path, e)
+
+# Timings of this run. Replaced by an enabled one in main if timings are to be exported.
+TIMINGS = Timings()
+
+
+def _frame_name(frame):
+    """Returns 'function (file:line)' for a frame, the line being where the function starts,
+    so all samples of a function add up."""
+
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Profiler(object):
+    """Profiles the run for --profile. By default deterministically with cProfile, writing
+    pstats to 'path' (see python -m pstats). If 'path' ends with '.folded', a thread samples the
+    main thread's stack every SAMPLE_INTERVAL_S instead and the samples are written as collapsed
+    stacks, one 'outermost;...;innermost count' line per distinct stack, which flamegraph.pl and
+    speedscope read. Sampling goes by the wall clock, so time spent waiting for the TV shows up
+    as the reactor sitting in its poll."""
+
+    SAMPLE_INTERVAL_S = 0.005
+
+    def __init__(self, path):
+        self.path = path
+        self.sampling = path.endswith('.folded')
+        self._profile = None
+        self._samples = collections.Counter()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        if self.sampling:
+            self._thread = threading.Thread(target=self._sample, name='Profiler',
+                                            args=(threading.current_thread().ident,))
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def _sample(self, thread_id):
+        while not self._stopped:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self._samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.SAMPLE_INTERVAL_S)
+
+    def stop(self):
+        """Stops profiling and writes the profile."""
 
-            if self._remaining_tries == 0:
-                self._timeout_handler(retrier=self)
+        try:
+            if self.sampling:
+                self._stopped = True
+                self._thread.join()
+                _write_file_atomically(self.path, ''.join(
+                    '%s %d\n' % (stack, count)
+                    for stack, count in sorted(self._samples.iteritems())))
             else:
-                retrier = self
-                handler = _retrier
-                self._retry_handler(retrier, handler)
+                self._profile.disable()
+                self._profile.dump_stats(self.path)
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to write the profile to %s: %s', self.path, e)
+        else:
+            LOG.info('Wrote the profile to %s', self.path)
+
+
+class LagMonitor(object):
+    """Logs event loop stalls longer than 'threshold_s' for --lag-threshold, with the callback
+    that caused them. The loop runs a heartbeat every 'threshold_s' seconds (scheduled with
+    'call_later', which is reactor.callLater or an asyncio loop's call_later), and a watchdog
+    thread checks it's on time. If it's late by more than the threshold, the watchdog takes the
+    loop thread's stack, whose outermost frame below the loop's own code is the culprit. Once
+    the heartbeat runs again, the stall is logged and recorded in TIMINGS."""
+
+    # Top-level packages of the event loops we run on; their frames aren't culprits.
+    LOOP_PACKAGES = frozenset(['twisted', 'trollius', 'asyncio'])
+
+    def __init__(self, threshold_s, call_later):
+        self.threshold_s = threshold_s
+        self.stalls      = 0
+        self._call_later = call_later
+        self._beat       = None
+        self._stack      = None
+        self._stopped    = False
+        self._call       = None
+
+    def start(self):
+        """Starts monitoring. Must be called from the thread running the event loop."""
+
+        self._beat = time.time()
+        self._call = self._call_later(self.threshold_s, self._heartbeat)
+        thread = threading.Thread(target=self._watch, name='LagMonitor',
+                                  args=(threading.current_thread().ident,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped = True
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def _heartbeat(self):
+        now = time.time()
+        lag_s = now - self._beat - self.threshold_s
+        stack, self._stack = self._stack, None
+        if stack is not None and lag_s >= self.threshold_s:
+            self._report(now - lag_s, lag_s, stack)
+        self._beat = time.time()
+        self._call = self._call_later(self.threshold_s, self._heartbeat)
+
+    def _watch(self, thread_id):
+        while not self._stopped:
+            time.sleep(self.threshold_s / 4)
+            # Only one stack per stall: the one taken while it's still going on.
+            if (self._stack is None and
+                    time.time() - self._beat >= 2 * self.threshold_s):
+                frame = sys._current_frames().get(thread_id)
+                self._stack = traceback.extract_stack(frame) if frame else []
+
+    def _is_loop_file(self, filename):
+        parts = os.path.normpath(filename).split(os.path.sep)
+        parts[-1] = os.path.splitext(parts[-1])[0]
+        return not self.LOOP_PACKAGES.isdisjoint(parts)
+
+    def _culprit(self, stack):
+        """Returns a description of the callback the loop was running in the stack (outermost
+        frame first) of a stall, and of the innermost frame if that's a different one."""
+
+        if not stack:
+            return 'an unknown callback'
+
+        loop_frames = [i for i, (filename, _, _, _) in enumerate(stack)
+                       if self._is_loop_file(filename)]
+        callback = stack[-1]
+        if loop_frames and loop_frames[-1] + 1 < len(stack):
+            callback = stack[loop_frames[-1] + 1]
+        where = '%s (%s:%d)' % (callback[2], os.path.basename(callback[0]), callback[1])
+        if callback is not stack[-1]:
+            where += ', at %s (%s:%d)' % (stack[-1][2], os.path.basename(stack[-1][0]),
+                                          stack[-1][1])
+        return where
+
+    def _report(self, started, lag_s, stack):
+        self.stalls += 1
+        where = self._culprit(stack)
+        LOG.warning('The event loop stalled for %.3f seconds in %s', lag_s, where)
+        LOG.debug('Stack during the stall:\n%s', ''.join(traceback.format_list(stack)))
+
+        span = TIMINGS.span('stall', callback=where)
+        span.started = started
+        span.finish(ok=False)
+        TIMINGS.set('stalls', self.stalls)
 
-                self._remaining_tries -= 1
-                self._next_call_s     *= self._retry_spec.backoff_factor
-        return _retrier
 
 class LogFormatter(logging.Formatter):
     """Formatter for sstcs' log. Colors the log level and auto-grows columns."""
 
     def __init__(self, initial_widths={}):
         self.widths = initial_widths.copy()
+        # strftime is the expensive part of a record, and all records within a second share it.
+        self._time_second = None
+        self._time_text   = None
         super(LogFormatter, self).__init__()
 
     def _get_padded_text(self, what, text):
@@ -187,8 +844,11 @@ class LogFormatter(logging.Formatter):
         colored_loglevel = (LOG_LEVEL_COLORS.get(record.levelno, '') +
                             self._get_padded_text('levelname', record.levelname) +
                             LOG_LEVEL_COLOR_RESET)
-        formatted_time = '%s,%03d' % (time.strftime("%H:%M:%S", time.localtime(record.created)),
-                                      record.msecs)
+        second = int(record.created)
+        if second != self._time_second:
+            self._time_second = second
+            self._time_text   = time.strftime("%H:%M:%S", time.localtime(record.created))
+        formatted_time = '%s,%03d' % (self._time_text, record.msecs)
 
         try:
             message = record.message
@@ -202,10 +862,58 @@ class LogFormatter(logging.Formatter):
         if name == 'py.warnings' and hasattr(record, 'real_module'):
             name = record.real_module
         padded_name = self._get_padded_text('name', name)
-        return '\n'.join("%s %s %s %s" % (formatted_time,
-                                          padded_name,
-                                          colored_loglevel,
-                                          line) for line in message.split('\n'))
+        prefix = "%s %s %s " % (formatted_time, padded_name, colored_loglevel)
+        if '\n' not in message:
+            return prefix + message
+        return '\n'.join(prefix + line for line in message.split('\n'))
+
+
+class QueueHandler(logging.Handler):
+    """Puts log records into a queue for a LogWriter to format and write, so whoever logs (the
+    reactor, mostly) never waits for formatting or for the terminal."""
+
+    def __init__(self, queue):
+        self.queue = queue
+        super(QueueHandler, self).__init__()
+
+    def emit(self, record):
+        # Render the message now, like the stdlib's QueueHandler.prepare: by the time the
+        # LogWriter gets to it, mutable arguments may have changed, and Channels are decoded
+        # lazily, which is nothing to do on another thread.
+        try:
+            record.msg  = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                if not record.exc_text:
+                    record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+        except Exception:
+            self.handleError(record)
+            return
+        self.queue.put_nowait(record)
+
+
+class LogWriter(threading.Thread):
+    """Takes log records from a QueueHandler's queue and hands them to 'handler' in a thread of
+    its own. stop() writes what's still queued and waits for that, see set_up_logging."""
+
+    def __init__(self, queue, handler):
+        self.queue   = queue
+        self.handler = handler
+        super(LogWriter, self).__init__(name='LogWriter')
+        self.daemon = True
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.handler.handle(record)
+
+    def stop(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
 
 
 
@@ -234,59 +942,149 @@ class ParseException(ContextException):
     pass
 
 
-def _getint(buf, offset):
-    """Helper function to extract a 16-bit little-endian unsigned from a char
-    buffer 'buf' at offset 'offset'..'offset'+2."""
-    x = unpack('<H', buf[offset:offset+2])
-    return x[0]
+class DiscoveryException(ContextException):
+    """An Exception for when we couldn't find (or talk to) the TV."""
+    pass
+
+
+class SwitchException(ContextException):
+    """An Exception for when the TV couldn't switch to a channel."""
+    pass
+
+
+class DeadlineException(ContextException):
+    """An Exception for when something took longer than we were willing to wait."""
+    pass
+
+
+class SupersededException(ContextException):
+    """An Exception for when a daemon's switch request was dropped for a later one."""
+    pass
+
+
+class EventException(ContextException):
+    """An Exception for when we couldn't subscribe to the TV's events."""
+    pass
+
+
+class ActionException(ContextException):
+    """An Exception for when the TV answered a UPnP action with a SOAP fault. error_code is
+    the UPnP error code from the fault, or None if it didn't have one."""
+
+    def __init__(self, msg, context=[], error_code=None):
+        super(ActionException, self).__init__(msg, context)
+        self.error_code = error_code
+
+
+# Each channel list entry consists of (all integers are 16-bit little-endian unsigned):
+#   [2 bytes int] Type of the channel. I've only seen 3 and 4, meaning
+#                 CDTV (Cable Digital TV, I guess) or CATV (Cable Analog
+#                 TV) respectively as argument for <ChType>
+#   [2 bytes int] Major channel (<MajorCh>)
+#   [2 bytes int] Minor channel (<MinorCh>)
+#   [2 bytes int] PTC (Physical Transmission Channel?), <PTC>
+#   [2 bytes int] Program Number (in the mux'ed MPEG or so?), <ProgNum>
+#   [2 bytes int] They've always been 0xffff for me, so I'm just assuming
+#                 they have to be :)
+#   [4 bytes string, \0-padded] The (usually 3-digit, for me) channel number
+#                               that's displayed (and which you can enter), in ASCII
+#   [6 bytes] No idea.
+#   [2 bytes int] Length of the channel title
+#   [100 bytes string, \0-padded] The channel title, in UTF-8 (wow)
+#
+# See _parse_channel_list for the header.
+CHANNEL_LIST_HEADER = Struct('<2xH')
+CHANNEL_ENTRY_INTS  = Struct('<5H')  # ChType, MajorCh, MinorCh, PTC, ProgNum
+CHANNEL_ENTRY_CHECK = Struct('<H8xH')  # Channel type and reserved field
+CHANNEL_TITLE_LEN   = Struct('<H')
+CHANNEL_ENTRY_SIZE  = 124
+
+# The fields of Channel.key.
+CHANNEL_KEY_FIELDS = ['ch_type', 'major_ch', 'minor_ch', 'ptc', 'prog_num']
+
+# Maps the channel type field of a channel list entry to the <ChType> SetMainTVChannel wants.
+CHANNEL_TYPES = {
+    3: 'CATV',
+    4: 'CDTV',
+}
 
 class Channel(object):
-    """Class representing a Channel from the TV's channel list."""
-
-    def __init__(self, from_dat):
-        """Constructs the Channel object from a binary channel list chunk."""
-
-        self._parse_dat(from_dat)
-
-    def _parse_dat(self, buf):
-        """Parses the binary data from a channel list chunk and initilizes the
-        member variables."""
-
-        # Each entry consists of (all integers are 16-bit little-endian unsigned):
-        #   [2 bytes int] Type of the channel. I've only seen 3 and 4, meaning
-        #                 CDTV (Cable Digital TV, I guess) or CATV (Cable Analog
-        #                 TV) respectively as argument for <ChType>
-        #   [2 bytes int] Major channel (<MajorCh>)
-        #   [2 bytes int] Minor channel (<MinorCh>)
-        #   [2 bytes int] PTC (Physical Transmission Channel?), <PTC>
-        #   [2 bytes int] Program Number (in the mux'ed MPEG or so?), <ProgNum>
-        #   [2 bytes int] They've always been 0xffff for me, so I'm just assuming
-        #                 they have to be :)
-        #   [4 bytes string, \0-padded] The (usually 3-digit, for me) channel number
-        #                               that's displayed (and which you can enter), in ASCII
-        #   [2 bytes int] Length of the channel title
-        #   [106 bytes string, \0-padded] The channel title, in UTF-8 (wow)
-
-        t = _getint(buf, 0)
-        if t == 4:
-            self.ch_type = 'CDTV'
-        elif t == 3:
-            self.ch_type = 'CATV'
-        else:
+    """Class representing a Channel from the TV's channel list. A Channel is merely a view on
+    its entry in the raw channel list, so it's cheap to construct and small even for long
+    lists: the fields are decoded when they are first accessed, and the title and the XML
+    representation for SetMainTVChannel are built only once."""
+
+    __slots__ = ('_raw', '_pos', '_ints', '_title', '_xml')
+
+    def __init__(self, from_dat, pos=0):
+        """Constructs the Channel object from the binary channel list chunk at 'pos' in
+        'from_dat'. The channel type and reserved field are checked right away, everything
+        else is decoded lazily."""
+
+        t, reserved = CHANNEL_ENTRY_CHECK.unpack_from(from_dat, pos)
+        if t not in CHANNEL_TYPES:
             raise ParseException('Unknown channel type %d' % t)
 
-        self.major_ch = _getint(buf, 2)
-        self.minor_ch = _getint(buf, 4)
-        self.ptc      = _getint(buf, 6)
-        self.prog_num = _getint(buf, 8)
+        if reserved != 0xffff:
+            raise ParseException('reserved field mismatch (%04x)' % reserved)
+
+        self._raw = from_dat
+        self._pos = pos
+
+    def _get_ints(self):
+        try:
+            return self._ints
+        except AttributeError:
+            self._ints = CHANNEL_ENTRY_INTS.unpack_from(self._raw, self._pos)
+            return self._ints
+
+    @property
+    def ch_type(self):
+        return CHANNEL_TYPES[self._get_ints()[0]]
+
+    @property
+    def major_ch(self):
+        return self._get_ints()[1]
+
+    @property
+    def minor_ch(self):
+        return self._get_ints()[2]
+
+    @property
+    def ptc(self):
+        return self._get_ints()[3]
+
+    @property
+    def prog_num(self):
+        return self._get_ints()[4]
+
+    @property
+    def record(self):
+        """The channel's raw 124-byte channel list entry."""
+
+        return self._raw[self._pos:self._pos+CHANNEL_ENTRY_SIZE]
 
-        if _getint(buf, 10) != 0xffff:
-            raise ParseException('reserved field mismatch (%04x)' % _getint(buf, 10))
+    @property
+    def key(self):
+        """The fields identifying a channel across channel lists (see CHANNEL_KEY_FIELDS),
+        which unlike the display number and title don't change when channels are renumbered
+        or renamed."""
+
+        return self._get_ints()
 
-        self.dispno = buf[12:16].rstrip('\x00')
+    @property
+    def dispno(self):
+        return self._raw[self._pos+12:self._pos+16].rstrip('\x00')
 
-        title_len = _getint(buf, 22)
-        self.title = buf[24:24+title_len].decode('utf-8')
+    @property
+    def title(self):
+        try:
+            return self._title
+        except AttributeError:
+            title_len, = CHANNEL_TITLE_LEN.unpack_from(self._raw, self._pos+22)
+            title_len = min(title_len, CHANNEL_ENTRY_SIZE-24)
+            self._title = self._raw[self._pos+24:self._pos+24+title_len].decode('utf-8')
+            return self._title
 
     def display_string(self):
         """Returns a unicode display string, since both __repr__ and __str__ convert it
@@ -294,6 +1092,19 @@ class Channel(object):
 
         return u'[%s] % 4s %s' % (self.ch_type, self.dispno, self.title)
 
+    def as_dict(self):
+        """Returns the channel's fields as a dict, e.g. for JSON."""
+
+        return {
+            'ch_type' : self.ch_type,
+            'major_ch': self.major_ch,
+            'minor_ch': self.minor_ch,
+            'ptc'     : self.ptc,
+            'prog_num': self.prog_num,
+            'dispno'  : self.dispno,
+            'title'   : self.title,
+        }
+
     def __repr__(self):
         return '<Channel %s %s ChType=%s MajorCh=%d MinorCh=%d PTC=%d ProgNum=%d>' % \
             (self.dispno, repr(self.title), self.ch_type, self.major_ch, self.minor_ch, self.ptc,
@@ -303,260 +1114,3151 @@ class Channel(object):
     def as_xml(self):
         """The channel list as XML representation for SetMainTVChannel."""
 
-        return ('<?xml version="1.0" encoding="UTF-8" ?><Channel><ChType>%s</ChType><MajorCh>%d'
-                '</MajorCh><MinorCh>%d</MinorCh><PTC>%d</PTC><ProgNum>%d</ProgNum></Channel>') % \
-            (escape(self.ch_type), self.major_ch, self.minor_ch, self.ptc, self.prog_num)
-
-
-def set_channel_returned(result, set_main_tv_channel, cl_type_fallbacks, channel):
-    """Called when SetMainTVChannel returns. Extracts the 'Result' field from the result
-    and in case the result is 'NOTOK_InvalidCh' calls SetMainTVChannel again, with itself
-    as callback the next channel type list from cl_type_fallbacks. Or, just tells the
-    user whether the TV succeeded in switching the channel or returned an error."""
-
+        try:
+            return self._xml
+        except AttributeError:
+            self._xml = ('<?xml version="1.0" encoding="UTF-8" ?><Channel><ChType>%s</ChType>'
+                         '<MajorCh>%d</MajorCh><MinorCh>%d</MinorCh><PTC>%d</PTC><ProgNum>%d'
+                         '</ProgNum></Channel>') % \
+                (escape(self.ch_type), self.major_ch, self.minor_ch, self.ptc, self.prog_num)
+            return self._xml
+
+
+def set_channel_returned(result, set_main_tv_channel, cl_type, cl_type_fallbacks, channel,
+                         tried):
+    """Called when SetMainTVChannel (with channel list type 'cl_type') returns. Extracts the
+    'Result' field from the result and in case the result is 'NOTOK_InvalidCh' calls
+    SetMainTVChannel again, with itself as callback the next channel type list from
+    cl_type_fallbacks. Or, just tells the user whether the TV succeeded in switching the
+    channel and returns the channel list type that worked, or raises a SwitchException if it
+    returned an error. Appends each channel list type the TV answered for to 'tried'."""
+
+    tried.append(cl_type)
     LOG.debug('set_channel_returned: result=%r, fallbacks=%r, channel=%r', result,
         cl_type_fallbacks, channel)
 
-    if result['Result'] == 'NOTOK_InvalidCh':
+    if not _check_set_channel_result(result):
         try:
-            cl_type = cl_type_fallbacks.pop(0)
+            next_cl_type = cl_type_fallbacks.pop(0)
         except IndexError:
-            fatal('TV doesn\'t know how to switch to %s' % channel)
-            return
+            raise SwitchException('TV doesn\'t know how to switch to %s' % channel)
 
         LOG.warning("channel %s not in current channel list, trying with %s",
-                    channel, cl_type)
-        set_main_tv_channel.call(ChannelListType=cl_type,
-                                 SatelliteID=0,
-                                 Channel=channel.as_xml).\
-                        addCallback(set_channel_returned, set_main_tv_channel,
-                                    cl_type_fallbacks, channel)
+                    channel, next_cl_type)
+        d = call_with_policy('set_main_tv_channel', lambda: set_main_tv_channel.call(
+            ChannelListType=next_cl_type, SatelliteID=0, Channel=channel.as_xml))
+        return TIMINGS.track(d, 'set_main_tv_channel', cl_type=next_cl_type, fallback=True).\
+                        addCallback(set_channel_returned, set_main_tv_channel, next_cl_type,
+                                    cl_type_fallbacks, channel, tried)
+
+    LOG.info('Channel switched.')
+    TIMINGS.set('cl_type', cl_type)
+    return cl_type
+
+def _check_set_channel_result(result):
+    """Returns True if the results 'result' of SetMainTVChannel say the TV switched, or False
+    if the channel isn't in the channel list type we passed. Raises a SwitchException if the
+    TV reported back anything else."""
+
+    if result['Result'] == 'NOTOK_InvalidCh':
+        return False
     elif result['Result'] == 'OK':
-        LOG.info('Channel switched.')
-        reactor.stop()
-        return
+        return True
+    raise SwitchException('TV reported back result %s, no idea what that is.' % result)
+
+
+class ChannelListTypeStats(object):
+    """Remembers, per TV, which channel list type switching to a channel last worked with and
+    how often switching worked with each channel list type, in a JSON file in the cache
+    directory. With that, switches to channels outside the current channel list usually take
+    a single SetMainTVChannel call instead of walking CL_TYPE_FALLBACKS."""
+
+    FILENAME = 'cl_types.json'
+
+    def __init__(self, cache_dir):
+        self._path = os.path.join(cache_dir, self.FILENAME)
+
+    @staticmethod
+    def _key(channel):
+        return '%d/%d/%d' % (channel.ptc, channel.prog_num, channel.major_ch)
+
+    def _load(self):
+        try:
+            with open(self._path, 'rb') as f:
+                return json.load(f)
+        except IOError:
+            return {}
+        except ValueError as e:
+            LOG.warning('Ignoring corrupt channel list type stats %s: %s', self._path, e)
+            return {}
+
+    def order(self, udn, channel, cl_type):
+        """Returns the channel list types to try switching to 'channel' on TV 'udn' with, in
+        order: the one that worked last time, the TV's current one 'cl_type', and then
+        CL_TYPE_FALLBACKS, most successful first."""
+
+        tv = self._load().get(udn, {})
+        stats = tv.get('stats', {})
+
+        def _success_rate(fallback):
+            successes, attempts = stats.get(fallback, (0, 0))
+            # Laplace smoothing, so types we know nothing about rank in the middle.
+            return float(successes + 1) / (attempts + 2)
+
+        fallbacks = sorted(CL_TYPE_FALLBACKS,
+                           key=lambda fallback: (-_success_rate(fallback),
+                                                 CL_TYPE_FALLBACKS.index(fallback)))
+
+        cl_types = []
+        for candidate in [tv.get('channels', {}).get(self._key(channel)), cl_type] + fallbacks:
+            if candidate and candidate not in cl_types:
+                cl_types.append(candidate)
+        return cl_types
+
+    def record(self, udn, channel, tried, worked):
+        """Records that switching to 'channel' on TV 'udn' has been tried with the channel list
+        types 'tried', of which 'worked' (if not None) worked."""
+
+        entries = self._load()
+        tv = entries.setdefault(udn, {'channels': {}, 'stats': {}})
+        for cl_type in tried:
+            successes, attempts = tv['stats'].get(cl_type, (0, 0))
+            tv['stats'][cl_type] = (successes + (cl_type == worked), attempts + 1)
+        if worked:
+            tv['channels'][self._key(channel)] = worked
+
+        try:
+            _write_file_atomically(self._path, json.dumps(entries, indent=2, sort_keys=True))
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to write channel list type stats %s: %s', self._path, e)
+
+
+def switch_channel(set_main_tv_channel, cl_type, channel, udn=None,
+                   get_current_main_tv_channel=None):
+    """Calls SetMainTVChannel (the Action 'set_main_tv_channel') to switch to 'channel' in the
+    channel list type 'cl_type', falling back to CL_TYPE_FALLBACKS if the channel isn't in
+    there. If we know the TV's UDN 'udn' and caching is enabled, ChannelListTypeStats picks
+    the order of channel list types to try, and learns from the outcome. If the Action
+    'get_current_main_tv_channel' is given, the switch is verified with it (see
+    verify_switch). Returns a Deferred firing with the channel list type that worked.
+
+    Next: set_channel_returned, passing a list of fallback channel types and everything
+    needed to reproduce the call to SetMainTVChannel for the fallback channel lists."""
+
+    stats = None
+    if udn and opts['use_cache']:
+        stats = ChannelListTypeStats(opts['cache_dir'])
+        cl_types = stats.order(udn, channel, cl_type)
     else:
-        fatal('TV reported back result %s, no idea what that is.' % result)
-        return
+        cl_types = [cl_type] + CL_TYPE_FALLBACKS
+    first_cl_type = cl_types[0]
+    channel_xml   = channel.as_xml
+
+    LOG.debug('Calling SetMainTVChannel(ChannelListType=%r, SatelliteID=0, Channel=%r)',
+        first_cl_type, channel_xml)
+
+    d = call_with_policy('set_main_tv_channel', lambda: set_main_tv_channel.call(
+        ChannelListType=first_cl_type, SatelliteID=0, Channel=channel_xml))
+    tried = []
+    d = TIMINGS.track(d, 'set_main_tv_channel', cl_type=first_cl_type, fallback=False).\
+        addCallback(set_channel_returned, set_main_tv_channel, first_cl_type, cl_types[1:],
+                    channel, tried)
+
+    if stats:
+        def _learn(result):
+            if isinstance(result, Failure):
+                if result.check(SwitchException):
+                    stats.record(udn, channel, tried, None)
+            else:
+                stats.record(udn, channel, tried, result)
+            return result
+        d.addBoth(_learn)
+
+    if get_current_main_tv_channel:
+        # After learning: the channel list type did work, even if the TV then fails to tune.
+        d.addCallback(lambda cl_type: verify_switch(get_current_main_tv_channel, channel).
+                      addCallback(lambda tune_s_: cl_type))
+    return d
+
+
+def is_current_channel(result, channel):
+    """Returns whether the results 'result' of GetCurrentMainTVChannel say the TV is tuned to
+    'channel'."""
+
+    if result.get('Result') != 'OK':
+        return False
+    try:
+        current = ElementTree.fromstring(result.get('CurrentChannel', '').encode('utf-8'))
+        return ((current.findtext('ChType'), int(current.findtext('MajorCh')),
+                 int(current.findtext('MinorCh')), int(current.findtext('PTC')),
+                 int(current.findtext('ProgNum'))) ==
+                (channel.ch_type, channel.major_ch, channel.minor_ch, channel.ptc,
+                 channel.prog_num))
+    except (SyntaxError, TypeError, ValueError) as e:
+        LOG.debug('Unable to parse current channel %r: %s', result.get('CurrentChannel'), e)
+        return False
+
+def verify_switch(get_current_main_tv_channel, channel):
+    """Polls GetCurrentMainTVChannel (the Action 'get_current_main_tv_channel') after the TV
+    acknowledged switching to 'channel', see VERIFY_POLL_DELAYS_S, until the TV says it's
+    tuned to it. Returns a Deferred firing with the number of seconds that took, or failing
+    with a SwitchException if it takes longer than opts['verify_timeout_s'] seconds.
+    Cancelling it stops polling."""
+
+    started = time.time()
+    span = TIMINGS.span('verify')
+    state = {'stopped': False, 'poll': None, 'call': None}
+
+    def _cancel(_):
+        state['stopped'] = True
+        span.finish(ok=False)
+        if state['poll'] and state['poll'].active():
+            state['poll'].cancel()
+        if state['call']:
+            state['call'].cancel()
+
+    verified = defer.Deferred(_cancel)
+
+    def _poll(n):
+        state['call'] = call_with_policy('get_current_main_tv_channel',
+                                         get_current_main_tv_channel.call)
+        state['call'].addCallbacks(_polled, _failed, callbackArgs=(n,))
+
+    def _polled(result, n):
+        if state['stopped']:
+            return
+        tune_s = time.time() - started
+        if is_current_channel(result, channel):
+            LOG.info('Tuned to %s %.3f seconds after the TV acknowledged (%d polls)',
+                     channel.display_string(), tune_s, n + 1)
+            span.finish(polls=n + 1)
+            TIMINGS.set('tune_s', round(tune_s, 3))
+            verified.callback(tune_s)
+        elif tune_s >= opts['verify_timeout_s']:
+            _failed(SwitchException('TV acknowledged switching to %s, but still wasn\'t tuned '
+                                    'to it after %.1f seconds' % (channel.display_string(),
+                                                                  tune_s),
+                                    ['current channel: %s' % result.get('CurrentChannel')]))
+        else:
+            delay_s = VERIFY_POLL_DELAYS_S[min(n, len(VERIFY_POLL_DELAYS_S) - 1)]
+            state['poll'] = reactor.callLater(min(delay_s, opts['verify_timeout_s'] - tune_s),
+                                              _poll, n + 1)
+
+    def _failed(failure):
+        if state['stopped']:
+            return
+        span.finish(ok=False)
+        verified.errback(failure)
+
+    _poll(0)
+    return verified
 
 
 def _parse_channel_list(channel_list):
     """Splits the binary channel list into channel entry fields and returns a list of Channels."""
 
+    span = TIMINGS.span('parse', bytes=len(channel_list))
+    try:
+        channels = _split_channel_list(channel_list)
+    except ParseException:
+        span.finish(ok=False)
+        raise
+
+    LOG.debug('Parsed %d channels', len(channels))
+    span.finish(channels=len(channels))
+    TIMINGS.set('channels', len(channels))
+    return channels
+
+def _split_channel_list(channel_list):
+    """Checks the binary channel list and returns a list of Channels, one per entry."""
+
     # The channel list is binary file with a 4-byte header, containing 2 unknown bytes and
     # 2 bytes for the channel count, which must be len(list)-4/124, as each following channel
-    # is 124 bytes each. See Channel._parse_dat for how each entry is constructed.
+    # is 124 bytes each. See Channel for how each entry is constructed.
 
     if len(channel_list) < 128:
         raise ParseException(('channel list is smaller than it has to be for at least '\
                               'one channel (%d bytes (actual) vs. 128 bytes' % len(channel_list)),
-                             ('Channel list: %s' % repr(channel_list)))
+                             ['Channel list: %s' % repr(channel_list)])
 
 
     if (len(channel_list)-4) % 124 != 0:
         raise ParseException(('channel list\'s size (%d) minus 128 (header) is not a multiple of '\
                               '124 bytes' % len(channel_list)),
-                             ('Channel list: %s' % repr(channel_list)))
+                             ['Channel list: %s' % repr(channel_list)])
 
     actual_channel_list_len = (len(channel_list)-4) / 124
-    expected_channel_list_len = _getint(channel_list, 2)
+    expected_channel_list_len, = CHANNEL_LIST_HEADER.unpack_from(channel_list)
     if actual_channel_list_len != expected_channel_list_len:
         raise ParseException(('Actual channel list length ((%d-4)/124=%d) does not equal expected '\
                               'channel list length (%d) as defined in header' % (len(channel_list),
-                              actual_channel_list_len, expected_channel_list_len))
-                             ('Channel list: %s' % repr(channel_list)))
+                              actual_channel_list_len, expected_channel_list_len)),
+                             ['Channel list: %s' % repr(channel_list)])
 
+    # Channels are views on their entry in channel_list, so we only check each entry here
+    # instead of slicing it out and decoding it. Fields are unpacked straight from
+    # channel_list when they are accessed.
     channels = []
-    pos = 4
-    while pos < len(channel_list):
-        chunk = channel_list[pos:pos+124]
+    for pos in xrange(4, len(channel_list), CHANNEL_ENTRY_SIZE):
         try:
-            channels.append(Channel(chunk))
+            channels.append(Channel(channel_list, pos))
         except ParseException as pe:
-            pe.add_context('chunk starting at %d: %s' % (pos, repr(chunk)))
+            pe.add_context('chunk starting at %d: %s' %
+                           (pos, repr(channel_list[pos:pos+CHANNEL_ENTRY_SIZE])))
             raise pe
-
-        pos += 124
-
-    LOG.debug('Parsed %d channels', len(channels))
     return channels
 
 
-def got_channel_list(channel_list, cl_type, service):
-    """Called when the channel list URL has been retrieved. Parses the channel list, looks
-    for a matching channel and calls SetMainTVChannel with the passed cl_type (channel list
-    type), unless opts['do_list'] is true, in which case it just prints the channels and
-    terminates Twisted.
+def diff_channel_lists(old, new):
+    """Compares the lists of Channels 'old' and 'new', matching channels by Channel.key.
+    Returns a list of (change, old channel, new channel) tuples, where change is 'added' (old
+    channel is None), 'removed' (new channel is None), 'renumbered' or 'renamed'. A channel
+    can be both renumbered and renamed. Changes are in the order of the new list, with the
+    removed channels last in the order of the old list.
+
+    Channels sharing a key (which shouldn't happen, but who knows) are matched in list order.
+    Runs in linear time."""
+
+    old_by_key = collections.defaultdict(collections.deque)
+    for channel in old:
+        old_by_key[channel.key].append(channel)
+
+    changes = []
+    for channel in new:
+        old_channels = old_by_key.get(channel.key)
+        if not old_channels:
+            changes.append(('added', None, channel))
+            continue
+        old_channel = old_channels.popleft()
+        if old_channel.dispno != channel.dispno:
+            changes.append(('renumbered', old_channel, channel))
+        if old_channel.title != channel.title:
+            changes.append(('renamed', old_channel, channel))
+
+    removed = set(id(channel) for channels in old_by_key.itervalues() for channel in channels)
+    changes.extend(('removed', channel, None) for channel in old if id(channel) in removed)
+    return changes
+
+
+def print_diff(old, new):
+    """Prints the differences between the lists of Channels 'old' and 'new', as text or, if
+    opts['diff_json'] is set, as a JSON change feed with one change per line."""
+
+    changes = diff_channel_lists(old, new)
+    counts = collections.Counter(change for change, old_, new_ in changes)
+    LOG.info('%d added, %d removed, %d renumbered, %d renamed', counts['added'],
+             counts['removed'], counts['renumbered'], counts['renamed'])
+
+    for change, old_channel, new_channel in changes:
+        if opts['diff_json']:
+            fields = (old_channel or new_channel).as_dict()
+            print json.dumps({
+                'change': change,
+                'key'   : dict((field, fields[field]) for field in CHANNEL_KEY_FIELDS),
+                'old'   : old_channel.as_dict() if old_channel else None,
+                'new'   : new_channel.as_dict() if new_channel else None,
+            }, sort_keys=True)
+        elif change == 'added':
+            print u'+ %s' % new_channel.display_string()
+        elif change == 'removed':
+            print u'- %s' % old_channel.display_string()
+        elif change == 'renumbered':
+            print u'~ [%s] % 4s -> %s %s' % (new_channel.ch_type, old_channel.dispno,
+                                             new_channel.dispno, new_channel.title)
+        else:
+            print u'~ [%s] % 4s %s -> %s' % (new_channel.ch_type, new_channel.dispno,
+                                            old_channel.title, new_channel.title)
 
-    Next: set_channel_returned, passing a list of fallback channel types and everything
-    needed to reproduce the call to SetMainTVChannel for the fallback channel lists."""
 
-    LOG.debug('got_channel_list: fetched %d bytes', len(channel_list))
+def load_channel_list_file(path):
+    """Reads and parses the raw channel list in the file 'path'. Returns the list of Channels,
+    or None after calling fatal if that fails."""
+
     try:
-        all_channels = _parse_channel_list(channel_list)
-    except Exception, e:
-        fatal('Unable to parse channel list', e)
-        return
+        with open(path, 'rb') as f:
+            return _parse_channel_list(f.read())
+    except IOError as e:
+        fatal('Unable to read channel list %s' % path, e)
+    except ParseException as pe:
+        fatal('Unable to parse channel list %s' % path, pe)
+    return None
+
+
+def _normalize_title(title):
+    """Returns 'title' lower-cased, with diacritics and punctuation removed and whitespace
+    collapsed, for case- and accent-insensitive title matching."""
+
+    title = unicodedata.normalize('NFKD', title)
+    title = u''.join(c for c in title if not unicodedata.combining(c))
+    return u' '.join(re.findall(r'\w+', title.lower(), re.UNICODE))
+
+
+def _trigrams(normalized_title):
+    """Returns the set of trigrams of a normalized title. It's padded so that even one- and
+    two-character titles have trigrams, and so that the start of the title has more weight,
+    which favours prefix matches."""
+
+    padded = u'  %s ' % normalized_title
+    return set(padded[i:i+3] for i in xrange(len(padded)-2))
+
+
+class ChannelIndex(object):
+    """Lookup indexes over a parsed channel list, built once per list: a hash index on channel
+    type and display number, one on the normalized title and a trigram index for fuzzy
+    matching. Lookups only touch the channels sharing a key or (a rare enough) trigram with
+    the query, and at most MAX_CANDIDATES of them, so they don't get slower with longer
+    lists."""
+
+    # Queries like "CDTV 101" (or "CATV101") look up a channel by type and display number.
+    NUMBER_RE = re.compile(r'(C[AD]TV)\s*(\d+)')
+
+    # Minimum trigram similarity (0..1) for a fuzzy match.
+    MIN_SIMILARITY = 0.3
+
+    # How many channels a search looks up in the trigram index. The query's rarest trigrams
+    # go first, and common ones ("das", " hd") that no longer fit are skipped like stop words:
+    # they hardly tell titles apart, and walking all their channels would make searches as
+    # slow as the list is long. They still count towards the similarity of the candidates.
+    POSTINGS_BUDGET = 1000
+
+    # At most this many candidates, those sharing the most rare trigrams, are scored.
+    MAX_CANDIDATES = 50
+
+    def __init__(self, channels):
+        self._channels  = channels
+        self._by_number = collections.defaultdict(list)
+        self._by_title  = collections.defaultdict(list)
+        self._titles    = []
+        self._trigrams  = collections.defaultdict(list)
+        self._num_trigrams = []
+
+        for i, channel in enumerate(channels):
+            self._by_number[(channel.ch_type, channel.dispno.strip())].append(channel)
+
+            title = _normalize_title(channel.title)
+            self._by_title[title].append(channel)
+            self._titles.append(title)
+
+            trigrams = _trigrams(title)
+            self._num_trigrams.append(len(trigrams))
+            for trigram in trigrams:
+                self._trigrams[trigram].append(i)
+
+    def by_number(self, ch_type, dispno):
+        """Returns the list of channels of type 'ch_type' with display number 'dispno'."""
+
+        return list(self._by_number.get((ch_type, dispno), []))
+
+    def by_title(self, title):
+        """Returns the list of channels whose title matches 'title', ignoring case, diacritics
+        and punctuation. Channels with exactly 'title' as title come first."""
+
+        matches = self._by_title.get(_normalize_title(title), [])
+        return sorted(matches, key=lambda c: c.title != title)
+
+    def search(self, query, limit=10):
+        """Returns up to 'limit' (score, channel) tuples of channels whose title is similar to
+        'query', best match first. Exact title matches score 3, prefix matches 2 and up, and
+        everything else its trigram similarity (at least MIN_SIMILARITY)."""
+
+        normalized = _normalize_title(query)
+        query_trigrams = _trigrams(normalized)
+        if not normalized:
+            return []
+
+        # Count the rare trigrams each candidate shares with the query. If it only has common
+        # ones, the first channels with the rarest of them will have to do.
+        shared = collections.defaultdict(int)
+        budget = self.POSTINGS_BUDGET
+        for postings in sorted((self._trigrams.get(trigram, ()) for trigram in query_trigrams),
+                               key=len):
+            if len(postings) > budget:
+                if shared:
+                    break
+                postings = postings[:budget]
+            for i in postings:
+                shared[i] += 1
+            budget -= len(postings)
+        candidates = shared
+        if len(shared) > max(self.MAX_CANDIDATES, limit):
+            candidates = heapq.nlargest(max(self.MAX_CANDIDATES, limit), shared,
+                                        key=lambda i: (shared[i], -i))
+
+        results = []
+        for i in candidates:
+            title = self._titles[i]
+            # The trigrams of a title are the substrings of its padded form, see _trigrams.
+            padded = u'  %s ' % title
+            count = sum(1 for trigram in query_trigrams if trigram in padded)
+            similarity = float(count) / (len(query_trigrams) + self._num_trigrams[i] - count)
+            if title == normalized:
+                score = 3.0
+            elif title.startswith(normalized):
+                score = 2.0 + similarity
+            elif similarity >= self.MIN_SIMILARITY:
+                score = similarity
+            else:
+                continue
+            results.append((score, i))
 
-    if opts['do_list']:
-        for channel in all_channels:
-            print channel.display_string()
-        reactor.stop()
-        return
+        # Ties keep channel list order.
+        results.sort(key=lambda (score, i): (-score, i))
+        return [(score, self._channels[i]) for score, i in results[:limit]]
 
-    re_match = re.match(r'(C[AD]TV)\s*(\d+)', opts['channel'])
-    if re_match:
-        cmp_fn = lambda c: c.ch_type == re_match.group(1) and c.dispno.strip() == re_match.group(2)
-    else:
-        cmp_fn = lambda c: c.title == opts['channel']
-    matching_channels = [c for c in all_channels if cmp_fn(c)]
+    @classmethod
+    def matcher(cls, query):
+        """Returns a function telling whether a channel is the one lookup(query) would return
+        first, for looking at channels one by one before the whole list is there. Only works
+        for numbers and exact titles; it can't know about matches that need the other
+        channels."""
 
-    if len(matching_channels) == 0:
-        fatal('No channel found')
-        return
+        re_match = cls.NUMBER_RE.match(query)
+        if re_match:
+            key = (re_match.group(1), re_match.group(2))
+            return lambda channel: (channel.ch_type, channel.dispno.strip()) == key
+        return lambda channel: channel.title == query
 
-    if len(matching_channels) > 1:
-        logging.info("More than one matching channel found (%s), picking first", matching_channels)
-    channel     = matching_channels[0]
-    channel_xml = channel.as_xml
+    def lookup(self, query, fuzzy=True):
+        """Returns the list of channels matching 'query', best match first: the channels with
+        the given type and display number for "CDTV 101"-style queries, else those with a
+        matching title, else (if 'fuzzy' is true) the best fuzzy matches."""
 
-    set_main_tv_channel = service.get_action('SetMainTVChannel')
-    if not set_main_tv_channel:
-        # FIXME retry, uh?
-        fatal('Can\'t resolve SetMainTVChannel on TV, that\'s usually intermittent.')
-        return
+        re_match = self.NUMBER_RE.match(query)
+        if re_match:
+            return self.by_number(re_match.group(1), re_match.group(2))
 
-    LOG.debug('Calling SetMainTVChannel(ChannelListType=%r, SatelliteID=0, Channel=%r)',
-        cl_type, channel_xml)
+        matches = self.by_title(query)
+        if matches or not fuzzy:
+            return matches
 
-    set_main_tv_channel.call(ChannelListType=cl_type, SatelliteID=0, Channel=channel_xml).\
-        addCallback(set_channel_returned, set_main_tv_channel, CL_TYPE_FALLBACKS[:], channel).\
-        addErrback(fatal)
+        return [channel for score_, channel in self.search(query)]
 
 
-def got_channel_list_url(results, service):
-    """Called when GetChannelListURL returns. Gets the URL referenced from the channel list and
-    the channel list type. Next: got_channel_list(channel_list_type)."""
+class ChannelListCache(object):
+    """An on-disk cache of channel lists per TV and channel list type. For each list it keeps
+    the raw list, its SHA-1 and size, the HTTP validators (ETag and Last-Modified) the TV sent
+    and the parsed list, so an unchanged list neither has to be transferred nor re-parsed."""
 
-    LOG.debug('got_channel_list_url: %r', results)
+    # Bump when the pickled representation of the parsed list changes.
+    PICKLE_VERSION = 2
 
-    cl_type = results['ChannelListType']
-    url     = results['ChannelListURL']
+    def __init__(self, cache_dir):
+        self._dir = os.path.join(cache_dir, 'lists')
 
-    LOG.debug('Current cl_type is %s, URL is %s. Fetching URL.',
-        cl_type, url)
-    twisted.web.client.getPage(url).addCallback(got_channel_list, cl_type, service).\
-        addErrback(fatal)
+    def _path(self, udn, cl_type, ext):
+        safe_udn = re.sub(r'[^A-Za-z0-9._-]', '_', udn)
+        return os.path.join(self._dir, safe_udn, '%s.%s' % (cl_type, ext))
 
+    def get(self, udn, cl_type):
+        """Returns the metadata (a dict) of the cached list for 'udn' and 'cl_type', or None
+        if we don't have it."""
 
-def dev_found(retrier, device):
-    """Called when a device was found and calls GetChannelListURL if the device matches and has
-    the appropriate service. Next: got_channel_list_url(service)."""
+        try:
+            with open(self._path(udn, cl_type, 'json'), 'rb') as f:
+                return json.load(f)
+        except IOError:
+            return None
+        except ValueError as e:
+            LOG.warning('Ignoring corrupt channel list metadata for %s/%s: %s', udn, cl_type, e)
+            return None
+
+    def entries(self):
+        """Returns a list of (UDN, channel list type, metadata) tuples of all cached lists. The
+        UDN is the one used in file names for lists cached before we kept track of it."""
+
+        entries = []
+        try:
+            dirnames = sorted(os.listdir(self._dir))
+        except OSError:
+            return entries
+        for dirname in dirnames:
+            try:
+                filenames = sorted(os.listdir(os.path.join(self._dir, dirname)))
+            except OSError:
+                continue
+            for filename in filenames:
+                cl_type, ext = os.path.splitext(filename)
+                if ext != '.json':
+                    continue
+                entry = self.get(dirname, cl_type)
+                if entry:
+                    entries.append((entry.get('udn', dirname), cl_type, entry))
+        return entries
+
+    def latest(self):
+        """Returns the entries() tuple of the most recently validated cached list, or None if
+        there is none."""
+
+        entries = self.entries()
+        if not entries:
+            return None
+        return max(entries, key=lambda (udn_, cl_type_, entry): entry.get('validated', 0))
+
+    def age_s(self, udn, cl_type):
+        """Returns the number of seconds since the cached list for 'udn' and 'cl_type' has last
+        been validated against the TV, or None if we don't have it."""
+
+        entry = self.get(udn, cl_type)
+        if not entry:
+            return None
+        return time.time() - entry.get('validated', 0)
+
+    def load_raw(self, udn, cl_type):
+        """Returns the raw cached list for 'udn' and 'cl_type'."""
+
+        with open(self._path(udn, cl_type, 'dat'), 'rb') as f:
+            return f.read()
+
+    def load_channels(self, udn, cl_type, entry):
+        """Returns the parsed list of Channels for the cache entry 'entry'. Falls back to parsing
+        the cached raw list if the pickled one is unusable."""
 
-    LOG.debug('Discovered device %r', device)
-    if opts['devtype']:
-        if device.get_device_type() != opts['devtype']:
-            return
+        try:
+            with open(self._path(udn, cl_type, 'pickle'), 'rb') as f:
+                version, sha1, channels = pickle.load(f)
+            if version == self.PICKLE_VERSION and sha1 == entry['sha1']:
+                return channels
+            LOG.debug('Pickled channel list for %s/%s is outdated', udn, cl_type)
+        except Exception as e:  # pickle can raise about anything.
+            LOG.debug('Unable to load pickled channel list for %s/%s: %s', udn, cl_type, e)
+
+        channel_list = self.load_raw(udn, cl_type)
+        if hashlib.sha1(channel_list).hexdigest() != entry['sha1']:
+            raise ParseException('cached channel list does not match its hash',
+                                 ['%s/%s' % (udn, cl_type)])
+        channels = _parse_channel_list(channel_list)
+        self._store_channels(udn, cl_type, entry['sha1'], channels)
+        return channels
+
+    def _store_channels(self, udn, cl_type, sha1, channels):
+        _write_file_atomically(self._path(udn, cl_type, 'pickle'),
+                               pickle.dumps((self.PICKLE_VERSION, sha1, channels),
+                                            pickle.HIGHEST_PROTOCOL))
+
+    def put(self, udn, cl_type, channel_list, channels, etag, last_modified, validated=None):
+        """Stores the raw list 'channel_list', its parsed version 'channels' and the HTTP
+        validators for 'udn' and 'cl_type', validated at the timestamp 'validated' (or
+        now)."""
+
+        entry = {
+            'udn'          : udn,
+            'sha1'         : hashlib.sha1(channel_list).hexdigest(),
+            'size'         : len(channel_list),
+            'etag'         : etag,
+            'last_modified': last_modified,
+            'validated'    : time.time(),
+        }
+        try:
+            _write_file_atomically(self._path(udn, cl_type, 'dat'), channel_list)
+            self._store_channels(udn, cl_type, entry['sha1'], channels)
+            # Metadata goes last, so it never refers to data we haven't written.
+            self.touch(udn, cl_type, entry, validated=validated)
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to cache channel list for %s/%s: %s', udn, cl_type, e)
+        return entry
+
+    def touch(self, udn, cl_type, entry, etag=None, last_modified=None, validated=None):
+        """Marks the cache entry 'entry' as validated just now (or at the timestamp
+        'validated'), updating the HTTP validators if the TV sent new ones."""
+
+        entry['validated'] = validated or time.time()
+        if etag:
+            entry['etag'] = etag
+        if last_modified:
+            entry['last_modified'] = last_modified
+        try:
+            _write_file_atomically(self._path(udn, cl_type, 'json'),
+                                   json.dumps(entry, indent=2, sort_keys=True))
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to update channel list metadata for %s/%s: %s', udn, cl_type, e)
+
+
+class ChannelDB(object):
+    """A file holding the channel lists of any number of TVs in a form other processes can
+    mmap and query without parsing anything. All integers are little-endian unsigned:
+
+        File header:  8 bytes magic ('SSTCSDB' and a NUL), 4 bytes version, 4 bytes number of
+                      lists
+        List headers: One per list, see LIST_HEADER: UDN and channel list type (NUL-padded
+                      UTF-8), the TV's 4-byte channel list header, the SHA-1 of the channel
+                      list as the TV sent it, when it was last validated (a double), the
+                      number of channels, the file offsets of its records and its two lookup
+                      tables, and the number of slots in each table.
+        Records:      The channel list's raw 124-byte entries, see Channel.
+        Tables:       Open addressing hash tables (4-byte slots holding a record number + 1,
+                      0 for empty, linear probing, CRC-32 of the key modulo the number of
+                      slots, which is a power of two) for channel type and display number
+                      ('CDTV 101') and for the normalized title, see _normalize_title.
+
+    Lookups hash the query, probe the table and construct Channels straight on the mapped
+    records."""
+
+    MAGIC          = 'SSTCSDB\0'
+    VERSION        = 1
+    FILE_HEADER    = Struct('<8sII')
+    LIST_HEADER    = Struct('<128s16s4s20sdIIIII')
+    SLOT           = Struct('<I')
+
+    def __init__(self, path):
+        """Maps the database at 'path'. Raises an IOError if that fails and a ParseException
+        if it's not a channel database."""
+
+        with open(path, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError) as e:
+                raise ParseException('unable to map channel database %s: %s' % (path, e))
+
+        if len(self._map) < self.FILE_HEADER.size:
+            raise ParseException('channel database %s is truncated' % path)
+        magic, version, num_lists = self.FILE_HEADER.unpack_from(self._map)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ParseException('%s is not a channel database of version %d' %
+                                 (path, self.VERSION))
+
+        self._lists = collections.OrderedDict()
+        for i in xrange(num_lists):
+            fields = self.LIST_HEADER.unpack_from(
+                self._map, self.FILE_HEADER.size + i * self.LIST_HEADER.size)
+            udn, cl_type = fields[0].rstrip('\0').decode('utf-8'), fields[1].rstrip('\0')
+            count, records, slots = fields[5], fields[6], fields[9]
+            if (records + count * CHANNEL_ENTRY_SIZE > len(self._map) or
+                    any(table + slots * self.SLOT.size > len(self._map)
+                        for table in fields[7:9])):
+                raise ParseException('channel database %s is truncated' % path)
+            if not slots or slots & (slots - 1):
+                raise ParseException('channel database %s has tables of %d slots, which is no '
+                                     'power of two' % (path, slots))
+            self._lists[(udn, cl_type)] = fields[2:]
+
+    @staticmethod
+    def _number_key(ch_type, dispno):
+        return '%s %s' % (ch_type, dispno)
+
+    @staticmethod
+    def _title_key(title):
+        return _normalize_title(title).encode('utf-8')
+
+    @staticmethod
+    def _table(keys):
+        slots = 8
+        while slots < 2 * len(keys):
+            slots *= 2
+        table = array('I', [0]) * slots
+        for i, key in enumerate(keys):
+            slot = zlib.crc32(key) & (slots - 1)
+            while table[slot]:
+                slot = (slot + 1) & (slots - 1)
+            table[slot] = i + 1
+        if sys.byteorder != 'little':
+            table.byteswap()
+        return table.tostring()
+
+    @classmethod
+    def export(cls, path, lists):
+        """Writes the database 'path'. 'lists' is a list of (UDN, channel list type, raw
+        channel list, validation timestamp) tuples."""
+
+        headers = []
+        data    = []
+        offset  = cls.FILE_HEADER.size + len(lists) * cls.LIST_HEADER.size
+        for udn, cl_type, channel_list, validated in lists:
+            channels = _parse_channel_list(channel_list)
+            records = channel_list[CHANNEL_LIST_HEADER.size:]
+            number_table = cls._table([cls._number_key(c.ch_type, c.dispno.strip())
+                                       for c in channels])
+            title_table  = cls._table([cls._title_key(c.title) for c in channels])
+
+            headers.append(cls.LIST_HEADER.pack(
+                udn.encode('utf-8'), cl_type, channel_list[:CHANNEL_LIST_HEADER.size],
+                hashlib.sha1(channel_list).digest(), validated or 0, len(channels), offset,
+                offset + len(records), offset + len(records) + len(number_table),
+                len(number_table) / cls.SLOT.size))
+            data += [records, number_table, title_table]
+            offset += len(records) + len(number_table) + len(title_table)
+
+        _write_file_atomically(path, cls.FILE_HEADER.pack(cls.MAGIC, cls.VERSION, len(lists)) +
+                               ''.join(headers) + ''.join(data))
+
+    def lists(self):
+        """Returns a list of (UDN, channel list type, number of channels) tuples of the lists
+        in the database."""
+
+        return [(udn, cl_type, fields[3])
+                for (udn, cl_type), fields in self._lists.iteritems()]
+
+    def channel_list(self, udn, cl_type):
+        """Returns a tuple of the raw channel list (as the TV sent it) of 'udn' and 'cl_type'
+        and when it was validated."""
+
+        header, sha1_, validated, count, records, _, _, _ = self._lists[(udn, cl_type)]
+        return header + self._map[records:records + count * CHANNEL_ENTRY_SIZE], validated
+
+    def channels(self, udn, cl_type):
+        """Returns the list of Channels of 'udn' and 'cl_type'. They are views on the mapped
+        file, so this doesn't parse anything."""
+
+        count, records = self._lists[(udn, cl_type)][3:5]
+        return [Channel(self._map, records + i * CHANNEL_ENTRY_SIZE) for i in xrange(count)]
+
+    def _probe(self, udn, cl_type, table_index, key, matches):
+        fields = self._lists[(udn, cl_type)]
+        count, records, table, slots = fields[3], fields[4], fields[5 + table_index], fields[7]
+
+        found = []
+        slot = zlib.crc32(key) & (slots - 1)
+        # A table always has empty slots, unless the file is corrupt.
+        for _ in xrange(slots):
+            i, = self.SLOT.unpack_from(self._map, table + slot * self.SLOT.size)
+            if not i:
+                break
+            if i > count:
+                raise ParseException('channel database table of %s/%s refers to record %d of '
+                                     '%d' % (udn, cl_type, i, count))
+            channel = Channel(self._map, records + (i - 1) * CHANNEL_ENTRY_SIZE)
+            if matches(channel):
+                found.append((i, channel))
+            slot = (slot + 1) & (slots - 1)
+        else:
+            raise ParseException('channel database table of %s/%s has no empty slot' %
+                                 (udn, cl_type))
+        return [channel for i_, channel in sorted(found)]
+
+    def lookup(self, query):
+        """Returns a list of (UDN, channel list type, Channel) tuples of the channels matching
+        'query' in all lists, like ChannelIndex.lookup without fuzzy matching does."""
+
+        re_match = ChannelIndex.NUMBER_RE.match(query)
+        results = []
+        for udn, cl_type in self._lists:
+            if re_match:
+                key = (re_match.group(1), re_match.group(2))
+                matches = self._probe(udn, cl_type, 0, self._number_key(*key),
+                                      lambda c: (c.ch_type, c.dispno.strip()) == key)
+            else:
+                key = self._title_key(query)
+                matches = self._probe(udn, cl_type, 1, key,
+                                      lambda c: self._title_key(c.title) == key)
+                matches.sort(key=lambda c: c.title != query)
+            results.extend((udn, cl_type, channel) for channel in matches)
+        return results
 
-    services = [s for s in device.services if s.get_id() ==
-                'urn:samsung.com:serviceId:MainTVAgent2']
 
-    if not services:
-        return
-    if len(services) > 1:
-        fatal('Your TV reports back more than one service, can\'t handle that',
-              [device, services])
-        return
+def run_db():
+    """Exports the channel list cache to the channel database opts['export_db'], imports the
+    database opts['import_db'] into the cache, or lists or looks up channels in the database
+    opts['db'], see ChannelDB."""
 
-    svc = services[0]
-    LOG.debug('Found matching service %r', svc)
-    retrier.cancel()
+    cache = ChannelListCache(opts['cache_dir'])
+    try:
+        if opts['export_db']:
+            lists = []
+            for udn, cl_type, entry in cache.entries():
+                lists.append((udn, cl_type, cache.load_raw(udn, cl_type),
+                              entry.get('validated')))
+            ChannelDB.export(opts['export_db'], lists)
+            LOG.info('Exported %d channel lists to %s', len(lists), opts['export_db'])
+            return
 
-    get_channel_list_url = svc.get_action('GetChannelListURL')
-    if not get_channel_list_url:
-        # FIXME retry
-        fatal('Can\'t resolve GetChannelListURL on TV, that\'s usually intermittent.')
+        db = ChannelDB(opts['import_db'] or opts['db'])
+        if opts['import_db']:
+            for udn, cl_type, count_ in db.lists():
+                channel_list, validated = db.channel_list(udn, cl_type)
+                cache.put(udn, cl_type, channel_list, _parse_channel_list(channel_list), None,
+                          None, validated)
+            LOG.info('Imported %d channel lists from %s', len(db.lists()), opts['import_db'])
+            return
+    except (IOError, OSError, ParseException) as e:
+        fatal('Unable to %s channel database %s' % ('export' if opts['export_db'] else 'read',
+                                                     opts['export_db'] or opts['import_db'] or
+                                                     opts['db']), e)
         return
 
-    # UPnP somehow maps action's return values to state variables. If Coherence knows
-    # of such a mapping, each value returned has to exist in that mapping. If not,
-    # Action.got_results will crash with an IndexError because of the faied lookup.
-    # As a workaround, pretend that there are no "out" arguments (with no related
-    # state variables to updates).
-    get_channel_list_url.arguments_list = get_channel_list_url.get_in_arguments()
+    if opts['do_list']:
+        for udn, cl_type, count_ in db.lists():
+            for channel in db.channels(udn, cl_type):
+                print u'%s %s %s' % (udn, cl_type, channel.display_string())
+    if opts['search']:
+        results = db.lookup(opts['search'])
+        if not results:
+            # No exact match, so it's worth building the fuzzy indexes.
+            for udn, cl_type, count_ in db.lists():
+                results.extend((udn, cl_type, channel) for score_, channel in
+                               ChannelIndex(db.channels(udn, cl_type)).search(opts['search']))
+        for udn, cl_type, channel in results:
+            print u'%s %s %s' % (udn, cl_type, channel.display_string())
+
+
+_HTTP_AGENT = None
+
+def http_agent():
+    """Returns the Agent all our HTTP requests (SOAP calls and fetching descriptions and channel
+    lists) go through. It keeps connections to the TV open between requests, so in batch mode
+    and in the daemon a step costs a single request instead of a new connection each time."""
+
+    global _HTTP_AGENT
+    if _HTTP_AGENT is None:
+        pool = twisted.web.client.HTTPConnectionPool(reactor, persistent=True)
+        _HTTP_AGENT = twisted.web.client.Agent(reactor, pool=pool)
+    return _HTTP_AGENT
+
+
+def http_request(method, url, headers=None, body=None):
+    """Sends an HTTP request with the headers 'headers' (a dict) and the body 'body' (a str
+    or None) via http_agent(). Returns a Deferred firing with a tuple of the response and its
+    body."""
+
+    producer = twisted.web.client.FileBodyProducer(BytesIO(body)) if body is not None else None
+    d = http_agent().request(method, url, Headers(dict((name, [value]) for name, value in
+                                                       (headers or {}).iteritems())), producer)
+    def _got_response(response):
+        return twisted.web.client.readBody(response).\
+            addCallback(lambda body: (response, body))
+    return d.addCallback(_got_response)
+
+
+def get_page(url):
+    """Like twisted.web.client.getPage, but via http_agent()."""
+
+    def _got_page((response, body)):
+        if response.code != 200:
+            raise twisted.web.error.Error(str(response.code), response.phrase)
+        return body
+    return http_request('GET', url).addCallback(_got_page)
+
+
+class ChannelListReceiver(object):
+    """Receives a channel list from an HTTP response body and parses it while it arrives, see
+    _parse_channel_list for the format. The header is checked as soon as it's there, against
+    the Content-Length 'length' if the TV sent one, and each entry is turned into a Channel
+    and passed to 'on_channel' as soon as it's complete. It's an IProtocol for
+    Response.deliverBody, but doesn't derive from Twisted's Protocol, so parsing doesn't
+    depend on Twisted being imported.
+
+    When the whole list has been received and checked, 'finished' fires with a tuple of the
+    list of Channels (None unless 'keep_channels') and the raw channel list (None unless
+    'keep_data'). Not keeping them keeps memory use flat, however long the list is.
+
+    Without Twisted, pass None as 'finished', and call feed() with each chunk of the body and
+    finish() at its end instead."""
+
+    def __init__(self, finished, on_channel=None, length=None, keep_channels=True,
+                 keep_data=False):
+        self._finished   = finished
+        self._on_channel = on_channel
+        self._length     = length
+        self._channels   = [] if keep_channels else None
+        self._data       = [] if keep_data else None
+        self._buffer     = ''
+        self._offset     = 0     # Offset of _buffer in the channel list.
+        self._expected   = None  # Channel count according to the header.
+        self._received   = 0
+        self._error      = None
+        self.transport   = None
+
+    def makeConnection(self, transport):
+        self.transport = transport
+
+    def dataReceived(self, data):
+        if self._error:
+            return
+        try:
+            self.feed(data)
+        except Exception:
+            self._error = Failure()
+            self.transport.stopProducing()
+
+    def feed(self, data):
+        """Parses the next chunk 'data' of the channel list. Raises a ParseException if it's
+        broken."""
+
+        if self._data is not None:
+            self._data.append(data)
+        self._parse(self._buffer + data)
+
+    def _check_header(self):
+        if self._expected == 0:
+            raise ParseException('channel list header says there are no channels')
+        if self._length is not None and self._length != 4 + self._expected * CHANNEL_ENTRY_SIZE:
+            raise ParseException(('Content-Length (%d) does not match the channel list length '\
+                                  'as defined in header (%d, so %d bytes)' % (self._length,
+                                  self._expected, 4 + self._expected * CHANNEL_ENTRY_SIZE)))
+
+    def _parse(self, buf):
+        pos = 0
+        if self._expected is None:
+            if len(buf) < CHANNEL_LIST_HEADER.size:
+                self._buffer = buf
+                return
+            self._expected, = CHANNEL_LIST_HEADER.unpack_from(buf)
+            self._check_header()
+            pos = CHANNEL_LIST_HEADER.size
+
+        # Channels are views on 'buf' (see Channel), so each chunk is only kept around as long
+        # as channels in it are.
+        last = len(buf) - CHANNEL_ENTRY_SIZE
+        while pos <= last:
+            if self._received == self._expected:
+                raise ParseException(('channel list is longer than the %d channels defined in '\
+                                      'header' % self._expected))
+            try:
+                channel = Channel(buf, pos)
+            except ParseException as pe:
+                pe.add_context('chunk starting at %d: %s' %
+                               (self._offset + pos, repr(buf[pos:pos+CHANNEL_ENTRY_SIZE])))
+                raise pe
+            self._received += 1
+            if self._channels is not None:
+                self._channels.append(channel)
+            if self._on_channel:
+                self._on_channel(channel)
+            pos += CHANNEL_ENTRY_SIZE
+
+        self._buffer = buf[pos:]
+        self._offset += pos
+
+    def connectionLost(self, reason):
+        if self._finished.called:
+            return  # Cancelled, see _request_channel_list.
+        if self._error:
+            self._finished.errback(self._error)
+            return
+        if not reason.check(twisted.web.client.ResponseDone):
+            self._finished.errback(reason)
+            return
 
-    LOG.debug('Calling GetChannelListURL')
-    get_channel_list_url.call().addCallback(got_channel_list_url, svc).\
-        addErrback(fatal)
+        try:
+            result = self.finish()
+        except ParseException:
+            self._finished.errback()
+            return
+        self._finished.callback(result)
+
+    def finish(self):
+        """Checks the channel list is complete now that it has ended and returns the tuple
+        'finished' fires with. Raises a ParseException if it isn't."""
+
+        if self._expected is None or self._buffer or self._received != self._expected:
+            raise ParseException(
+                ('channel list ended after %d bytes, expected %d channels and got %d' %
+                 (self._offset + len(self._buffer), self._expected or 0, self._received)),
+                ('Trailing data: %s' % repr(self._buffer),))
+
+        LOG.debug('Parsed %d channels', self._received)
+        TIMINGS.set('channels', self._received)
+        return self._channels, ''.join(self._data) if self._data is not None else None
+
+
+def _request_channel_list(url, headers, on_channel=None, keep_channels=True, keep_data=False):
+    """GETs the channel list at 'url', sending 'headers' (a dict), and parses it while it
+    downloads, see ChannelListReceiver for the other arguments. Returns a Deferred firing with
+    a tuple of the list of Channels, the raw channel list and the response headers (a dict of
+    lower-cased header names to lists of values). A '304 Not Modified' response fires with
+    (None, None, headers)."""
+
+    first_channel = TIMINGS.span('first_channel')
+    def _on_channel(channel):
+        first_channel.finish()
+        if on_channel:
+            on_channel(channel)
+
+    def _got_response(response):
+        response_headers = dict((name.lower(), values)
+                                for name, values in response.headers.getAllRawHeaders())
+        if response.code == 304:
+            return None, None, response_headers
+        if response.code != 200:
+            response.deliverBody(protocol.Protocol())  # Discard it.
+            raise twisted.web.error.Error(str(response.code), response.phrase)
+
+        # Cancelling (see call_with_policy) drops the connection, the rest of the list with it.
+        finished = defer.Deferred(lambda _: receiver.transport and
+                                  receiver.transport.stopProducing())
+        length = None if response.length == UNKNOWN_LENGTH else response.length
+        receiver = ChannelListReceiver(finished, _on_channel, length, keep_channels, keep_data)
+        response.deliverBody(receiver)
+        return finished.addCallback(lambda (channels, data): (channels, data, response_headers))
+
+    return http_agent().request('GET', url, Headers(dict((name, [value])
+                                                         for name, value in headers.iteritems()))).\
+        addCallback(_got_response)
+
+
+def _revalidation_latency_name((channels_, channel_list, response_headers_)):
+    """Returns the name to record the latency of a conditional GET of a channel list under.
+    A '304 Not Modified' takes milliseconds, so hedging downloads (which take seconds) by it
+    would download nearly every changed list twice."""
+
+    return 'fetch_channel_list_304' if channel_list is None else 'fetch_channel_list'
+
+def _check_channel_list_cache(cache, udn, cl_type, max_age_s):
+    """Looks up the list of type 'cl_type' of the TV 'udn' in the ChannelListCache 'cache'.
+    Returns a tuple of the cache entry (or None) and the headers (a dict) to revalidate it
+    with, which are None if the entry has been validated within 'max_age_s' seconds and can
+    be used as it is. See fetch_channel_list."""
+
+    entry = cache.get(udn, cl_type)
+    headers = {}
+    if entry:
+        age_s = time.time() - entry.get('validated', 0)
+        if age_s <= max_age_s:
+            LOG.debug('Using cached channel list for %s/%s, validated %.0f seconds ago', udn,
+                      cl_type, age_s)
+            TIMINGS.set('channel_list_cache', 'fresh')
+            return entry, None
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    return entry, headers
+
+def _update_channel_list_cache(cache, udn, cl_type, entry, channels, channel_list,
+                               response_headers):
+    """Updates the ChannelListCache 'cache' after fetching the list of type 'cl_type' of the
+    TV 'udn', whose cache entry was 'entry', with the request from _check_channel_list_cache.
+    'channels' and 'channel_list' are the parsed and raw list, or None if the TV answered
+    '304 Not Modified', and 'response_headers' maps lower-cased header names to lists of
+    values. Returns False if the cached list is to be used, True if the fetched one is."""
+
+    etag          = response_headers.get('etag', [None])[0]
+    last_modified = response_headers.get('last-modified', [None])[0]
+
+    if channel_list is None:
+        LOG.debug('Cached channel list for %s/%s is not modified', udn, cl_type)
+        TIMINGS.set('channel_list_cache', 'not_modified')
+        cache.touch(udn, cl_type, entry, etag, last_modified)
+        return False
+
+    LOG.debug('Fetched %d bytes', len(channel_list))
+    TIMINGS.set('bytes_fetched', len(channel_list))
+    if (entry and entry['size'] == len(channel_list) and
+            entry['sha1'] == hashlib.sha1(channel_list).hexdigest()):
+        LOG.debug('Fetched channel list for %s/%s is unchanged', udn, cl_type)
+        TIMINGS.set('channel_list_cache', 'unchanged')
+        cache.touch(udn, cl_type, entry, etag, last_modified)
+    else:
+        TIMINGS.set('channel_list_cache', 'changed' if entry else 'miss')
+        cache.put(udn, cl_type, channel_list, channels, etag, last_modified)
+    return True
+
+
+def fetch_channel_list(url, udn, cl_type, cache, max_age_s, on_channel=None,
+                       keep_channels=True):
+    """Fetches and parses the channel list at 'url', which is the list of type 'cl_type' of the
+    TV 'udn'. Returns a Deferred firing with the list of Channels, or None if 'keep_channels'
+    is false. If 'on_channel' isn't None, it's called with each Channel as soon as it's there,
+    which for a downloaded list is while the rest of it is still downloading.
+
+    If 'cache' (a ChannelListCache) isn't None, a cached list that has been validated within
+    'max_age_s' seconds is used without asking the TV at all. Otherwise, the list is
+    revalidated with a conditional request if the TV sent an ETag or Last-Modified header, or
+    else fetched and compared to the cached list by size and hash. Only changed lists are
+    stored again."""
+
+    def _from_cache(entry):
+        channels = cache.load_channels(udn, cl_type, entry)
+        if on_channel:
+            for channel in channels:
+                on_channel(channel)
+        return channels if keep_channels else None
+
+    hedged = HedgedChannels(on_channel)
+
+    if not cache:
+        def _fetched((channels, channel_list_, response_headers_)):
+            return channels
+        d = call_with_policy('fetch_channel_list', lambda: _request_channel_list(
+            url, {}, hedged.for_attempt(), keep_channels))
+        return TIMINGS.track(d, 'fetch_channel_list', cache='off').addCallback(_fetched)
+
+    entry, headers = _check_channel_list_cache(cache, udn, cl_type, max_age_s)
+    if headers is None:
+        return defer.maybeDeferred(_from_cache, entry)
+
+    def _fetched((channels, channel_list, response_headers)):
+        if not _update_channel_list_cache(cache, udn, cl_type, entry, channels, channel_list,
+                                          response_headers):
+            return _from_cache(entry)
+        return channels if keep_channels else None
+
+    # The cache needs the whole list anyway, so it's kept even if the caller doesn't want it.
+    d = call_with_policy('fetch_channel_list', lambda: _request_channel_list(
+        url, headers, hedged.for_attempt(), True, True), _revalidation_latency_name)
+    return TIMINGS.track(d, 'fetch_channel_list', cache='revalidate' if entry else 'miss').\
+        addCallback(_fetched)
+
+
+def load_channel_list(service, results, max_age_s):
+    """Fetches (or gets from the cache, see fetch_channel_list) the channel list referenced by
+    'results' of GetChannelListURL on 'service'. Returns a Deferred firing with a tuple of
+    the channel list type and the list of Channels."""
 
-def start():
-    """Starts up Coherence and sets everything up. Next: dev_found()"""
+    cl_type = results['ChannelListType']
+    cache   = ChannelListCache(opts['cache_dir']) if opts['use_cache'] else None
+    return fetch_channel_list(results['ChannelListURL'], service.udn, cl_type, cache,
+                              max_age_s).\
+        addCallback(lambda channels: (cl_type, channels))
 
-    def _log_handler(level, obj, category, file, line, msg, *args):
-        try:
-            log_level = COHERENCE_LOG_LEVEL_MAP[coherence_log.getLevelName(level)]
-        except KeyError:
-            log_level = 'NOTSET'
 
-        if category == 'coherence':
-            logger_name = 'coherence.main'
-        else:
-            logger_name = 'coherence.%s' % category
+def print_search_results(channels, query):
+    """Prints the channels in 'channels' best matching 'query' with their scores."""
 
-        l = logging.getLogger(logger_name)
-        l.log(log_level, msg, *args)
+    for score, channel in ChannelIndex(channels).search(query):
+        print u'%4.2f %s' % (score, channel.display_string())
 
-    coherence_log.addLogHandler(_log_handler)
-    try:
-        coherence_log.removeLimitedLogHandler(coherence_log.stderrHandler)
-    except ValueError:
-        pass
 
-    coherence = Coherence({'logmode': 'none'})
-    control_point = ControlPoint(coherence, auto_client=[])
+def run_offline():
+    """Lists, searches or diffs a channel list without talking to the TV (and without importing
+    Twisted or Coherence): the file passed with --channel-list, or else the cached list that
+    has been validated most recently."""
 
-    LOG.debug('Coherence initialized, waiting for devices to be discovered...')
+    if opts['channel']:
+        fatal('Can\'t switch channels offline, only -l and --search work.')
+        return
 
-    def _retry(retrier, handler):
-        LOG.debug('TV not yet discovered, retrying discovery...')
-        coherence.msearch.double_discover()
-        reactor.callLater(retrier.next_call_s, handler)
-    def _give_up(retrier):
-        fatal('Did not discover TV after %.1f seconds' % retrier.elapsed_s)
+    if opts['channel_list']:
+        channels = load_channel_list_file(opts['channel_list'])
+        if channels is None:
+            return
+    else:
+        cache  = ChannelListCache(opts['cache_dir'])
+        latest = cache.latest()
+        if not latest:
+            fatal('No cached channel list in %s, run without --offline once or use '
+                  '--channel-list.' % opts['cache_dir'])
+            return
+        udn, cl_type, entry = latest
+        LOG.debug('Using cached channel list for %s/%s, validated %.0f seconds ago', udn,
+                  cl_type, time.time() - entry.get('validated', 0))
+        try:
+            channels = cache.load_channels(udn, cl_type, entry)
+        except (IOError, ParseException) as e:
+            fatal('Unable to load cached channel list for %s/%s' % (udn, cl_type), e)
+            return
 
-    retrier = Retrier(_retry, _give_up, DEFAULT_RETRY_SPEC)
-    reactor.callLater(retrier.next_call_s, retrier.retrier)
+    if opts['do_list']:
+        for channel in channels:
+            print channel.display_string()
+    if opts['search']:
+        print_search_results(channels, opts['search'])
+    if opts['diff']:
+        old_channels = load_channel_list_file(opts['diff'])
+        if old_channels is not None:
+            print_diff(old_channels, channels)
 
-    def _dev_found(device):
-        dev_found(retrier, device)
-    control_point.connect(_dev_found, 'Coherence.UPnP.RootDevice.detection_completed')
 
-class PyWarningsFilter(logging.Filter):
-    """A filter for py.warnings which resolves the cause (module) of the
-    warning and checks their logger whether we should log."""
+def _verify_action(service):
+    """Returns the GetCurrentMainTVChannel action of 'service' if switches are to be verified,
+    see switch_channel, or else None."""
 
-    def __init__(self, *args, **kwargs):
-        self.module_names_cache = {}
-        super(PyWarningsFilter, self).__init__(*args, **kwargs)
+    return service.get_action('GetCurrentMainTVChannel') if opts['verify'] else None
 
-    def _module_name_from_filename(self, filename):
-        try:
-            return self.module_names_cache[filename]
-        except KeyError:
-            pass
+def switch_to(service, cl_type, channel):
+    """Switches the TV 'service' to 'channel' from its channel list of type 'cl_type'. Returns
+    the Deferred of switch_channel()."""
 
-        # we can't use os.path.realpath as it resolves symlinks, which we
-        # do not want, so normalize "as good as possible".
-        normalize = lambda path: os.path.normcase(os.path.normpath(path))
-        normalized_filename = normalize(filename)
-        for modpath in sorted(sys.path, key=lambda e: len(e), reverse=True):
-            normalized_modpath = normalize(modpath)+os.path.sep
-            if normalized_filename.startswith(normalized_modpath):
-                # we can safely strip at os.path.sep, normpath already replaced
-                # altsep with sep
-                rest = normalized_filename.replace(normalized_modpath, '', 1).split(os.path.sep)
-                # strip python extension from filename
-                rest[-1] = (os.path.splitext(rest[-1]))[0]
+    return switch_channel(service.get_action('SetMainTVChannel'), cl_type, channel, service.udn,
+                          _verify_action(service))
+
+
+def got_channel_list(all_channels, cl_type, service, refetch=None, switched=None):
+    """Called when the channel list has been retrieved and parsed. Looks for a matching channel
+    and calls SetMainTVChannel with the passed cl_type (channel list type), unless
+    opts['do_list'] or opts['search'] is set, in which case it just prints the matching
+    channels (or nothing, as the whole list has been printed while it was parsed) and
+    terminates Twisted.
+
+    If the list came from the channel list cache without asking the TV, 'refetch' is a function
+    to call without arguments to fetch the list again in case the channel isn't in it. If the
+    channel has been found and switched to while the list was downloading, 'switched' is the
+    Deferred of that switch.
+
+    With opts['diff'], the differences to that channel list are printed as well.
+
+    Next: switch_channel()"""
+
+    if switched:
+        switched.addCallbacks(lambda _: reactor.stop(), fatal_failure)
+        return
+
+    if opts['search']:
+        print_search_results(all_channels, opts['search'])
+
+    if opts['diff']:
+        old_channels = load_channel_list_file(opts['diff'])
+        if old_channels is None:
+            return
+        print_diff(old_channels, all_channels)
+
+    if opts['do_list'] or opts['search'] or opts['diff']:
+        reactor.stop()
+        return
+
+    # Don't settle for a fuzzy match if the list might just be outdated.
+    channel = _pick_channel(all_channels, opts['channel'], fuzzy=not refetch)
+
+    if channel is None:
+        if refetch:
+            LOG.info('No channel found in cached channel list, fetching it again')
+            refetch()
+            return
+        fatal('No channel found')
+        return
+
+    switch_to(service, cl_type, channel).addCallbacks(lambda _: reactor.stop(), fatal_failure)
+
+def _pick_channel(all_channels, query, fuzzy):
+    """Returns the Channel in 'all_channels' to switch to for 'query', or None if there is
+    none (see ChannelIndex.lookup for 'fuzzy')."""
+
+    matching_channels = ChannelIndex(all_channels).lookup(query, fuzzy=fuzzy)
+    if len(matching_channels) == 0:
+        return None
+
+    if len(matching_channels) > 1:
+        logging.info("More than one matching channel found (%s), picking first", matching_channels)
+    channel     = matching_channels[0]
+    if (not ChannelIndex.NUMBER_RE.match(query) and
+            _normalize_title(channel.title) != _normalize_title(query)):
+        LOG.info('No channel named %s, picking closest match %s', query,
+                 channel.display_string())
+    return channel
+
+
+def got_channel_list_url(results, service):
+    """Called when GetChannelListURL returns. Gets the URL referenced from the channel list and
+    the channel list type. Next: got_channel_list(channel_list_type)."""
+
+    LOG.debug('got_channel_list_url: %r', results)
+
+    cl_type = results['ChannelListType']
+    url     = results['ChannelListURL']
+
+    LOG.debug('Current cl_type is %s, URL is %s. Fetching URL.',
+        cl_type, url)
+
+    udn   = service.udn
+    cache = ChannelListCache(opts['cache_dir']) if opts['use_cache'] else None
+
+    def _fetch_failed(failure):
+        if failure.check(ParseException):
+            fatal('Unable to parse channel list', failure)
+        else:
+            fatal('Unable to fetch channel list', failure)
+
+    switch_now = not opts['do_list'] and not opts['search'] and not opts['diff'] and \
+        ChannelIndex.matcher(opts['channel'])
+
+    def _fetch(max_age_s):
+        refetch = None
+        if cache:
+            age_s = cache.age_s(udn, cl_type)
+            if age_s is not None and age_s <= max_age_s:
+                refetch = lambda: _fetch(-1)
+
+        # Print the list as it comes in, and switch as soon as the channel is there if it's
+        # an exact match, instead of waiting for the rest of the list.
+        state = {}
+        def _on_channel(channel):
+            if opts['do_list']:
+                print channel.display_string()
+            elif switch_now and 'switched' not in state and switch_now(channel):
+                LOG.debug('Found %s, switching while the channel list is still loading',
+                          channel.display_string())
+                state['switched'] = switch_to(service, cl_type, channel)
+
+        def _failed(failure):
+            if 'switched' not in state:
+                return _fetch_failed(failure)
+            # The switch doesn't need the rest of the list, so it decides how we exit.
+            LOG.warning('Unable to load the rest of the channel list: %s',
+                        failure.getErrorMessage())
+            return got_channel_list(None, cl_type, service, None, state['switched'])
+
+        fetch_channel_list(url, udn, cl_type, cache, max_age_s,
+                           _on_channel if opts['do_list'] or switch_now else None,
+                           keep_channels=not opts['do_list'] or bool(opts['diff'])).\
+            addCallbacks(lambda channels: got_channel_list(channels, cl_type, service, refetch,
+                                                           state.get('switched')),
+                         _failed).\
+            addErrback(fatal)
+
+    _fetch(opts['list_max_age_s'])
+
+
+class DeviceCache(object):
+    """An on-disk cache of TVs we've discovered before, so a run can talk to the TV right
+    away instead of waiting for SSDP. It's a JSON file mapping the device type we looked for
+    to the TV's UDN, description location, MainTVAgent2 service type, control, service
+    description and event subscription URLs, and when we've last seen it."""
+
+    FILENAME = 'devices.json'
+
+    def __init__(self, cache_dir, ttl_s):
+        """Initialize the DeviceCache.
+
+        Args:
+            cache_dir: Directory to keep the cache file in.
+            ttl_s: Number of seconds after which a cache entry is considered stale."""
+
+        self._path  = os.path.join(cache_dir, self.FILENAME)
+        self._ttl_s = ttl_s
+
+    @staticmethod
+    def _key(devtype):
+        # devtype can be empty if the user asked for any device type.
+        return devtype or '*'
+
+    def _load(self):
+        try:
+            with open(self._path, 'rb') as f:
+                entries = json.load(f)
+        except IOError:
+            return {}
+        except ValueError as e:
+            LOG.warning('Ignoring corrupt device cache %s: %s', self._path, e)
+            return {}
+
+        if not isinstance(entries, dict):
+            LOG.warning('Ignoring device cache %s with unexpected contents', self._path)
+            return {}
+        return entries
+
+    def _store(self, entries):
+        try:
+            _write_file_atomically(self._path, json.dumps(entries, indent=2, sort_keys=True))
+        except (IOError, OSError) as e:
+            # Not being able to cache is no reason to fail the channel switch.
+            LOG.warning('Unable to write device cache %s: %s', self._path, e)
+
+    def get(self, devtype):
+        """Returns the cache entry (a dict) for 'devtype', or None if there is none or it
+        has expired."""
+
+        entry = self._load().get(self._key(devtype))
+        if not entry:
+            LOG.debug('No cached device for %r', devtype)
+            return None
+
+        age_s = time.time() - entry.get('timestamp', 0)
+        if age_s > self._ttl_s:
+            LOG.debug('Cached device %s is %.0f seconds old, ignoring it', entry.get('udn'),
+                      age_s)
+            return None
+
+        return entry
+
+    def addresses(self):
+        """Returns the addresses of all TVs we've seen, most recently seen first, including
+        those whose entries have expired."""
+
+        entries = sorted(self._load().itervalues(), key=lambda e: -e.get('timestamp', 0))
+        addresses = []
+        for entry in entries:
+            address = urlparse.urlsplit(entry.get('location') or '').hostname
+            if address and address not in addresses:
+                addresses.append(address)
+        return addresses
+
+    def put(self, devtype, udn, location, service_type, control_url, scpd_url, event_sub_url):
+        """Remembers a TV with a MainTVAgent2 service for 'devtype'."""
+
+        entries = self._load()
+        entries[self._key(devtype)] = {
+            'udn'          : udn,
+            'location'     : location,
+            'service_type' : service_type,
+            'control_url'  : control_url,
+            'scpd_url'     : scpd_url,
+            'event_sub_url': event_sub_url,
+            'timestamp'    : time.time(),
+        }
+        LOG.debug('Caching device %s (control URL %s)', udn, control_url)
+        self._store(entries)
+
+    def invalidate(self, devtype=None):
+        """Forgets the cached TV for 'devtype', or all cached TVs if devtype is None."""
+
+        if devtype is None:
+            entries = {}
+        else:
+            entries = self._load()
+            if entries.pop(self._key(devtype), None) is None:
+                return
+        LOG.debug('Invalidating device cache for %s', 'all devices' if devtype is None else
+                  repr(devtype))
+        self._store(entries)
+
+
+class ServiceDescriptionCache(object):
+    """An on-disk cache of the actions in the service descriptions (SCPDs) of TVs we've
+    talked to, so we don't have to fetch and parse them again. It's a JSON file mapping UDN
+    and service type to the actions' in arguments (see ActionTable.actions). An entry is
+    dropped when the TV rejects an action, which is what happens after a firmware update
+    changed the service."""
+
+    FILENAME = 'services.json'
+
+    def __init__(self, cache_dir):
+        self._path = os.path.join(cache_dir, self.FILENAME)
+
+    @staticmethod
+    def _key(udn, service_type):
+        return '%s %s' % (udn, service_type)
+
+    def _load(self):
+        try:
+            with open(self._path, 'rb') as f:
+                entries = json.load(f)
+        except IOError:
+            return {}
+        except ValueError as e:
+            LOG.warning('Ignoring corrupt service description cache %s: %s', self._path, e)
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _store(self, entries):
+        try:
+            _write_file_atomically(self._path, json.dumps(entries, indent=2, sort_keys=True))
+        except (IOError, OSError) as e:
+            LOG.warning('Unable to write service description cache %s: %s', self._path, e)
+
+    def get(self, udn, service_type):
+        """Returns the cached actions of 'service_type' on the TV 'udn' as a dict of action
+        name -> tuple of in argument names, or None."""
+
+        entry = self._load().get(self._key(udn, service_type))
+        if not entry:
+            return None
+        return dict((name, tuple(arguments))
+                    for name, arguments in entry.get('actions', {}).iteritems())
+
+    def put(self, udn, service_type, actions):
+        entries = self._load()
+        entries[self._key(udn, service_type)] = {
+            'actions'  : dict((name, list(arguments)) for name, arguments in actions.iteritems()),
+            'timestamp': time.time(),
+        }
+        self._store(entries)
+
+    def invalidate(self, udn, service_type):
+        entries = self._load()
+        if entries.pop(self._key(udn, service_type), None) is not None:
+            LOG.debug('Invalidating cached service description of %s', udn)
+            self._store(entries)
+
+
+# An action, ready to be called: its in arguments in order, the SOAPACTION header and the
+# SOAP envelope up to and after the arguments.
+ActionSpec = collections.namedtuple('ActionSpec', 'name arguments soap_action head tail')
+
+class ActionTable(object):
+    """The actions of a service, precomputed so that calling one only means filling in its
+    arguments. Built from a service description or from MAIN_TV_AGENT_ACTIONS."""
+
+    def __init__(self, service_type, actions):
+        """Initialize the ActionTable.
+
+        Args:
+            service_type: The UPnP service type, e.g. urn:samsung.com:service:MainTVAgent2:1
+            actions: dict of action name -> tuple of the names of its in arguments."""
+
+        self.service_type = service_type
+        self.actions      = actions
+        self._specs       = {}
+        for name, arguments in actions.iteritems():
+            head = ('<?xml version="1.0" encoding="utf-8"?>'
+                    '<s:Envelope xmlns:s="%s" '
+                    's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+                    '<u:%s xmlns:u="%s">') % (SOAP_ENVELOPE_NS, name, escape(service_type))
+            tail = '</u:%s></s:Body></s:Envelope>' % name
+            self._specs[name] = ActionSpec(name, arguments, '"%s#%s"' % (service_type, name),
+                                           head, tail)
+
+    def get(self, name):
+        """Returns the ActionSpec for the action 'name', or None if there's no such action."""
+        return self._specs.get(name)
+
+
+def _parse_soap_response(name, service_type, code, phrase, body):
+    """Returns the out arguments in the response to the action 'name' of 'service_type' as
+    a dict, given the response's HTTP status 'code' and 'phrase' and its 'body'. Raises an
+    ActionException for SOAP faults and responses we can't make sense of."""
+
+    try:
+        root = ElementTree.fromstring(body)
+    except SyntaxError as e:
+        raise ActionException('%s failed: invalid SOAP response (%s)' % (name, e),
+                              ['HTTP status %d' % code])
+
+    if code != 200:
+        # A SOAP fault, hopefully with a UPnP error in it.
+        description = root.findtext('.//{%s}errorDescription' % UPNP_CONTROL_NS) or \
+            root.findtext('.//faultstring') or phrase
+        raise ActionException('%s failed: %s' % (name, description), ['HTTP status %d' % code],
+                              root.findtext('.//{%s}errorCode' % UPNP_CONTROL_NS))
+
+    result = root.find('{%s}Body/{%s}%sResponse' % (SOAP_ENVELOPE_NS, service_type, name))
+    if result is None:
+        raise ActionException('%s failed: SOAP response without %sResponse' % (name, name),
+                              ['HTTP status %d' % code])
+    return dict((argument.tag, argument.text or '') for argument in result)
+
+
+class DirectAction(object):
+    """Stand-in for Coherence's Action that calls an action on a DirectService with a SOAP
+    request via http_agent(). If the service's ActionTable doesn't know the action, or the TV
+    rejects the call as an invalid action, the service is resolved again (see
+    DirectService.resolve) and the call is retried once."""
+
+    def __init__(self, service, name):
+        self._service = service
+        self._name    = name
+
+    @staticmethod
+    def _envelope(spec, arguments):
+        unknown = set(arguments) - set(spec.arguments)
+        if unknown:
+            raise ActionException('%s has no argument(s) %s' % (spec.name,
+                                                                ', '.join(sorted(unknown))),
+                                  error_code='402')
+        return ''.join([spec.head] +
+                       ['<%s>%s</%s>' % (name, escape(unicode(arguments[name])).encode('utf-8'),
+                                         name)
+                        for name in spec.arguments if name in arguments] +
+                       [spec.tail])
+
+    def _got_response(self, (response, body)):
+        return _parse_soap_response(self._name, self._service.service_type, response.code,
+                                    response.phrase, body)
+
+    def _call(self, kwargs):
+        spec = self._service.actions.get(self._name)
+        if spec is None:
+            return defer.fail(ActionException('TV doesn\'t have action %s' % self._name,
+                                              error_code='401'))
+        try:
+            body = self._envelope(spec, kwargs)
+        except ActionException:
+            return defer.fail()
+
+        headers = {
+            'Content-Type': 'text/xml; charset="utf-8"',
+            'SOAPACTION'  : spec.soap_action,
+        }
+        return http_request('POST', self._service.control_url, headers, body).\
+            addCallback(self._got_response)
+
+    def call(self, **kwargs):
+        """Calls the action with 'kwargs' as arguments and returns a Deferred firing with a
+        dict of the action's out arguments, just like Coherence's Action.call does."""
+
+        def _invalid_action(failure):
+            failure.trap(ActionException)
+            if failure.value.error_code not in UPNP_INVALID_ACTION_ERRORS:
+                return failure
+            LOG.info('%s: %s, resolving the service again', self._service.udn,
+                     failure.getErrorMessage())
+            return self._service.resolve().addCallback(lambda _: self._call(kwargs))
+
+        return self._call(kwargs).addErrback(_invalid_action)
+
+
+class DirectService(object):
+    """Stand-in for Coherence's Service that talks to a known control URL directly, through
+    http_agent(), so we can skip discovery and reuse connections. Discovered services are
+    turned into DirectServices as well. Only implements what we actually use of Service.
+
+    Its actions come from the ServiceDescriptionCache or, for a TV we haven't seen yet, from
+    MAIN_TV_AGENT_ACTIONS, so they're available right away. The service description at
+    'scpd_url' is only fetched by resolve(), when an action turns out to be missing."""
+
+    def __init__(self, udn, service_type, control_url, scpd_url=None, event_sub_url=None):
+        self.udn           = udn
+        self.service_type  = service_type
+        self.control_url   = control_url
+        self.scpd_url      = scpd_url
+        self.event_sub_url = event_sub_url
+        self._resolving    = None
+
+        self._cache = ServiceDescriptionCache(opts['cache_dir']) if opts['use_cache'] else None
+        actions = self._cache and self._cache.get(udn, service_type)
+        if actions:
+            LOG.debug('Using cached service description of %s', udn)
+        # Whether the actions come from the TV's service description rather than from
+        # MAIN_TV_AGENT_ACTIONS.
+        self.described = bool(actions)
+        self.actions   = ActionTable(service_type, actions or MAIN_TV_AGENT_ACTIONS)
+
+    def set_scpd(self, scpd):
+        """Builds the service's ActionTable from the service description 'scpd' and caches
+        it. Raises a DiscoveryException if the TV lacks any of REQUIRED_ACTIONS."""
+
+        actions = _parse_scpd_actions(scpd)
+        missing = set(REQUIRED_ACTIONS) - set(actions)
+        if missing:
+            raise DiscoveryException('TV doesn\'t have action(s) %s' % ', '.join(sorted(missing)),
+                                     [repr(self)])
+
+        self.actions   = ActionTable(self.service_type, actions)
+        self.described = True
+        if self._cache:
+            self._cache.put(self.udn, self.service_type, actions)
+
+    def resolve(self):
+        """Fetches the service description again and rebuilds the ActionTable from it.
+        Returns a Deferred firing when that's done; concurrent calls share it."""
+
+        if self._resolving is not None:
+            d = defer.Deferred()
+            self._resolving.append(d)
+            return d
+
+        if self._cache:
+            self._cache.invalidate(self.udn, self.service_type)
+        if not self.scpd_url:
+            return defer.fail(DiscoveryException('Can\'t resolve the actions of %r without its '
+                                                 'service description URL' % self))
+
+        self._resolving = []
+        def _done(result):
+            waiters, self._resolving = self._resolving, None
+            for d in waiters:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+            return result
+
+        LOG.debug('Fetching service description for %r from %s', self, self.scpd_url)
+        return call_with_policy('get_description', lambda: get_page(self.scpd_url)).\
+            addCallback(self.set_scpd).addBoth(_done)
+
+    def get_id(self):
+        return MAIN_TV_AGENT_SERVICE_ID
+
+    def get_action(self, name):
+        return DirectAction(self, name)
+
+    def __repr__(self):
+        return '<DirectService %s at %s>' % (self.udn, self.control_url)
+
+
+def _parse_property_set(body):
+    """Returns the state variables in the GENA event 'body' as a dict of name -> value.
+    Raises a ParseException if it isn't a property set."""
+
+    try:
+        root = ElementTree.fromstring(body)
+    except SyntaxError as e:
+        raise ParseException('Unable to parse event: %s' % e)
+    if root.tag != '{%s}propertyset' % UPNP_EVENT_NS:
+        raise ParseException('Event is no property set but %s' % root.tag)
+
+    values = {}
+    for prop in root.findall('{%s}property' % UPNP_EVENT_NS):
+        for variable in prop:
+            values[variable.tag.rpartition('}')[2]] = variable.text or ''
+    return values
+
+
+def _local_address_for(host):
+    """Returns our address on the way to 'host', for the TV to send events to."""
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Connecting a UDP socket only picks the route, nothing is sent.
+        sock.connect((host, SSDP_PORT))
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+
+class EventSubscription(object):
+    """A GENA subscription to the evented state variables of a DirectService, see UPnP Device
+    Architecture 1.0, 4. Listens for the TV's NOTIFY requests on opts['event_port'] and calls
+    'on_event' with a dict of state variable name -> value for each event, or with None if
+    events were missed. The first event after subscribing has the current values of all
+    evented variables.
+
+    The subscription is renewed halfway through its timeout. If the TV doesn't know it
+    anymore, we subscribe again right away; if that fails, every RETRY_S seconds."""
+
+    PATH      = '/sstcs/events'
+    TIMEOUT_S = 1800
+    RETRY_S   = 30
+
+    # Event sequence numbers wrap around to 1 after this one.
+    MAX_SEQ = 0xffffffff
+
+    def __init__(self, service, on_event):
+        self._service  = service
+        self._on_event = on_event
+        self._port     = None
+        self._callback = None
+        self._sid      = None
+        self._seq      = None
+        self._call     = None
+        self._stopped  = False
+
+    def start(self):
+        """Starts listening for events and subscribes. Returns a Deferred firing once
+        subscribed."""
+
+        return defer.maybeDeferred(self._listen).addCallback(lambda _: self._subscribe())
+
+    def _listen(self):
+        from twisted.web.resource import Resource
+        from twisted.web.server import Site
+
+        subscription = self
+
+        class EventResource(Resource):
+            """Hands the TV's NOTIFY requests to the EventSubscription."""
+
+            isLeaf = True
+
+            def render_NOTIFY(self, request):
+                if request.path != subscription.PATH:
+                    request.setResponseCode(404)
+                else:
+                    request.setResponseCode(subscription.notify(
+                        request.getHeader('sid'), request.getHeader('seq'),
+                        request.content.read()))
+                return ''
+
+        self._port = reactor.listenTCP(opts['event_port'], Site(EventResource()))
+        host = _local_address_for(urlparse.urlsplit(self._service.event_sub_url).hostname)
+        self._callback = 'http://%s:%d%s' % (host, self._port.getHost().port, self.PATH)
+
+    def _subscribe(self):
+        """Subscribes, or renews the subscription if we have one. Returns a Deferred firing
+        when done."""
+
+        if self._sid:
+            LOG.debug('Renewing subscription %s to events of %r', self._sid, self._service)
+            headers = {'SID': self._sid}
+        else:
+            LOG.debug('Subscribing to events of %r for %s', self._service, self._callback)
+            headers = {'CALLBACK': '<%s>' % self._callback, 'NT': 'upnp:event'}
+        headers['TIMEOUT'] = 'Second-%d' % self.TIMEOUT_S
+        return call_with_policy('subscribe', lambda: http_request(
+            'SUBSCRIBE', self._service.event_sub_url, headers)).addCallback(self._subscribed)
+
+    def _subscribed(self, (response, body_)):
+        if response.code != 200:
+            raise EventException('SUBSCRIBE failed: %d %s' % (response.code, response.phrase),
+                                 [self._service.event_sub_url])
+        sid = (response.headers.getRawHeaders('sid') or [None])[0]
+        if not sid:
+            raise EventException('SUBSCRIBE answered without SID', [self._service.event_sub_url])
+
+        if self._stopped:
+            self._unsubscribe(sid)
+            return
+        if sid != self._sid:
+            LOG.info('Subscribed to events of TV %s', self._service.udn)
+            self._sid = sid
+            self._seq = None
+
+        timeout = (response.headers.getRawHeaders('timeout') or [''])[0]
+        try:
+            timeout_s = int(timeout.partition('-')[2])
+        except ValueError:
+            # 'infinite', or something we don't understand.
+            timeout_s = self.TIMEOUT_S
+        self._schedule(max(timeout_s / 2.0, 1))
+
+    def _schedule(self, delay_s):
+        if not self._stopped:
+            self._call = reactor.callLater(delay_s, self._renew)
+
+    def _renew(self):
+        self._call = None
+        renewing = self._sid is not None
+
+        def _failed(failure):
+            if self._stopped:
+                return
+            self._sid = None
+            if renewing:
+                LOG.info('Unable to renew subscription to events of TV %s, subscribing again: '
+                         '%s', self._service.udn, failure.getErrorMessage())
+                self._renew()
+            else:
+                LOG.warning('Unable to subscribe to events of TV %s, retrying in %d seconds: %s',
+                            self._service.udn, self.RETRY_S, failure.getErrorMessage())
+                self._schedule(self.RETRY_S)
+        self._subscribe().addErrback(_failed)
+
+    def notify(self, sid, seq, body):
+        """Handles a NOTIFY request with the headers 'sid' and 'seq' and the body 'body'.
+        Returns the HTTP status code to answer with."""
+
+        # Until the TV answered our SUBSCRIBE we don't know the SID, but the first event may
+        # already be on its way.
+        if self._stopped or not sid or (self._sid and sid != self._sid):
+            return 412
+        try:
+            values = _parse_property_set(body)
+            seq = int(seq)
+        except (ParseException, TypeError, ValueError) as e:
+            LOG.warning('Ignoring invalid event from TV %s: %s', self._service.udn, e)
+            return 400
+
+        LOG.debug('Event %d from TV %s: %r', seq, self._service.udn, values)
+        expected = None if self._seq is None else self._seq % self.MAX_SEQ + 1
+        self._seq = seq
+        if expected is not None and seq != expected:
+            LOG.info('Expected event %d from TV %s, got %d', expected, self._service.udn, seq)
+            self._on_event(None)
+        self._on_event(values)
+        return 200
+
+    def _unsubscribe(self, sid):
+        return call_with_policy('unsubscribe', lambda: http_request(
+            'UNSUBSCRIBE', self._service.event_sub_url, {'SID': sid})).\
+            addErrback(lambda failure: LOG.debug('Unable to unsubscribe %s: %s', sid,
+                                                 failure.getErrorMessage()))
+
+    def stop(self):
+        """Cancels the subscription and stops listening for events. Returns a Deferred
+        firing once the TV has been told (or failed to answer)."""
+
+        self._stopped = True
+        d = defer.succeed(None)
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if self._sid:
+            d = self._unsubscribe(self._sid)
+            self._sid = None
+        if self._port is not None:
+            self._port.stopListening()
+            self._port = None
+        return d
+
+
+def call_get_channel_list_url(service):
+    """Calls GetChannelListURL on 'service'. Returns a Deferred firing with its results."""
+
+    LOG.debug('Calling GetChannelListURL')
+    action = service.get_action('GetChannelListURL')
+    return TIMINGS.track(call_with_policy('get_channel_list_url', action.call),
+                         'get_channel_list_url')
+
+
+def _main_tv_agent_service(device):
+    """Returns the MainTVAgent2 service of 'device' as a DirectService if it's a device we're
+    looking for, or None. Raises a DiscoveryException if the device has more than one."""
+
+    if opts['devtype']:
+        if device.get_device_type() != opts['devtype']:
+            return None
+
+    services = [s for s in device.services if s.get_id() == MAIN_TV_AGENT_SERVICE_ID]
+
+    if not services:
+        return None
+    if len(services) > 1:
+        raise DiscoveryException('Your TV reports back more than one service, can\'t handle '
+                                 'that', [repr(device), repr(services)])
+    return DirectService(device.get_id(), services[0].get_type(), services[0].get_control_url(),
+                         services[0].get_scpd_url(), services[0].get_event_sub_url())
+
+
+def dev_found(scheduler, device_cache, found, device):
+    """Called when a device was found and calls GetChannelListURL if the device matches and has
+    the appropriate service. Stops the DiscoveryScheduler 'scheduler', remembers the device in
+    device_cache, unless that is None, and fires the Deferred 'found' with the service and
+    GetChannelListURL's results."""
+
+    LOG.debug('Discovered device %r', device)
+    # Once we've settled on a TV, GetChannelListURL may still be running when more devices
+    # (or the same one again) turn up.
+    if found.called or scheduler.device is not None:
+        return
+
+    try:
+        svc = _main_tv_agent_service(device)
+    except DiscoveryException as e:
+        scheduler.cancel()
+        found.errback(e)
+        return
+
+    if not svc:
+        return
+
+    LOG.debug('Found matching service %r', svc)
+    scheduler.discovered(device)
+
+    if device_cache:
+        device_cache.put(opts['devtype'], svc.udn, device.get_location(), svc.service_type,
+                         svc.control_url, svc.scpd_url, svc.event_sub_url)
+
+    call_get_channel_list_url(svc).addCallback(lambda results: (svc, results)).\
+        chainDeferred(found)
+
+def start_from_cache(entry, device_cache, found):
+    """Calls GetChannelListURL on the TV described by the device cache entry 'entry' right
+    away and fires the Deferred 'found' with the service and GetChannelListURL's results. If
+    the TV doesn't answer, the entry is invalidated and we fall back to discovery."""
+
+    svc = DirectService(entry['udn'], entry['service_type'], entry['control_url'],
+                        entry.get('scpd_url'), entry.get('event_sub_url'))
+    LOG.debug('Using cached service %r', svc)
+
+    def _cache_failed(failure):
+        LOG.info('Cached TV %s did not answer (%s), discovering it again', entry['udn'],
+                 failure.getErrorMessage())
+        device_cache.invalidate(opts['devtype'])
+        # The TV may just have a new address, but it's still the best guess.
+        start_discovery(device_cache, found, [urlparse.urlsplit(entry['location']).hostname])
+
+    TIMINGS.set('discovery', 'cache')
+    call_get_channel_list_url(svc).\
+        addCallbacks(lambda results: found.callback((svc, results)), _cache_failed)
+
+
+def _parse_device_description(description, location):
+    """Finds the MainTVAgent2 service in the device description 'description' fetched from
+    'location' and returns a tuple of the device's UDN, the service type, the control URL,
+    the SCPD URL and the event subscription URL (None if the TV has none). Raises a
+    DiscoveryException if there's no such service."""
+
+    try:
+        root = ElementTree.fromstring(description)
+    except SyntaxError as e:
+        raise DiscoveryException('Unable to parse device description: %s' % e, [location])
+
+    ns = '{%s}' % UPNP_DEVICE_NS
+    base = root.findtext(ns+'URLBase') or location
+    for device in root.iter(ns+'device'):
+        if opts['devtype'] and device.findtext(ns+'deviceType') != opts['devtype']:
+            continue
+
+        for service in device.findall('%sserviceList/%sservice' % (ns, ns)):
+            if service.findtext(ns+'serviceId') != MAIN_TV_AGENT_SERVICE_ID:
+                continue
+            event_sub_url = service.findtext(ns+'eventSubURL')
+            return (device.findtext(ns+'UDN'), service.findtext(ns+'serviceType'),
+                    urlparse.urljoin(base, service.findtext(ns+'controlURL')),
+                    urlparse.urljoin(base, service.findtext(ns+'SCPDURL')),
+                    urlparse.urljoin(base, event_sub_url) if event_sub_url else None)
+
+    raise DiscoveryException('No %s device with a %s service in device description' %
+                             (opts['devtype'] or 'UPnP', MAIN_TV_AGENT_SERVICE_ID), [location])
+
+
+def _parse_scpd_actions(scpd):
+    """Returns the actions in the service description 'scpd' as a dict of action name ->
+    tuple of the names of its in arguments, in order."""
+
+    try:
+        root = ElementTree.fromstring(scpd)
+    except SyntaxError as e:
+        raise DiscoveryException('Unable to parse service description: %s' % e)
+
+    ns = '{%s}' % UPNP_SERVICE_NS
+    actions = {}
+    for action in root.iter(ns+'action'):
+        actions[action.findtext(ns+'name')] = tuple(
+            argument.findtext(ns+'name')
+            for argument in action.iter(ns+'argument')
+            if (argument.findtext(ns+'direction') or '').strip() == 'in')
+    return actions
+
+
+def _msearch_request(host, mx):
+    """Returns an SSDP M-SEARCH for opts['devtype'] to send to 'host' (the multicast group or
+    a single TV), asking for an answer within 'mx' seconds."""
+
+    return ('M-SEARCH * HTTP/1.1\r\n'
+            'HOST: %s:%d\r\n'
+            'MAN: "ssdp:discover"\r\n'
+            'MX: %d\r\n'
+            'ST: %s\r\n\r\n') % (host, SSDP_PORT, mx, opts['devtype'] or 'ssdp:all')
+
+
+def _ssdp_headers(datagram):
+    """Returns the headers of the SSDP message 'datagram' as a dict of lower-cased names to
+    values."""
+
+    headers = {}
+    for line in datagram.split('\r\n')[1:]:
+        name, _, value = line.partition(':')
+        if name:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def search_host(host):
+    """Asks 'host' for its device description location with unicast M-SEARCHs, repeated with
+    a short backoff. Returns a Deferred firing with the location."""
+
+    return call_with_policy('search_host', lambda: _search_host(host))
+
+def _search_host(host):
+    """One attempt of search_host: M-SEARCHs 'host' until it answers or the returned Deferred
+    is cancelled."""
+
+    from twisted.internet.protocol import DatagramProtocol
+
+    class UnicastSearchProtocol(DatagramProtocol):
+        """Sends an SSDP M-SEARCH for opts['devtype'] straight to a single host (instead of to the
+        multicast group) and fires 'deferred' with the LOCATION of the first answer."""
+
+        def __init__(self, host, deferred):
+            self._host     = host
+            self._deferred = deferred
+
+        def search(self):
+            self.transport.write(_msearch_request(self._host, 1), (self._host, SSDP_PORT))
+
+        def datagramReceived(self, datagram, address):
+            if self._deferred.called:
+                return
+
+            location = _ssdp_headers(datagram).get('location')
+            if location:
+                LOG.debug('%s:%d answered M-SEARCH with location %s', address[0], address[1],
+                          location)
+                self._deferred.callback(location)
+
+    d = defer.Deferred()
+    proto = UnicastSearchProtocol(host, d)
+    port = reactor.listenUDP(0, proto)
+
+    # UDP may get lost, so ask again after 0.1, 0.3, 0.7, ... seconds.
+    def _search(delay_s):
+        if d.called:
+            return
+        proto.search()
+        reactor.callLater(delay_s, _search, delay_s*2)
+    _search(0.1)
+
+    def _done(result):
+        port.stopListening()
+        return result
+    return d.addBoth(_done)
+
+
+def start_direct(found):
+    """Talks to the TV given by opts['location'] (or opts['host'], which is asked for its
+    location first) without any multicast discovery: fetches the device description and the
+    MainTVAgent2 service description, makes sure the actions we need exist, calls
+    GetChannelListURL and fires the Deferred 'found' with the service and its results."""
+
+    TIMINGS.set('discovery', 'direct')
+    if opts['location']:
+        d = defer.succeed(opts['location'])
+    else:
+        d = search_host(opts['host'])
+
+    state = {}
+    def _got_location(location):
+        LOG.debug('Fetching device description from %s', location)
+        state['location'] = location
+        return call_with_policy('get_description', lambda: get_page(location))
+
+    def _got_description(description):
+        udn, service_type, control_url, scpd_url, event_sub_url = \
+            _parse_device_description(description, state['location'])
+        state['service'] = svc = DirectService(udn, service_type, control_url, scpd_url,
+                                               event_sub_url)
+        # A cached service description has been checked for the actions we need already.
+        if not svc.described:
+            LOG.debug('Fetching service description for %r from %s', svc, scpd_url)
+            return call_with_policy('get_description', lambda: get_page(scpd_url)).\
+                addCallback(svc.set_scpd)
+
+    d.addCallback(_got_location)
+    d.addCallback(_got_description)
+    d.addCallback(lambda _: call_get_channel_list_url(state['service']))
+    d.addCallback(lambda results: (state['service'], results))
+    d.chainDeferred(found)
+
+
+def find_tv():
+    """Finds the TV, going straight to it if the user told us where it is, or to a cached TV
+    if we know one, or else (or with the cache disabled) discovering it. Returns a Deferred
+    firing with a tuple of the TV's MainTVAgent2 service and the results of
+    GetChannelListURL."""
+
+    found = defer.Deferred()
+    if opts['location'] or opts['host']:
+        start_direct(found)
+        return found
+
+    if not opts['use_cache']:
+        start_discovery(None, found, [])
+        return found
+
+    device_cache = DeviceCache(opts['cache_dir'], opts['cache_ttl_s'])
+    if opts['flush_cache']:
+        device_cache.invalidate()
+        # Only once, not for every reconnect of a daemon.
+        opts['flush_cache'] = False
+
+    entry = device_cache.get(opts['devtype'])
+    if entry:
+        start_from_cache(entry, device_cache, found)
+    else:
+        start_discovery(device_cache, found, device_cache.addresses())
+    return found
+
+
+def start():
+    """Finds the TV and sets everything up. Next: got_channel_list_url()"""
+
+    d = TIMINGS.track(find_tv(), 'find_tv')
+    d.addCallback(lambda (service, results): got_channel_list_url(results, service)).\
+        addErrback(fatal_failure)
+
+
+def _coherence_logmode():
+    """Returns the Coherence log mode for the most verbose of our 'coherence' loggers, so
+    Coherence doesn't even format the messages _bridge_coherence_logging would drop."""
+
+    loggers = [logging.getLogger('coherence')] + [
+        logger for name, logger in logging.Logger.manager.loggerDict.iteritems()
+        if name.startswith('coherence.') and isinstance(logger, logging.Logger)]
+    level = min(logger.getEffectiveLevel() for logger in loggers)
+    for logmode, logmode_level in [('debug',   logging.DEBUG),
+                                   ('info',    logging.INFO),
+                                   ('warning', logging.WARNING),
+                                   ('error',   logging.ERROR)]:
+        if level <= logmode_level:
+            return logmode
+    return 'none'
+
+def _bridge_coherence_logging():
+    """Sends Coherence's log messages to 'logging' instead of stderr. Only done once."""
+
+    if getattr(_bridge_coherence_logging, 'done', False):
+        return
+    _bridge_coherence_logging.done = True
+
+    # Coherence level -> 'logging' level and category -> Logger, filled as we go.
+    log_levels = {}
+    loggers    = {}
+
+    def _log_handler(level, obj, category, file, line, msg, *args):
+        try:
+            log_level = log_levels[level]
+        except KeyError:
+            log_level = log_levels[level] = COHERENCE_LOG_LEVEL_MAP.get(
+                coherence_log.getLevelName(level), logging.NOTSET)
+
+        try:
+            l = loggers[category]
+        except KeyError:
+            if category == 'coherence':
+                logger_name = 'coherence.main'
+            else:
+                logger_name = 'coherence.%s' % category
+            l = loggers[category] = logging.getLogger(logger_name)
+
+        if l.isEnabledFor(log_level):
+            l.log(log_level, msg, *args)
+
+    coherence_log.addLogHandler(_log_handler)
+    try:
+        coherence_log.removeLimitedLogHandler(coherence_log.stderrHandler)
+    except ValueError:
+        pass
+
+
+class DiscoveryScheduler(object):
+    """Sends SSDP M-SEARCHs for opts['devtype'] until the TV is discovered or 'deadline_s'
+    seconds have passed, and measures how long discovery took.
+
+    Searches go to the multicast group and, in parallel, straight to the addresses in 'hosts'
+    (TVs we've seen before), from Coherence's M-SEARCH socket so Coherence picks up the
+    answers. They start with a quick burst and then back off, each delay with some jitter.
+    Once a matching device answers, there's no point in asking again quickly while Coherence
+    fetches its description, so the scheduler slows down to MAX_INTERVAL_S."""
+
+    # Delays after the first M-SEARCHs; the TV usually answers one of them. After that, delays
+    # grow by BACKOFF_FACTOR up to MAX_INTERVAL_S.
+    BURST_DELAYS_S = [0.1, 0.2, 0.4]
+    BACKOFF_FACTOR = 2
+    MAX_INTERVAL_S = 3.0
+
+    # Delays are randomly stretched or shortened by up to this fraction.
+    JITTER = 0.25
+
+    # How many seconds TVs may wait before answering. Coherence's own searches ask for 5.
+    MX = 1
+
+    def __init__(self, coherence, hosts, deadline_s, timeout_handler):
+        """Initialize the DiscoveryScheduler.
+
+        Args:
+            coherence: The Coherence instance whose M-SEARCH socket to use.
+            hosts: List of addresses to send unicast M-SEARCHs to.
+            deadline_s: Number of seconds after which to give up.
+            timeout_handler: The handler to call with the scheduler as an argument when the
+                             deadline has passed."""
+
+        self._msearch         = coherence.msearch
+        self._hosts           = hosts
+        self._deadline_s      = deadline_s
+        self._timeout_handler = timeout_handler
+
+        self.searches       = 0
+        self.first_answer_s = None
+        self.device         = None  # The device passed to discovered()
+        self._started       = None
+        self._next_call     = None
+        self._deadline_call = None
+
+    @property
+    def elapsed_s(self):
+        """Returns the number of seconds since discovery started."""
+
+        return time.time() - self._started
+
+    def start(self, control_point):
+        """Starts searching. 'control_point' is connected to so we notice answers."""
+
+        self._started = time.time()
+        self._deadline_call = reactor.callLater(self._deadline_s, self._deadline_passed)
+        control_point.connect(self._answered, 'Coherence.UPnP.SSDP.new_device')
+        if self._hosts:
+            LOG.debug('Also searching at %s', ', '.join(self._hosts))
+        self._search(0)
+
+    @classmethod
+    def delay_s(cls, n, answered):
+        """Returns the number of seconds to wait after the n-th (counting from 0) M-SEARCH,
+        'answered' being whether the TV answered one already."""
+
+        if n < len(cls.BURST_DELAYS_S):
+            delay_s = cls.BURST_DELAYS_S[n]
+        else:
+            delay_s = min(cls.BURST_DELAYS_S[-1] *
+                          cls.BACKOFF_FACTOR ** (n - len(cls.BURST_DELAYS_S) + 1),
+                          cls.MAX_INTERVAL_S)
+        if answered:
+            delay_s = cls.MAX_INTERVAL_S
+        return delay_s * random.uniform(1 - cls.JITTER, 1 + cls.JITTER)
+
+    def _search(self, n):
+        LOG.debug('Sending M-SEARCH #%d after %.2f seconds', n + 1, self.elapsed_s)
+        for host in [SSDP_ADDR] + self._hosts:
+            try:
+                self._msearch.transport.write(_msearch_request(host, self.MX), (host, SSDP_PORT))
+            except socket.error as e:
+                LOG.debug('Unable to send M-SEARCH to %s: %s', host, e)
+        self.searches += 1
+        self._next_call = reactor.callLater(self.delay_s(n, self.first_answer_s is not None),
+                                            self._search, n + 1)
+
+    def _answered(self, device_type=None, infos=None, **kwargs_):
+        if self.first_answer_s is None and device_type == opts['devtype']:
+            self.first_answer_s = self.elapsed_s
+            LOG.debug('%s answered after %.2f seconds', (infos or {}).get('USN', 'TV'),
+                      self.first_answer_s)
+
+    def _deadline_passed(self):
+        self._deadline_call = None
+        self.cancel()
+        self._timeout_handler(self)
+
+    def cancel(self):
+        """Stops searching."""
+
+        for call in (self._next_call, self._deadline_call):
+            if call and call.active():
+                call.cancel()
+        self._next_call = self._deadline_call = None
+
+    def discovered(self, device):
+        """Stops searching as 'device' has been discovered and reports how long that took."""
+
+        self.device = device
+        self.cancel()
+        LOG.info('Discovered %s after %.2f seconds and %d M-SEARCHs', device.get_id(),
+                 self.elapsed_s, self.searches)
+        TIMINGS.set('time_to_discovery_s', round(self.elapsed_s, 3))
+        TIMINGS.set('msearches', self.searches)
+        if self.first_answer_s is not None:
+            TIMINGS.set('time_to_first_answer_s', round(self.first_answer_s, 3))
+
+
+def start_discovery(device_cache, found, hosts):
+    """Starts up Coherence and sets everything up for discovery, also asking the addresses in
+    'hosts' directly. Discovered TVs are remembered in device_cache, unless that is None.
+    Fires the Deferred 'found' via dev_found() or fails it with a DiscoveryException if we
+    don't discover the TV within opts['discovery_deadline_s'] seconds."""
+
+    TIMINGS.set('discovery', 'ssdp')
+    _bridge_coherence_logging()
+
+    coherence = Coherence({'logmode': _coherence_logmode()})
+    control_point = ControlPoint(coherence, auto_client=[])
+
+    LOG.debug('Coherence initialized, waiting for devices to be discovered...')
+
+    def _give_up(scheduler):
+        TIMINGS.set('msearches', scheduler.searches)
+        found.errback(DiscoveryException('Did not discover TV after %.1f seconds' %
+                                         scheduler.elapsed_s))
+
+    scheduler = DiscoveryScheduler(coherence, hosts, opts['discovery_deadline_s'], _give_up)
+
+    def _dev_found(device):
+        dev_found(scheduler, device_cache, found, device)
+    control_point.connect(_dev_found, 'Coherence.UPnP.RootDevice.detection_completed')
+    scheduler.start(control_point)
+
+class FanOut(object):
+    """Switches a set of TVs to the same channel concurrently. TVs are switched as soon as
+    they are discovered, at most opts['concurrency'] at a time and each within
+    opts['deadline_s'] seconds. Once all TVs are done, a report with the result and time for
+    each TV is printed."""
+
+    def __init__(self, targets, query):
+        """Initialize the FanOut.
+
+        Args:
+            targets: List of TVs to switch, as UDNs (with or without 'uuid:') or IP addresses.
+                     If it contains 'all', all TVs discovered within opts['discovery_s']
+                     seconds are switched.
+            query: The channel to switch to, anything ChannelIndex.lookup accepts."""
+
+        self._all       = 'all' in targets
+        self._targets   = set(t for t in targets if t != 'all')
+        self._query     = query
+        self._semaphore = defer.DeferredSemaphore(opts['concurrency'])
+        self._started   = time.time()
+        self._jobs      = []
+        self._results   = {}  # UDN -> (address, ok, seconds, message)
+        self._seen      = set()
+        self._discovering = True
+
+    @staticmethod
+    def _address(device):
+        return urlparse.urlsplit(device.get_location()).hostname
+
+    def _wanted(self, device):
+        if self._all:
+            return True
+        udn = device.get_id()
+        for target in (udn, udn.replace('uuid:', '', 1), self._address(device)):
+            if target in self._targets:
+                self._targets.discard(target)
+                return True
+        return False
+
+    def start(self):
+        _bridge_coherence_logging()
+
+        coherence = Coherence({'logmode': _coherence_logmode()})
+        control_point = ControlPoint(coherence, auto_client=[])
+
+        # Targets given by address can be asked directly.
+        hosts = [target for target in self._targets if '.' in target]
+        self._scheduler = DiscoveryScheduler(coherence, hosts, opts['discovery_s'],
+                                             lambda scheduler: self._discovery_done())
+
+        control_point.connect(self._dev_found, 'Coherence.UPnP.RootDevice.detection_completed')
+        self._scheduler.start(control_point)
+
+    def _dev_found(self, device):
+        udn = device.get_id()
+        if not self._discovering or udn in self._seen:
+            return
+
+        try:
+            svc = _main_tv_agent_service(device)
+        except DiscoveryException as e:
+            LOG.error('Ignoring %s: %s', udn, e)
+            return
+        if not svc or not self._wanted(device):
+            return
+
+        self._seen.add(udn)
+        address = self._address(device)
+        LOG.info('Discovered TV %s at %s after %.2f seconds', udn, address,
+                 self._scheduler.elapsed_s)
+        self._jobs.append(self._semaphore.run(self._switch, udn, address, svc))
+
+        if not self._all and not self._targets:
+            self._scheduler.cancel()
+            self._discovery_done()
+
+    def _switch(self, udn, address, service):
+        started = time.time()
+
+        def _switch_to((cl_type, channels)):
+            matches = ChannelIndex(channels).lookup(self._query)
+            if not matches:
+                raise SwitchException('No channel found for %s' % self._query)
+
+            set_main_tv_channel = service.get_action('SetMainTVChannel')
+            return switch_channel(set_main_tv_channel, cl_type, matches[0], udn,
+                                  _verify_action(service)).\
+                addCallback(lambda _: matches[0])
+
+        def _done(result):
+            elapsed_s = time.time() - started
+            if isinstance(result, Failure):
+                self._results[udn] = (address, False, elapsed_s, result.getErrorMessage())
+            else:
+                self._results[udn] = (address, True, elapsed_s, result.display_string())
+
+        d = call_get_channel_list_url(service)
+        d.addCallback(lambda results: load_channel_list(service, results,
+                                                        opts['list_max_age_s']))
+        d.addCallback(_switch_to)
+        return with_deadline(d, opts['deadline_s'], 'Switching %s' % udn).addBoth(_done)
+
+    def _discovery_done(self):
+        self._discovering = False
+        for target in self._targets:
+            self._results[target] = (None, False, None, 'not discovered')
+        defer.DeferredList(self._jobs).addCallback(self._report)
+
+    def _report(self, _):
+        failed = 0
+        print '%-42s %-15s %-6s %7s  %s' % ('TV', 'address', 'result', 'time', '')
+        for udn, (address, ok, elapsed_s, message) in sorted(self._results.iteritems()):
+            elapsed = '%6.2fs' % elapsed_s if elapsed_s is not None else '-'
+            print u'%-42s %-15s %-6s %7s  %s' % (udn, address or '-', 'OK' if ok else 'FAILED',
+                                                elapsed, message)
+            if not ok:
+                failed += 1
+
+        LOG.info('Done with %d TVs after %.2f seconds', len(self._results),
+                 time.time() - self._started)
+        if failed:
+            fatal('%d of %d TVs failed' % (failed, len(self._results)))
+        elif not self._results:
+            fatal('No TVs discovered')
+        else:
+            reactor.stop()
+
+
+class Daemon(object):
+    """Keeps everything needed to switch channels around between requests: the TV's
+    MainTVAgent2 service, the resolved SetMainTVChannel action and the parsed and indexed
+    channel list, so a switch is just a SetMainTVChannel call. If a switch is requested while
+    another one is in progress, it waits for it to finish; if more switches are requested in
+    the meantime, only the latest one is done.
+
+    With 'events', the daemon subscribes to the TV's events (see EventSubscription) and
+    reloads the channel list whenever an evented state variable changes, so it's kept up to
+    date without asking the TV. Switches wait for such a reload. stop() ends the
+    subscription."""
+
+    def __init__(self, events=False):
+        self._events              = events
+        self._service             = None
+        self._set_main_tv_channel = None
+        self._cl_type             = None
+        self._channels            = []
+        self._index               = ChannelIndex([])
+        self._connect_waiters     = []
+        self._switching           = False
+        self._pending             = None  # (query, Deferred) of the latest waiting switch
+        self._subscription        = None
+        self._event_values        = {}    # Last known values of the TV's evented variables
+        self._refresh_waiters     = None  # Deferreds waiting for the running refresh, if any
+        self._refresh_again       = False
+
+    def connect(self):
+        """Returns a Deferred firing once we have the TV's service and channel list, finding
+        the TV (again) if necessary."""
+
+        if self._service:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self._connect_waiters.append(d)
+        if len(self._connect_waiters) == 1:
+            find_tv().addCallback(self._found_tv).addBoth(self._connected)
+        return d
+
+    def _found_tv(self, (service, results)):
+        LOG.info('Connected to TV %s', service.udn)
+
+        # Only a service with a channel list counts as connected (see connect), so if loading
+        # it fails, the next request finds the TV again.
+        def _loaded(_):
+            self._service             = service
+            self._set_main_tv_channel = service.get_action('SetMainTVChannel')
+            self._subscribe()
+        return self._got_channel_list_url(results, opts['list_max_age_s'], service).\
+            addCallback(_loaded)
+
+    def _subscribe(self):
+        if not self._events:
+            return
+        if not self._service.event_sub_url:
+            LOG.info('TV %s has no events, the channel list is only reloaded when a channel '
+                     'isn\'t in it', self._service.udn)
+            return
+
+        if self._subscription:
+            self._subscription.stop()
+        self._event_values = {}
+        self._subscription = subscription = EventSubscription(self._service, self._event)
+
+        def _failed(failure):
+            LOG.warning('Unable to subscribe to events of TV %s, the channel list is only '
+                        'reloaded when a channel isn\'t in it: %s', self._service.udn,
+                        failure.getErrorMessage())
+            subscription.stop()
+            if self._subscription is subscription:
+                self._subscription = None
+        subscription.start().addErrback(_failed)
+
+    def stop(self):
+        """Ends the event subscription, if any. Returns a Deferred firing once the TV has
+        been told."""
+
+        subscription, self._subscription = self._subscription, None
+        return subscription.stop() if subscription else defer.succeed(None)
+
+    def _event(self, values):
+        """Called with the state variables of each event of the TV, or None if events were
+        missed. Refreshes the channel list if anything changed."""
+
+        if values is None:
+            changed = ['(missed events)']
+        else:
+            # The first value of each variable is just its current one.
+            changed = sorted(name for name, value in values.iteritems()
+                             if self._event_values.get(name, value) != value)
+            self._event_values.update(values)
+        if changed:
+            LOG.info('TV reports changes to %s, reloading the channel list', ', '.join(changed))
+            self.refresh()
+
+    def refresh(self):
+        """Reloads the channel list in the background, again once it's done if refresh is
+        called in the meantime."""
+
+        if self._refresh_waiters is not None:
+            self._refresh_again = True
+            return
+
+        def _reload():
+            self._refresh_again = False
+            self.reload().addBoth(_done)
+
+        def _done(result):
+            if isinstance(result, Failure):
+                LOG.warning('Unable to reload the channel list: %s', result.getErrorMessage())
+            if self._refresh_again and self._service:
+                _reload()
+                return
+            waiters, self._refresh_waiters = self._refresh_waiters, None
+            for d in waiters:
+                d.callback(None)
+
+        self._refresh_waiters = []
+        _reload()
+
+    def _refreshed(self):
+        """Returns a Deferred firing once the running refresh is done, or right away if
+        there is none."""
+
+        if self._refresh_waiters is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._refresh_waiters.append(d)
+        return d
+
+    def _connected(self, result):
+        waiters, self._connect_waiters = self._connect_waiters, []
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(None)
+
+    def _got_channel_list_url(self, results, max_age_s, service=None):
+        return load_channel_list(service or self._service, results, max_age_s).\
+            addCallback(self._got_channel_list)
+
+    def _got_channel_list(self, (cl_type, channels)):
+        LOG.info('Loaded %d channels (channel list type %s)', len(channels), cl_type)
+        self._cl_type  = cl_type
+        self._channels = channels
+        self._index    = ChannelIndex(channels)
+
+    def _forget_tv(self, failure):
+        """Errback dropping the service after errors other than the TV refusing to switch, so
+        the next request finds the TV again."""
+
+        if not failure.check(SwitchException):
+            LOG.debug('Forgetting TV after error: %s', failure.getErrorMessage())
+            self._service = None
+            if self._subscription:
+                self._subscription.stop()
+                self._subscription = None
+        return failure
+
+    def reload(self):
+        """Fetches the current channel list from the TV. Returns a Deferred firing when
+        done."""
+
+        def _get_channel_list_url(_):
+            return call_get_channel_list_url(self._service)
+        return self.connect().addCallback(_get_channel_list_url).\
+            addCallback(self._got_channel_list_url, -1).addErrback(self._forget_tv)
+
+    def list(self):
+        """Returns a Deferred firing with the list of all Channels."""
+
+        return self.connect().addCallback(lambda _: self._channels)
+
+    def search(self, query):
+        """Returns a Deferred firing with ChannelIndex.search's results for 'query'."""
+
+        return self.connect().addCallback(lambda _: self._index.search(query))
+
+    def switch(self, query):
+        """Switches to the channel matching 'query', see ChannelIndex.lookup. Returns a Deferred
+        firing with the Channel switched to. If another switch is requested before this one
+        started, this one fails with a SupersededException."""
+
+        if self._pending:
+            query_, superseded = self._pending
+            superseded.errback(SupersededException('superseded by switch to %s' % query))
+
+        d = defer.Deferred()
+        self._pending = (query, d)
+        if not self._switching:
+            self._switch_pending()
+        return d
+
+    def _switch_pending(self):
+        query, d = self._pending
+        self._pending   = None
+        self._switching = True
+
+        def _done(result):
+            self._switching = False
+            if self._pending:
+                self._switch_pending()
+            return result
+
+        self._switch(query).addBoth(_done).chainDeferred(d)
+
+    def _switch(self, query):
+        def _lookup(_):
+            # The list might be outdated, so reload it before settling for a fuzzy match.
+            matches = self._index.lookup(query, fuzzy=False)
+            if matches:
+                return matches[0]
+            LOG.info('No channel found for %s, reloading channel list', query)
+            return self.reload().addCallback(_lookup_again)
+
+        def _lookup_again(_):
+            matches = self._index.lookup(query)
+            if not matches:
+                raise SwitchException('No channel found for %s' % query)
+            return matches[0]
+
+        def _switch_to(channel):
+            LOG.info('Switching to %s', channel.display_string())
+            return switch_channel(self._set_main_tv_channel, self._cl_type, channel,
+                                  self._service.udn, _verify_action(self._service)).\
+                addCallback(lambda _: channel)
+
+        return self.connect().addCallback(lambda _: self._refreshed()).addCallback(_lookup).\
+            addCallback(_switch_to).addErrback(self._forget_tv)
+
+
+def start_daemon():
+    """Starts listening on the control socket and connects to the TV right away, so the first
+    request doesn't have to wait for it."""
+
+    from twisted.protocols.basic import LineReceiver
+
+    class DaemonProtocol(LineReceiver):
+        """The protocol of the daemon's control socket. A request is a single UTF-8 line:
+
+            switch CHANNEL  Switches to CHANNEL (anything -c accepts)
+            list            Lists all channels
+            search QUERY    Lists channels matching QUERY, best match first
+
+        The daemon answers with any number of data lines prefixed by '= ', followed by a single
+        status line starting with OK, SKIPPED (for superseded switch requests) or ERR."""
+
+        delimiter = '\n'
+
+        def lineReceived(self, line):
+            try:
+                command, _, arg = line.strip().decode('utf-8').partition(' ')
+            except UnicodeDecodeError:
+                self._reply('ERR', 'requests have to be UTF-8')
+                return
+
+            daemon = self.factory.daemon
+            if command == 'switch' and arg:
+                d = daemon.switch(arg).addCallback(
+                    lambda channel: self._reply('OK', u'switched to %s' % channel.display_string()))
+            elif command == 'list':
+                d = daemon.list().addCallback(
+                    lambda channels: self._reply('OK', u'%d channels' % len(channels),
+                                                 [c.display_string() for c in channels]))
+            elif command == 'search' and arg:
+                d = daemon.search(arg).addCallback(
+                    lambda results: self._reply('OK', u'%d matches' % len(results),
+                                                [u'%4.2f %s' % (score, c.display_string())
+                                                 for score, c in results]))
+            else:
+                self._reply('ERR', u'unknown request %s' % line.strip().decode('utf-8', 'replace'))
+                return
+            d.addErrback(self._failed)
+
+        def _failed(self, failure):
+            if failure.check(SupersededException):
+                self._reply('SKIPPED', failure.getErrorMessage())
+            elif failure.check(ContextException):
+                self._reply('ERR', failure.getErrorMessage())
+            else:
+                LOG.error('Request failed: %s', failure.getTraceback())
+                self._reply('ERR', 'unexpected error: %s' % failure.getErrorMessage())
+
+        def _reply(self, status, message, data=()):
+            for line in data:
+                self.sendLine((u'= %s' % line).encode('utf-8'))
+            self.sendLine((u'%s %s' % (status, message)).encode('utf-8'))
+
+    dirname = os.path.dirname(opts['socket'])
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    factory = protocol.ServerFactory()
+    factory.protocol = DaemonProtocol
+    factory.daemon   = Daemon(events=opts['events'])
+    # Don't leave the subscription behind on the TV.
+    reactor.addSystemEventTrigger('before', 'shutdown', factory.daemon.stop)
+
+    try:
+        reactor.listenUNIX(opts['socket'], factory, mode=0600, wantPID=True)
+    except Exception as e:
+        fatal('Unable to listen on %s' % opts['socket'], e)
+        return
+    LOG.info('Listening on %s', opts['socket'])
+
+    def _connect_failed(failure):
+        LOG.error('Unable to connect to TV, will retry on the next request: %s',
+                  failure.getErrorMessage())
+    factory.daemon.connect().addErrback(_connect_failed)
+
+
+def parse_batch(lines):
+    """Parses the batch commands in 'lines', one per line:
+
+        switch CHANNEL  Switches to CHANNEL (anything -c accepts)
+        list            Lists all channels
+        search QUERY    Lists channels matching QUERY, best match first
+        reload          Fetches the channel list again
+        wait SECONDS    Waits for SECONDS seconds
+        repeat [TIMES]  Starts over from the first command, TIMES times or forever
+
+    Empty lines and lines starting with # are ignored. Returns a list of (line number,
+    command, argument) tuples; raises a ParseException for invalid commands."""
+
+    steps = []
+    for lineno, line in enumerate(lines, 1):
+        try:
+            line = line.strip().decode('utf-8')
+        except UnicodeDecodeError:
+            raise ParseException('line %d is not UTF-8' % lineno)
+        if not line or line.startswith('#'):
+            continue
+
+        command, _, arg = line.partition(' ')
+        arg = arg.strip()
+        if command in ['switch', 'search']:
+            if not arg:
+                raise ParseException('line %d: %s needs an argument' % (lineno, command))
+        elif command in ['list', 'reload']:
+            if arg:
+                raise ParseException('line %d: %s takes no argument' % (lineno, command))
+        elif command in ['wait', 'repeat']:
+            if arg or command == 'wait':
+                try:
+                    arg = float(arg) if command == 'wait' else int(arg)
+                except ValueError:
+                    raise ParseException('line %d: invalid number %s' % (lineno, arg))
+            else:
+                arg = None
+        else:
+            raise ParseException('line %d: unknown command %s' % (lineno, command))
+        steps.append((lineno, command, arg))
+    return steps
+
+
+class Batch(object):
+    """Runs a list of batch commands (see parse_batch) one after the other in a single run,
+    keeping the TV's service and channel list around between them like the daemon does. A
+    failing step is logged and doesn't stop the batch, but makes us exit with an error."""
+
+    def __init__(self, steps):
+        self._steps   = steps
+        # Without events: a batch is over soon, and has 'reload' for lists that change.
+        self._daemon  = Daemon()
+        self._repeats = {}  # step index -> remaining repeats
+        self._run     = 0
+        self._failed  = 0
+
+    def start(self):
+        self._next(0)
+
+    def _execute(self, command, arg):
+        if command == 'switch':
+            return self._daemon.switch(arg)
+        elif command == 'list':
+            def _print(channels):
+                for channel in channels:
+                    print channel.display_string()
+            return self._daemon.list().addCallback(_print)
+        elif command == 'search':
+            def _print(results):
+                for score, channel in results:
+                    print u'%4.2f %s' % (score, channel.display_string())
+            return self._daemon.search(arg).addCallback(_print)
+        elif command == 'reload':
+            return self._daemon.reload()
+        elif command == 'wait':
+            d = defer.Deferred()
+            reactor.callLater(arg, d.callback, None)
+            return d
+
+    def _next(self, i):
+        if i == len(self._steps):
+            if self._failed:
+                fatal('%d of %d steps failed' % (self._failed, self._run))
+            else:
+                reactor.stop()
+            return
+
+        lineno, command, arg = self._steps[i]
+        if command == 'repeat':
+            remaining = self._repeats.get(i, arg)
+            if remaining is None or remaining > 0:
+                self._repeats[i] = remaining - 1 if remaining is not None else None
+                LOG.debug('Line %d: starting over', lineno)
+                # Only the repeats after this one start over when we get here again.
+                for j in self._repeats.keys():
+                    if j < i:
+                        del self._repeats[j]
+                reactor.callLater(0, self._next, 0)
+            else:
+                del self._repeats[i]
+                reactor.callLater(0, self._next, i + 1)
+            return
+
+        started = time.time()
+        self._run += 1
+
+        def _failed(failure):
+            self._failed += 1
+            LOG.error('Line %d (%s) failed: %s', lineno, command, failure.getErrorMessage())
+
+        def _done(_):
+            LOG.debug('Line %d (%s) took %.3f seconds', lineno, command, time.time() - started)
+            # Via the reactor, so long (or endlessly repeating) batches don't grow the stack.
+            reactor.callLater(0, self._next, i + 1)
+
+        self._execute(command, arg).addErrback(_failed).addCallback(_done)
+
+
+def start_batch():
+    """Reads the batch commands from opts['batch'] ('-' for stdin) and runs them."""
+
+    try:
+        if opts['batch'] == '-':
+            steps = parse_batch(sys.stdin.readlines())
+        else:
+            with open(opts['batch'], 'rb') as f:
+                steps = parse_batch(f.readlines())
+    except IOError as e:
+        fatal('Unable to read batch file %s' % opts['batch'], e)
+        return
+    except ParseException as pe:
+        fatal('Invalid batch file %s' % opts['batch'], pe)
+        return
+
+    Batch(steps).start()
+
+
+class ZapBench(object):
+    """Measures how long switching channels takes, end to end (--zap-bench): switches through
+    'count' channels spread evenly over the channel list, one after the other, verifying each
+    switch (see verify_switch), and prints how long the TV took to acknowledge each switch and
+    then to tune, and the distribution of both. The same channel list always gives the same
+    channels, so runs can be compared."""
+
+    # Seconds to wait between switches, so one switch doesn't slow down the next.
+    DWELL_S = 1.0
+
+    def __init__(self, count):
+        self._count    = count
+        self._service  = None
+        self._results  = []  # (channel, ack_s, tune_s, error)
+
+    def start(self):
+        find_tv().addCallback(self._found_tv).addCallback(self._got_channel_list).\
+            addErrback(fatal_failure)
+
+    def _found_tv(self, (service, results)):
+        self._service = service
+        return load_channel_list(service, results, opts['list_max_age_s'])
+
+    def _got_channel_list(self, (cl_type, channels)):
+        channels = [channels[(i * len(channels) // self._count) % len(channels)]
+                    for i in xrange(self._count)]
+        LOG.info('Zapping through %d channels', len(channels))
+        self._zap(cl_type, channels, 0)
+
+    def _zap(self, cl_type, channels, i):
+        if i == len(channels):
+            self._report()
+            return
+
+        channel = channels[i]
+        started = time.time()
+        times = {}
+
+        def _acked(_):
+            times['ack_s'] = time.time() - started
+            return verify_switch(self._service.get_action('GetCurrentMainTVChannel'), channel)
+
+        def _tuned(tune_s):
+            self._results.append((channel, times['ack_s'], tune_s, None))
+
+        def _failed(failure):
+            LOG.error('Switching to %s failed: %s', channel.display_string(),
+                      failure.getErrorMessage())
+            self._results.append((channel, times.get('ack_s'), None, failure.getErrorMessage()))
+
+        def _next(_):
+            reactor.callLater(self.DWELL_S, self._zap, cl_type, channels, i + 1)
+
+        LOG.debug('Zap %d/%d: %s', i + 1, len(channels), channel.display_string())
+        switch_channel(self._service.get_action('SetMainTVChannel'), cl_type, channel,
+                       self._service.udn).\
+            addCallback(_acked).addCallbacks(_tuned, _failed).addCallback(_next)
+
+    def _report(self):
+        print u'%-40s %8s %8s %8s' % ('channel', 'ack_s', 'tune_s', 'total_s')
+        for channel, ack_s, tune_s, error in self._results:
+            if error:
+                print u'%-40s %8s %s' % (channel.display_string()[:40],
+                                         '%.3f' % ack_s if ack_s is not None else '-', error)
+            else:
+                print u'%-40s %8.3f %8.3f %8.3f' % (channel.display_string()[:40], ack_s,
+                                                    tune_s, ack_s + tune_s)
+
+        ok = [(ack_s, tune_s) for _, ack_s, tune_s, error in self._results if not error]
+        print
+        print '%-8s %6s %8s %8s %8s %8s %8s' % ('', 'n', 'min', 'median', 'p90', 'max', 'mean')
+        for name, values in [('ack_s',   [ack_s for ack_s, _ in ok]),
+                             ('tune_s',  [tune_s for _, tune_s in ok]),
+                             ('total_s', [ack_s + tune_s for ack_s, tune_s in ok])]:
+            if not values:
+                continue
+            values.sort()
+            print '%-8s %6d %8.3f %8.3f %8.3f %8.3f %8.3f' % (
+                name, len(values), values[0], percentile(values, 50),
+                percentile(values, 90), values[-1], sum(values) / len(values))
+
+        failed = len(self._results) - len(ok)
+        if failed:
+            fatal('%d of %d switches failed' % (failed, len(self._results)))
+        else:
+            reactor.stop()
+
+
+def run_client():
+    """Sends the request given by the options to the daemon and prints its answer. Doesn't
+    need the reactor."""
+
+    if opts['do_list']:
+        request = u'list'
+    elif opts['search']:
+        request = u'search %s' % opts['search']
+    else:
+        request = u'switch %s' % opts['channel']
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(opts['socket'])
+        sock.sendall(request.encode('utf-8') + '\n')
+        answer = sock.makefile('rb')
+        for line in answer:
+            line = line.rstrip('\n').decode('utf-8')
+            if line.startswith('= '):
+                print line[2:]
+                continue
+
+            status, _, message = line.partition(' ')
+            if status == 'OK':
+                LOG.info('%s', message)
+            elif status == 'SKIPPED':
+                LOG.warning('Request skipped: %s', message)
+            else:
+                fatal(message)
+            return
+    except socket.error as e:
+        fatal('Unable to talk to daemon at %s' % opts['socket'], e)
+        return
+    finally:
+        sock.close()
+
+    fatal('Daemon closed the connection without answering')
+
+
+class PyWarningsFilter(logging.Filter):
+    """A filter for py.warnings which resolves the cause (module) of the
+    warning and checks their logger whether we should log."""
+
+    def __init__(self, *args, **kwargs):
+        self.module_names_cache = {}
+        self._sys_path = None
+        self._modpaths = frozenset()
+        super(PyWarningsFilter, self).__init__(*args, **kwargs)
+
+    @staticmethod
+    def _normalize(path):
+        # we can't use os.path.realpath as it resolves symlinks, which we
+        # do not want, so normalize "as good as possible".
+        return os.path.normcase(os.path.normpath(path))
+
+    def _get_modpaths(self):
+        """Returns the set of normalized sys.path entries, rebuilt only if sys.path changed."""
+
+        if self._sys_path != sys.path:
+            self._sys_path = list(sys.path)
+            self._modpaths = frozenset(self._normalize(modpath) for modpath in sys.path)
+        return self._modpaths
+
+    def _module_name_from_filename(self, filename):
+        try:
+            return self.module_names_cache[filename]
+        except KeyError:
+            pass
+
+        modpaths = self._get_modpaths()
+        # Walk up from the file's directory: the first directory that's in sys.path is the
+        # longest sys.path entry the file is in, which is the one that names the module.
+        # normpath already replaced altsep with sep, so we can split at os.path.sep.
+        rest = self._normalize(filename).split(os.path.sep)
+        for i in xrange(len(rest) - 1, 0, -1):
+            if os.path.sep.join(rest[:i]) in modpaths:
+                rest = rest[i:]
+                # strip python extension from filename
+                rest[-1] = (os.path.splitext(rest[-1]))[0]
                 if rest[-1] == '__init__':
                     rest.pop()  # drop __init__
                 module_name = self.module_names_cache[filename] = '.'.join(rest)
@@ -576,9 +4278,15 @@ class PyWarningsFilter(logging.Filter):
 def set_up_logging(levels_string):
     """Sets up logging and configures the log levels according to levels_string."""
 
+    # Formatting and writing happen in a LogWriter thread, so logging (even at debug level)
+    # doesn't hold up the reactor. Whatever is still queued is written at exit.
     sh = logging.StreamHandler()
     sh.setFormatter(LogFormatter())
-    logging.getLogger().addHandler(sh)
+    log_queue = Queue.Queue()
+    writer = LogWriter(log_queue, sh)
+    writer.start()
+    atexit.register(writer.stop)
+    logging.getLogger().addHandler(QueueHandler(log_queue))
 
     logging.getLogger('py.warnings').addFilter(PyWarningsFilter())
     logging.captureWarnings(True)
@@ -595,15 +4303,45 @@ def set_up_logging(levels_string):
     global LOG
     LOG = logging.getLogger('sstcs')
 
+def run_asyncio():
+    """Does a single run (-c, -l, --search or --diff) with the asyncio engine in
+    sstcs_asyncio instead of with Twisted and Coherence."""
+
+    if opts['tvs'] or opts['daemon'] or opts['batch'] or opts['zap_bench']:
+        fatal('--engine=asyncio only does single runs, not --tv, --daemon, --batch or '
+              '--zap-bench.')
+        return
+
+    # sstcs_asyncio imports us as 'sstcs', which has to be this module (with our opts) even if
+    # we're running as a script.
+    sys.modules.setdefault('sstcs', sys.modules[__name__])
+    try:
+        import sstcs_asyncio
+    except ImportError as e:
+        fatal('Unable to load the asyncio engine, it needs trollius: %s' % e)
+        return
+    sstcs_asyncio.main()
+
 def main():
-    """Parse options, set everything up and start twisted.reactor. Next: start()"""
+    """Parse options, set everything up and call run(), under the profiler for --profile."""
 
     # Force stdout to be utf-8 so we can actually pipe our output to grep. Argh.
     sys.stdout = codecs.getwriter('utf8')(sys.stdout)
 
     try:
         gopts, rest_ = getopt.getopt(sys.argv[1:], "L:t:c:l",
-                                     ["loglevels=", "devtype=", "channel=", "list"])
+                                     ["loglevels=", "devtype=", "channel=", "list", "search=",
+                                      "no-cache", "flush-cache", "cache-dir=", "cache-ttl=",
+                                      "list-max-age=", "daemon", "client", "socket=", "tv=",
+                                      "concurrency=", "deadline=", "discovery-time=",
+                                      "discovery-deadline=",
+                                      "host=", "location=", "timings-json=",
+                                      "prom-textfile=", "offline", "channel-list=", "batch=",
+                                      "diff=", "diff-json",
+                                      "db=", "export-db=", "import-db=", "engine=",
+                                      "verify", "verify-timeout=", "zap-bench=", "profile=",
+                                      "lag-threshold=", "no-events", "event-port=", "no-hedge",
+                                      "hedge-percentile="])
     except getopt.GetoptError as err:
         print str(err)
         sys.exit(1)
@@ -622,20 +4360,195 @@ def main():
                 opts['channel'] = a.decode('iso-8859-1')
         elif o in ['-l', '--list']:
             opts['do_list'] = True
+        elif o == '--search':
+            try:
+                opts['search'] = a.decode('utf-8')
+            except UnicodeDecodeError:
+                opts['search'] = a.decode('iso-8859-1')
+        elif o == '--no-cache':
+            opts['use_cache'] = False
+        elif o == '--flush-cache':
+            opts['flush_cache'] = True
+        elif o == '--cache-dir':
+            opts['cache_dir'] = a
+        elif o == '--cache-ttl':
+            try:
+                opts['cache_ttl_s'] = float(a)
+            except ValueError:
+                fatal('Invalid cache TTL: %s' % a)
+                return
+        elif o == '--list-max-age':
+            try:
+                opts['list_max_age_s'] = float(a)
+            except ValueError:
+                fatal('Invalid channel list max age: %s' % a)
+                return
+        elif o == '--daemon':
+            opts['daemon'] = True
+        elif o == '--client':
+            opts['client'] = True
+        elif o == '--socket':
+            opts['socket'] = a
+        elif o == '--host':
+            opts['host'] = a
+        elif o == '--location':
+            opts['location'] = a
+        elif o == '--offline':
+            opts['offline'] = True
+        elif o == '--channel-list':
+            opts['channel_list'] = a
+            opts['offline'] = True
+        elif o in ['--db', '--export-db', '--import-db']:
+            opts[o[2:].replace('-', '_')] = a
+        elif o == '--diff':
+            opts['diff'] = a
+        elif o == '--diff-json':
+            opts['diff_json'] = True
+        elif o == '--batch':
+            opts['batch'] = a
+        elif o == '--verify':
+            opts['verify'] = True
+        elif o == '--no-events':
+            opts['events'] = False
+        elif o == '--no-hedge':
+            opts['hedge'] = False
+        elif o == '--zap-bench':
+            try:
+                opts['zap_bench'] = int(a)
+            except ValueError:
+                opts['zap_bench'] = 0
+            if opts['zap_bench'] < 1:
+                fatal('--zap-bench needs a positive number of channels, not %s' % a)
+                return
+        elif o == '--engine':
+            if a not in ['twisted', 'asyncio']:
+                fatal('Unknown engine %s, use twisted or asyncio.' % a)
+                return
+            opts['engine'] = a
+        elif o == '--timings-json':
+            opts['timings_json'] = a
+        elif o == '--prom-textfile':
+            opts['prom_textfile'] = a
+        elif o == '--profile':
+            opts['profile'] = a
+        elif o == '--tv':
+            opts['tvs'].append(a)
+        elif o in ['--concurrency', '--deadline', '--discovery-time', '--discovery-deadline',
+                   '--verify-timeout', '--lag-threshold', '--event-port', '--hedge-percentile']:
+            key, convert = {'--concurrency'       : ('concurrency', int),
+                            '--deadline'          : ('deadline_s', float),
+                            '--discovery-time'    : ('discovery_s', float),
+                            '--discovery-deadline': ('discovery_deadline_s', float),
+                            '--verify-timeout'    : ('verify_timeout_s', float),
+                            '--lag-threshold'     : ('lag_threshold_s', float),
+                            '--event-port'        : ('event_port', int),
+                            '--hedge-percentile'  : ('hedge_percentile', float)}[o]
+            try:
+                opts[key] = convert(a)
+            except ValueError:
+                fatal('Invalid value for %s: %s' % (o, a))
+                return
         else:
             fatal('Unknown option: %s', o)
             return
 
-    if not opts['channel'] and not opts['do_list']:
-        fatal('Either -c or -l must be specified.')
+    if (not opts['channel'] and not opts['do_list'] and not opts['search'] and
+            not opts['daemon'] and not opts['batch'] and not opts['diff'] and
+            not opts['export_db'] and not opts['import_db'] and not opts['zap_bench']):
+        fatal('Either -c, -l, --search, --diff, --daemon, --batch, --zap-bench, --export-db or '
+              '--import-db must be specified.')
+        return
+
+    if opts['diff'] and opts['channel']:
+        fatal('--diff doesn\'t go with -c.')
         return
 
+    if not opts['socket']:
+        opts['socket'] = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or opts['cache_dir'],
+                                      'sstcs.sock')
+
     set_up_logging(opts['loglevels'])
 
-    reactor.callWhenRunning(start)
+    global TIMINGS
+    TIMINGS = Timings(enabled=bool(opts['timings_json'] or opts['prom_textfile']) and
+                      not opts['daemon'])
+
+    if opts['lag_threshold_s'] is not None and opts['lag_threshold_s'] <= 0:
+        fatal('--lag-threshold needs a positive number of seconds.')
+        return
+
+    if not 0 < opts['hedge_percentile'] <= 100:
+        fatal('--hedge-percentile needs a percentile between 0 and 100.')
+        return
+
+    profiler = Profiler(opts['profile']) if opts['profile'] else None
+    if profiler:
+        profiler.start()
+    try:
+        run()
+    finally:
+        if profiler:
+            profiler.stop()
+
+def _save_latencies():
+    if opts['use_cache']:
+        LATENCIES.save(opts['cache_dir'])
+
+def run():
+    """Does whatever the options say, on the reactor if it needs the network."""
+
+    if opts['db'] or opts['export_db'] or opts['import_db']:
+        if opts['channel'] or opts['diff']:
+            fatal('Channel databases can only be listed and searched.')
+            return
+        run_db()
+        return
+
+    if opts['offline']:
+        run_offline()
+        return
+
+    if opts['client']:
+        run_client()
+        return
+
+    if opts['use_cache']:
+        LATENCIES.load(opts['cache_dir'])
+
+    if opts['engine'] == 'asyncio':
+        run_asyncio()
+        _save_latencies()
+        TIMINGS.write(EXITCODE == 0)
+        return
+
+    _import_networking()
+
+    monitor = None
+    if opts['lag_threshold_s']:
+        monitor = LagMonitor(opts['lag_threshold_s'], reactor.callLater)
+        reactor.callWhenRunning(monitor.start)
+
+    if opts['tvs']:
+        if not opts['channel']:
+            fatal('--tv needs -c.')
+            return
+        reactor.callWhenRunning(FanOut(opts['tvs'], opts['channel']).start)
+    elif opts['daemon']:
+        reactor.callWhenRunning(start_daemon)
+    elif opts['batch']:
+        reactor.callWhenRunning(start_batch)
+    elif opts['zap_bench']:
+        reactor.callWhenRunning(ZapBench(opts['zap_bench']).start)
+    else:
+        reactor.callWhenRunning(start)
     reactor.run()
+    if monitor:
+        monitor.stop()
+
+    _save_latencies()
+    TIMINGS.write(EXITCODE == 0)
 
 if __name__ == '__main__':
     main()
+    sys.exit(EXITCODE)
 
-sys.exit(EXITCODE)
@@ -0,0 +1,855 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""An asyncio engine for sstcs (sstcs.py --engine=asyncio). It does what a single run of sstcs
+does with Twisted and Coherence -- discovering the TV with SSDP, calling MainTVAgent2's actions
+and fetching the channel list -- with nothing but asyncio, so it starts a lot faster, and its
+coroutines can be used from other asyncio code. Caches, options, logging and output are
+sstcs', so both engines behave the same.
+
+Python 2 has no asyncio, so this runs on trollius, its backport, which is why coroutines
+'yield From(...)' and 'raise Return(...)' instead of 'yield from' and 'return'.
+
+Embedding: set up sstcs.opts and logging (see sstcs.set_up_logging), then for example
+
+    service, results = yield From(sstcs_asyncio.find_tv())
+    cl_type, channels = yield From(sstcs_asyncio.load_channel_list(service, results, 3600))
+    yield From(sstcs_asyncio.switch_channel(service, cl_type, channels[0]))
+"""
+
+import logging
+import socket
+import sys
+import time
+import traceback
+import urlparse
+
+import trollius as asyncio
+from trollius import From, Return
+
+import sstcs
+from sstcs import (opts, ActionException, ChannelIndex, ChannelListCache, ChannelListReceiver,
+                   ChannelListTypeStats, ContextException, DeadlineException, DeviceCache,
+                   DirectAction, DirectService, DiscoveryException, DiscoveryScheduler,
+                   ParseException, SwitchException, CL_TYPE_FALLBACKS, SSDP_ADDR, SSDP_PORT,
+                   UPNP_INVALID_ACTION_ERRORS, VERIFY_POLL_DELAYS_S, fatal)
+
+# The same Logger as sstcs.LOG, which is only set once logging is set up.
+LOG = logging.getLogger('sstcs')
+
+# How much of a response body to read at a time.
+CHUNK_SIZE = 64 * 1024
+
+
+class HTTPError(Exception):
+    """An Exception for HTTP responses with an unexpected status, like Twisted's
+    twisted.web.error.Error."""
+
+    def __init__(self, code, message):
+        super(HTTPError, self).__init__(code, message)
+        self.code    = code
+        self.message = message
+
+    def __str__(self):
+        return '%s %s' % (self.code, self.message)
+
+
+@asyncio.coroutine
+def track(coro, name, **attrs):
+    """Records a Span called 'name' lasting until the coroutine (or Future) 'coro' is done,
+    like Timings.track does for Deferreds. Returns coro's result."""
+
+    span = sstcs.TIMINGS.span(name, **attrs)
+    ok = False
+    try:
+        result = yield From(coro)
+        ok = True
+    finally:
+        span.finish(ok=ok)
+    raise Return(result)
+
+
+@asyncio.coroutine
+def with_deadline(coro, timeout_s, what):
+    """Returns the result of the coroutine (or Future) 'coro', or raises a DeadlineException
+    mentioning 'what' if it takes longer than 'timeout_s' seconds."""
+
+    try:
+        result = yield From(asyncio.wait_for(coro, timeout_s))
+    except asyncio.TimeoutError:
+        raise DeadlineException('%s took longer than %.1f seconds' % (what, timeout_s))
+    raise Return(result)
+
+
+@asyncio.coroutine
+def call_with_policy(name, attempt, latency_name=None):
+    """Makes the call 'name' to the TV according to sstcs.CALL_POLICIES[name], retrying,
+    hedging and recording latencies (see 'latency_name') exactly like sstcs.call_with_policy.
+    'attempt' is called without arguments for each attempt and returns a coroutine. Returns
+    the result of the first attempt that succeeds, or raises what the last one raised, or a
+    DeadlineException."""
+
+    policy  = sstcs.CALL_POLICIES[name]
+    loop    = asyncio.get_event_loop()
+    started = time.time()
+    result  = asyncio.Future()
+    running = set()
+    timed_out = set()
+    state   = {'retries': 0, 'retry': None, 'hedge': None}
+
+    def _start(hedge=False):
+        sstcs._count('%s_attempts' % name)
+        attempt_started = time.time()
+        task = asyncio.ensure_future(attempt())
+        running.add(task)
+        timer = loop.call_later(policy.attempt_timeout_s, _time_out, task)
+        task.add_done_callback(lambda task: _attempt_done(task, timer, attempt_started))
+
+        delay_s = None if hedge else sstcs.hedge_delay_s(name, policy)
+        if delay_s is not None:
+            state['hedge'] = loop.call_later(delay_s, _hedge, delay_s)
+
+    def _time_out(task):
+        timed_out.add(task)
+        task.cancel()
+
+    def _hedge(delay_s):
+        if running and not result.done():
+            LOG.debug('%s not answered after %.3f seconds, hedging', name, delay_s)
+            sstcs._count('%s_hedges' % name)
+            _start(hedge=True)
+
+    def _attempt_done(task, timer, attempt_started):
+        running.discard(task)
+        timer.cancel()
+        if result.done():
+            return
+        if task.cancelled():
+            if task not in timed_out:
+                return
+            error = DeadlineException('%s attempt took longer than %.1f seconds' %
+                                      (name, policy.attempt_timeout_s))
+        else:
+            error = task.exception()
+        if error is None:
+            sstcs.LATENCIES.add(latency_name(task.result()) if latency_name else name,
+                                time.time() - attempt_started)
+            result.set_result(task.result())
+            return
+
+        LOG.debug('%s attempt failed: %s', name, error)
+        if running:
+            return  # The hedged attempt might still make it.
+        if state['hedge']:
+            state['hedge'].cancel()
+
+        delay_s = policy.backoff_s * 2 ** state['retries']
+        if (not sstcs.is_retryable(error) or state['retries'] >= policy.retries or
+                time.time() + delay_s >= started + policy.deadline_s):
+            result.set_exception(error)
+            return
+        state['retries'] += 1
+        sstcs._count('%s_retries' % name)
+        LOG.info('%s failed (%s), retrying in %.1f seconds', name, error, delay_s)
+        state['retry'] = loop.call_later(delay_s, _start)
+
+    _start()
+    try:
+        value = yield From(with_deadline(result, policy.deadline_s, name))
+    finally:
+        for timer in [state['hedge'], state['retry']]:
+            if timer:
+                timer.cancel()
+        for task in list(running):
+            task.cancel()
+    raise Return(value)
+
+
+# HTTP. The TV only talks plain HTTP/1.1, and it's all GETs and POSTs of small things and the
+# channel list, so a connection per request will do.
+
+@asyncio.coroutine
+def _send_request(method, url, headers=None, body=None):
+    """Sends an HTTP request with the headers 'headers' (a dict) and the body 'body' (a str
+    or None) and reads the response up to its body. Returns a tuple of the StreamReader to
+    read the body from (see _read_body), the StreamWriter to close when done, the status
+    code, the reason phrase and the response headers (a dict of lower-cased header names to
+    lists of values)."""
+
+    parts = urlparse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    reader, writer = yield From(asyncio.open_connection(parts.hostname, parts.port or 80))
+    try:
+        lines = ['%s %s HTTP/1.1' % (method, path),
+                 'Host: %s' % parts.netloc,
+                 'Connection: close']
+        lines.extend('%s: %s' % (name, value) for name, value in (headers or {}).iteritems())
+        if body is not None:
+            lines.append('Content-Length: %d' % len(body))
+        writer.write('\r\n'.join(lines) + '\r\n\r\n' + (body or ''))
+
+        status_line = yield From(reader.readline())
+        try:
+            version_, code, phrase = (status_line.rstrip('\r\n').split(' ', 2) + [''])[:3]
+            code = int(code)
+        except ValueError:
+            raise HTTPError(0, 'invalid status line %r' % status_line)
+
+        response_headers = {}
+        while True:
+            line = (yield From(reader.readline())).rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            response_headers.setdefault(name.strip().lower(), []).append(value.strip())
+    except:
+        writer.close()
+        raise
+    raise Return((reader, writer, code, phrase, response_headers))
+
+
+@asyncio.coroutine
+def _read_body(reader, code, response_headers, on_data):
+    """Reads the body of a response with the status 'code' and the headers 'response_headers'
+    from 'reader', passing each chunk of it to 'on_data'."""
+
+    if code in (204, 304) or 100 <= code < 200:
+        return
+
+    if 'chunked' in ','.join(response_headers.get('transfer-encoding', [])).lower():
+        while True:
+            size_line = yield From(reader.readline())
+            try:
+                size = int(size_line.split(';')[0].strip(), 16)
+            except ValueError:
+                raise HTTPError(code, 'invalid chunk size %r' % size_line)
+            if size == 0:
+                return
+            try:
+                data = yield From(reader.readexactly(size + 2))
+            except asyncio.IncompleteReadError:
+                raise HTTPError(code, 'connection closed in the middle of the response')
+            on_data(data[:-2])
+    elif 'content-length' in response_headers:
+        remaining = int(response_headers['content-length'][0])
+        while remaining:
+            data = yield From(reader.read(min(remaining, CHUNK_SIZE)))
+            if not data:
+                raise HTTPError(code, 'connection closed %d bytes before the end of the '
+                                      'response' % remaining)
+            remaining -= len(data)
+            on_data(data)
+    else:
+        while True:
+            data = yield From(reader.read(CHUNK_SIZE))
+            if not data:
+                return
+            on_data(data)
+
+
+@asyncio.coroutine
+def http_request(method, url, headers=None, body=None):
+    """Like sstcs.http_request: returns a tuple of the status code, the reason phrase, the
+    response headers (see _send_request) and the body."""
+
+    reader, writer, code, phrase, response_headers = \
+        yield From(_send_request(method, url, headers, body))
+    chunks = []
+    try:
+        yield From(_read_body(reader, code, response_headers, chunks.append))
+    finally:
+        writer.close()
+    raise Return((code, phrase, response_headers, ''.join(chunks)))
+
+
+@asyncio.coroutine
+def get_page(url):
+    """Returns the body at 'url', or raises an HTTPError unless the status is 200."""
+
+    code, phrase, headers_, body = yield From(http_request('GET', url))
+    if code != 200:
+        raise HTTPError(code, phrase)
+    raise Return(body)
+
+
+# SOAP
+
+@asyncio.coroutine
+def _call_action(service, name, kwargs):
+    spec = service.actions.get(name)
+    if spec is None:
+        raise ActionException('TV doesn\'t have action %s' % name, error_code='401')
+
+    headers = {
+        'Content-Type': 'text/xml; charset="utf-8"',
+        'SOAPACTION'  : spec.soap_action,
+    }
+    code, phrase, headers_, body = yield From(
+        http_request('POST', service.control_url, headers,
+                     DirectAction._envelope(spec, kwargs)))
+    raise Return(sstcs._parse_soap_response(name, service.service_type, code, phrase, body))
+
+
+@asyncio.coroutine
+def resolve(service):
+    """Fetches the service description of the DirectService 'service' and rebuilds its
+    ActionTable from it, like DirectService.resolve."""
+
+    if not service.scpd_url:
+        raise DiscoveryException('Can\'t resolve the actions of %r without its service '
+                                 'description URL' % service)
+    LOG.debug('Fetching service description for %r from %s', service, service.scpd_url)
+    scpd = yield From(call_with_policy('get_description',
+                                       lambda: get_page(service.scpd_url)))
+    service.set_scpd(scpd)
+
+
+@asyncio.coroutine
+def call_action(service, name, **kwargs):
+    """Calls the action 'name' of the DirectService 'service' with 'kwargs' as arguments and
+    returns a dict of its out arguments. Like DirectAction.call, resolves the service again
+    and retries once if the TV doesn't know the action."""
+
+    try:
+        result = yield From(_call_action(service, name, kwargs))
+    except ActionException as e:
+        if e.error_code not in UPNP_INVALID_ACTION_ERRORS:
+            raise
+        LOG.info('%s: %s, resolving the service again', service.udn, e)
+        yield From(resolve(service))
+        result = yield From(_call_action(service, name, kwargs))
+    raise Return(result)
+
+
+@asyncio.coroutine
+def get_channel_list_url(service):
+    """Calls GetChannelListURL on 'service' and returns its results."""
+
+    LOG.debug('Calling GetChannelListURL')
+    results = yield From(track(call_with_policy('get_channel_list_url',
+                                                lambda: call_action(service, 'GetChannelListURL')),
+                               'get_channel_list_url'))
+    raise Return(results)
+
+
+# Finding the TV
+
+class SSDPSearchProtocol(asyncio.DatagramProtocol):
+    """Calls 'on_answer' with the headers (see sstcs._ssdp_headers) and the address of each
+    answer to our M-SEARCHs that has a LOCATION."""
+
+    def __init__(self, on_answer):
+        self._on_answer = on_answer
+        self.transport  = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def search(self, host, mx):
+        """Sends an M-SEARCH for opts['devtype'] to 'host' (see sstcs._msearch_request)."""
+
+        try:
+            self.transport.sendto(sstcs._msearch_request(host, mx), (host, SSDP_PORT))
+        except socket.error as e:
+            LOG.debug('Unable to send M-SEARCH to %s: %s', host, e)
+
+    def datagram_received(self, datagram, address):
+        headers = sstcs._ssdp_headers(datagram)
+        if headers.get('location'):
+            LOG.debug('%s:%d answered M-SEARCH with location %s', address[0], address[1],
+                      headers['location'])
+            self._on_answer(headers, address)
+
+    def error_received(self, exc):
+        LOG.debug('SSDP socket error: %s', exc)
+
+
+@asyncio.coroutine
+def _search_socket(on_answer):
+    loop = asyncio.get_event_loop()
+    transport_, proto = yield From(loop.create_datagram_endpoint(
+        lambda: SSDPSearchProtocol(on_answer), local_addr=('0.0.0.0', 0)))
+    raise Return(proto)
+
+
+@asyncio.coroutine
+def search_host(host):
+    """Asks 'host' for its device description location with unicast M-SEARCHs, like
+    sstcs.search_host. Returns the location."""
+
+    location = yield From(call_with_policy('search_host', lambda: _search_host(host)))
+    raise Return(location)
+
+
+@asyncio.coroutine
+def _search_host(host):
+    """One attempt of search_host: M-SEARCHs 'host' until it answers."""
+
+    found = asyncio.Future()
+    def _answered(headers, address_):
+        if not found.done():
+            found.set_result(headers['location'])
+    proto = yield From(_search_socket(_answered))
+
+    # UDP may get lost, so ask again after 0.1, 0.3, 0.7, ... seconds.
+    @asyncio.coroutine
+    def _search():
+        delay_s = 0.1
+        while True:
+            proto.search(host, 1)
+            yield From(asyncio.sleep(delay_s))
+            delay_s *= 2
+    searching = asyncio.ensure_future(_search())
+    try:
+        location = yield From(found)
+    finally:
+        searching.cancel()
+        proto.transport.close()
+    raise Return(location)
+
+
+@asyncio.coroutine
+def describe(location):
+    """Fetches the device description at 'location' and returns the TV's MainTVAgent2 service
+    as a DirectService. Raises a DiscoveryException if it doesn't have one."""
+
+    LOG.debug('Fetching device description from %s', location)
+    description = yield From(call_with_policy('get_description', lambda: get_page(location)))
+    udn, service_type, control_url, scpd_url, event_sub_url = \
+        sstcs._parse_device_description(description, location)
+    raise Return(DirectService(udn, service_type, control_url, scpd_url, event_sub_url))
+
+
+@asyncio.coroutine
+def discover(device_cache, hosts):
+    """Discovers the TV with SSDP M-SEARCHs for opts['devtype'] to the multicast group and
+    the addresses in 'hosts', sent as DiscoveryScheduler would send them, and returns its
+    MainTVAgent2 service as a DirectService. It's remembered in 'device_cache', unless that's
+    None. Raises a DiscoveryException if we don't discover the TV within
+    opts['discovery_deadline_s'] seconds."""
+
+    sstcs.TIMINGS.set('discovery', 'ssdp')
+    started = time.time()
+    state = {'first_answer_s': None, 'searches': 0}
+    found = asyncio.Future()
+    described = set()
+
+    @asyncio.coroutine
+    def _describe(location):
+        try:
+            service = yield From(describe(location))
+        except (ContextException, HTTPError, EnvironmentError) as e:
+            LOG.debug('Ignoring device at %s: %s', location, e)
+            return
+        if not found.done():
+            found.set_result((service, location))
+
+    def _answered(headers, address_):
+        if state['first_answer_s'] is None and headers.get('st') == opts['devtype']:
+            state['first_answer_s'] = time.time() - started
+            LOG.debug('%s answered after %.2f seconds', headers.get('usn', 'TV'),
+                      state['first_answer_s'])
+        if headers['location'] not in described:
+            described.add(headers['location'])
+            asyncio.ensure_future(_describe(headers['location']))
+
+    proto = yield From(_search_socket(_answered))
+    if hosts:
+        LOG.debug('Also searching at %s', ', '.join(hosts))
+
+    @asyncio.coroutine
+    def _search():
+        n = 0
+        while True:
+            LOG.debug('Sending M-SEARCH #%d after %.2f seconds', n + 1, time.time() - started)
+            for host in [SSDP_ADDR] + hosts:
+                proto.search(host, DiscoveryScheduler.MX)
+            state['searches'] += 1
+            yield From(asyncio.sleep(DiscoveryScheduler.delay_s(
+                n, state['first_answer_s'] is not None)))
+            n += 1
+    searching = asyncio.ensure_future(_search())
+
+    try:
+        service, location = yield From(asyncio.wait_for(found, opts['discovery_deadline_s']))
+    except asyncio.TimeoutError:
+        sstcs.TIMINGS.set('msearches', state['searches'])
+        raise DiscoveryException('Did not discover TV after %.1f seconds' %
+                                 (time.time() - started))
+    finally:
+        searching.cancel()
+        proto.transport.close()
+
+    elapsed_s = time.time() - started
+    LOG.info('Discovered %s after %.2f seconds and %d M-SEARCHs', service.udn, elapsed_s,
+             state['searches'])
+    sstcs.TIMINGS.set('time_to_discovery_s', round(elapsed_s, 3))
+    sstcs.TIMINGS.set('msearches', state['searches'])
+    if state['first_answer_s'] is not None:
+        sstcs.TIMINGS.set('time_to_first_answer_s', round(state['first_answer_s'], 3))
+
+    LOG.debug('Found matching service %r', service)
+    if device_cache:
+        device_cache.put(opts['devtype'], service.udn, location, service.service_type,
+                         service.control_url, service.scpd_url, service.event_sub_url)
+    raise Return(service)
+
+
+@asyncio.coroutine
+def _find_direct():
+    sstcs.TIMINGS.set('discovery', 'direct')
+    if opts['location']:
+        location = opts['location']
+    else:
+        location = yield From(search_host(opts['host']))
+
+    service = yield From(describe(location))
+    # A cached service description has been checked for the actions we need already.
+    if not service.described:
+        yield From(resolve(service))
+    raise Return(service)
+
+
+@asyncio.coroutine
+def find_tv():
+    """Finds the TV like sstcs.find_tv: straight away if the user told us where it is, or at
+    the cached address if we know one, or else (or with the cache disabled) discovering it.
+    Returns a tuple of the TV's MainTVAgent2 service and the results of GetChannelListURL."""
+
+    if opts['location'] or opts['host']:
+        service = yield From(_find_direct())
+    elif not opts['use_cache']:
+        service = yield From(discover(None, []))
+    else:
+        device_cache = DeviceCache(opts['cache_dir'], opts['cache_ttl_s'])
+        if opts['flush_cache']:
+            device_cache.invalidate()
+            opts['flush_cache'] = False
+
+        entry = device_cache.get(opts['devtype'])
+        if not entry:
+            service = yield From(discover(device_cache, device_cache.addresses()))
+        else:
+            sstcs.TIMINGS.set('discovery', 'cache')
+            service = DirectService(entry['udn'], entry['service_type'], entry['control_url'],
+                                    entry.get('scpd_url'), entry.get('event_sub_url'))
+            LOG.debug('Using cached service %r', service)
+            try:
+                results = yield From(get_channel_list_url(service))
+            except (ContextException, HTTPError, EnvironmentError) as e:
+                LOG.info('Cached TV %s did not answer (%s), discovering it again',
+                         entry['udn'], e)
+                device_cache.invalidate(opts['devtype'])
+                # The TV may just have a new address, but it's still the best guess.
+                service = yield From(discover(
+                    device_cache, [urlparse.urlsplit(entry['location']).hostname]))
+            else:
+                raise Return((service, results))
+
+    results = yield From(get_channel_list_url(service))
+    raise Return((service, results))
+
+
+# The channel list
+
+@asyncio.coroutine
+def _request_channel_list(url, headers, on_channel=None, keep_channels=True, keep_data=False):
+    """GETs the channel list at 'url' and parses it while it downloads, like
+    sstcs._request_channel_list. Returns a tuple of the list of Channels, the raw channel list
+    and the response headers, or (None, None, headers) for '304 Not Modified'."""
+
+    first_channel = sstcs.TIMINGS.span('first_channel')
+    def _on_channel(channel):
+        first_channel.finish()
+        if on_channel:
+            on_channel(channel)
+
+    reader, writer, code, phrase, response_headers = \
+        yield From(_send_request('GET', url, headers))
+    try:
+        if code == 304:
+            raise Return((None, None, response_headers))
+        if code != 200:
+            raise HTTPError(code, phrase)
+
+        length = response_headers.get('content-length')
+        receiver = ChannelListReceiver(None, _on_channel, int(length[0]) if length else None,
+                                       keep_channels, keep_data)
+        yield From(_read_body(reader, code, response_headers, receiver.feed))
+        channels, channel_list = receiver.finish()
+    finally:
+        writer.close()
+    raise Return((channels, channel_list, response_headers))
+
+
+@asyncio.coroutine
+def fetch_channel_list(url, udn, cl_type, cache, max_age_s, on_channel=None,
+                       keep_channels=True):
+    """Fetches and parses the channel list at 'url' (or takes it from 'cache'), exactly like
+    sstcs.fetch_channel_list. Returns the list of Channels, or None if 'keep_channels' is
+    false."""
+
+    def _from_cache(entry):
+        channels = cache.load_channels(udn, cl_type, entry)
+        if on_channel:
+            for channel in channels:
+                on_channel(channel)
+        return channels if keep_channels else None
+
+    hedged = sstcs.HedgedChannels(on_channel)
+
+    if not cache:
+        channels, channel_list_, response_headers_ = yield From(track(
+            call_with_policy('fetch_channel_list', lambda: _request_channel_list(
+                url, {}, hedged.for_attempt(), keep_channels)),
+            'fetch_channel_list', cache='off'))
+        raise Return(channels)
+
+    entry, headers = sstcs._check_channel_list_cache(cache, udn, cl_type, max_age_s)
+    if headers is None:
+        raise Return(_from_cache(entry))
+
+    # The cache needs the whole list anyway, so it's kept even if the caller doesn't want it.
+    channels, channel_list, response_headers = yield From(track(
+        call_with_policy('fetch_channel_list', lambda: _request_channel_list(
+            url, headers, hedged.for_attempt(), True, True),
+            sstcs._revalidation_latency_name),
+        'fetch_channel_list', cache='revalidate' if entry else 'miss'))
+    if not sstcs._update_channel_list_cache(cache, udn, cl_type, entry, channels, channel_list,
+                                            response_headers):
+        raise Return(_from_cache(entry))
+    raise Return(channels if keep_channels else None)
+
+
+@asyncio.coroutine
+def load_channel_list(service, results, max_age_s):
+    """Returns a tuple of the channel list type and the list of Channels referenced by
+    'results' of GetChannelListURL on 'service', like sstcs.load_channel_list."""
+
+    cl_type = results['ChannelListType']
+    cache   = ChannelListCache(opts['cache_dir']) if opts['use_cache'] else None
+    channels = yield From(fetch_channel_list(results['ChannelListURL'], service.udn, cl_type,
+                                             cache, max_age_s))
+    raise Return((cl_type, channels))
+
+
+# Switching
+
+@asyncio.coroutine
+def verify_switch(service, channel):
+    """Polls GetCurrentMainTVChannel on 'service' until the TV says it's tuned to 'channel',
+    like sstcs.verify_switch. Returns the number of seconds that took."""
+
+    started = time.time()
+    span = sstcs.TIMINGS.span('verify')
+    n = 0
+    try:
+        while True:
+            result = yield From(call_with_policy(
+                'get_current_main_tv_channel',
+                lambda: call_action(service, 'GetCurrentMainTVChannel')))
+            tune_s = time.time() - started
+            if sstcs.is_current_channel(result, channel):
+                break
+            if tune_s >= opts['verify_timeout_s']:
+                raise SwitchException('TV acknowledged switching to %s, but still wasn\'t tuned '
+                                      'to it after %.1f seconds' % (channel.display_string(),
+                                                                    tune_s),
+                                      ['current channel: %s' % result.get('CurrentChannel')])
+            delay_s = VERIFY_POLL_DELAYS_S[min(n, len(VERIFY_POLL_DELAYS_S) - 1)]
+            yield From(asyncio.sleep(min(delay_s, opts['verify_timeout_s'] - tune_s)))
+            n += 1
+    except Exception:
+        span.finish(ok=False)
+        raise
+
+    LOG.info('Tuned to %s %.3f seconds after the TV acknowledged (%d polls)',
+             channel.display_string(), tune_s, n + 1)
+    span.finish(polls=n + 1)
+    sstcs.TIMINGS.set('tune_s', round(tune_s, 3))
+    raise Return(tune_s)
+
+
+@asyncio.coroutine
+def switch_channel(service, cl_type, channel):
+    """Switches the TV 'service' to 'channel' from its channel list of type 'cl_type', trying
+    the channel list types sstcs.switch_channel would try, in the same order, and verifies the
+    switch with opts['verify']. Returns the channel list type that worked or raises a
+    SwitchException."""
+
+    stats = None
+    if service.udn and opts['use_cache']:
+        stats = ChannelListTypeStats(opts['cache_dir'])
+        cl_types = stats.order(service.udn, channel, cl_type)
+    else:
+        cl_types = [cl_type] + CL_TYPE_FALLBACKS
+    channel_xml = channel.as_xml
+
+    LOG.debug('Calling SetMainTVChannel(ChannelListType=%r, SatelliteID=0, Channel=%r)',
+              cl_types[0], channel_xml)
+
+    tried = []
+    try:
+        for try_cl_type in cl_types:
+            if tried:
+                LOG.warning("channel %s not in current channel list, trying with %s",
+                            channel, try_cl_type)
+            tried.append(try_cl_type)
+            result = yield From(track(
+                call_with_policy('set_main_tv_channel', lambda: call_action(
+                    service, 'SetMainTVChannel', ChannelListType=try_cl_type, SatelliteID=0,
+                    Channel=channel_xml)),
+                'set_main_tv_channel', cl_type=try_cl_type, fallback=len(tried) > 1))
+            LOG.debug('set_channel_returned: result=%r, fallbacks=%r, channel=%r', result,
+                      cl_types[len(tried):], channel)
+            if sstcs._check_set_channel_result(result):
+                break
+        else:
+            raise SwitchException('TV doesn\'t know how to switch to %s' % channel)
+    except SwitchException:
+        if stats:
+            stats.record(service.udn, channel, tried, None)
+        raise
+
+    LOG.info('Channel switched.')
+    sstcs.TIMINGS.set('cl_type', try_cl_type)
+    if stats:
+        stats.record(service.udn, channel, tried, try_cl_type)
+    if opts['verify']:
+        yield From(verify_switch(service, channel))
+    raise Return(try_cl_type)
+
+
+# A single run
+
+@asyncio.coroutine
+def got_channel_list(all_channels, cl_type, service, refetch, switched):
+    """Does what sstcs.got_channel_list does with the channel list. Returns False if the
+    list came from the cache without asking the TV ('refetch') and has to be fetched again,
+    True when done."""
+
+    if switched:
+        yield From(switched)
+        raise Return(True)
+
+    if opts['search']:
+        sstcs.print_search_results(all_channels, opts['search'])
+
+    if opts['diff']:
+        old_channels = sstcs.load_channel_list_file(opts['diff'])
+        if old_channels is None:
+            raise Return(True)
+        sstcs.print_diff(old_channels, all_channels)
+
+    if opts['do_list'] or opts['search'] or opts['diff']:
+        raise Return(True)
+
+    # Don't settle for a fuzzy match if the list might just be outdated.
+    channel = sstcs._pick_channel(all_channels, opts['channel'], fuzzy=not refetch)
+
+    if channel is None:
+        if refetch:
+            LOG.info('No channel found in cached channel list, fetching it again')
+            raise Return(False)
+        fatal('No channel found')
+        raise Return(True)
+
+    yield From(switch_channel(service, cl_type, channel))
+    raise Return(True)
+
+
+@asyncio.coroutine
+def got_channel_list_url(service, results):
+    """Does what sstcs.got_channel_list_url does: fetches the channel list, printing it as it
+    comes in with opts['do_list'] and switching as soon as an exact match is there."""
+
+    LOG.debug('got_channel_list_url: %r', results)
+
+    cl_type = results['ChannelListType']
+    url     = results['ChannelListURL']
+
+    LOG.debug('Current cl_type is %s, URL is %s. Fetching URL.',
+        cl_type, url)
+
+    udn   = service.udn
+    cache = ChannelListCache(opts['cache_dir']) if opts['use_cache'] else None
+
+    switch_now = not opts['do_list'] and not opts['search'] and not opts['diff'] and \
+        ChannelIndex.matcher(opts['channel'])
+
+    max_age_s = opts['list_max_age_s']
+    while True:
+        refetch = False
+        if cache:
+            age_s = cache.age_s(udn, cl_type)
+            refetch = age_s is not None and age_s <= max_age_s
+
+        state = {}
+        def _on_channel(channel):
+            if opts['do_list']:
+                print channel.display_string()
+            elif switch_now and 'switched' not in state and switch_now(channel):
+                LOG.debug('Found %s, switching while the channel list is still loading',
+                          channel.display_string())
+                state['switched'] = asyncio.ensure_future(
+                    switch_channel(service, cl_type, channel))
+
+        try:
+            channels = yield From(fetch_channel_list(
+                url, udn, cl_type, cache, max_age_s,
+                _on_channel if opts['do_list'] or switch_now else None,
+                keep_channels=not opts['do_list'] or bool(opts['diff'])))
+        except Exception as e:
+            if 'switched' in state:
+                # The switch doesn't need the rest of the list, so it decides how we exit.
+                LOG.warning('Unable to load the rest of the channel list: %s', e)
+                yield From(got_channel_list(None, cl_type, service, refetch, state['switched']))
+                return
+            if isinstance(e, ParseException):
+                fatal('Unable to parse channel list', e)
+            else:
+                fatal('Unable to fetch channel list', e)
+            return
+
+        done = yield From(got_channel_list(channels, cl_type, service, refetch,
+                                           state.get('switched')))
+        if done:
+            return
+        max_age_s = -1
+
+
+@asyncio.coroutine
+def run():
+    """A single run of sstcs: finds the TV, then lists, searches, diffs or switches according
+    to opts. Errors end up in sstcs.fatal, as with Twisted."""
+
+    try:
+        service, results = yield From(track(find_tv(), 'find_tv'))
+        yield From(got_channel_list_url(service, results))
+    except ContextException as e:
+        fatal(str(e))
+    except Exception:
+        fatal('Unexpected error', traceback.format_exc())
+
+
+def main():
+    """Runs run() on the event loop, see sstcs.run_asyncio."""
+
+    loop = asyncio.get_event_loop()
+    monitor = None
+    if opts['lag_threshold_s']:
+        monitor = sstcs.LagMonitor(opts['lag_threshold_s'], loop.call_later)
+        monitor.start()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        if monitor:
+            monitor.stop()
+        loop.close()
+
+
+if __name__ == '__main__':
+    sys.stderr.write('Use sstcs.py --engine=asyncio to run this.\n')
+    sys.exit(1)
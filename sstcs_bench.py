@@ -0,0 +1,348 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Benchmarks for sstcs' hot paths. Generates synthetic channel lists in the format the TV
+serves and measures how fast sstcs parses, indexes, searches, diffs and renders them, and how fast
+it formats log records.
+
+Usage: sstcs_bench.py [-s SIZES] [-r REPEAT] [-l TITLE_LEN] [-j FILE] [-t FILE] [-b NAMES]
+
+    -s, --sizes       Comma-separated list of channel list sizes (number of entries) to
+                      benchmark. The channel count in the list header is 16 bits, so 65535 is
+                      the maximum. Default: 1000,10000,65535
+    -r, --repeat      How often to run each benchmark, the best run is reported. Default: 3
+    -l, --title-len   Length of the generated channel titles in bytes of UTF-8, at most 100.
+                      Default: 20
+    -j, --json        Also write the results as JSON to FILE ('-' for stdout, which moves the
+                      table of results to stderr).
+    -t, --thresholds  Check the results against the thresholds in the JSON file FILE, which
+                      maps benchmark names to the maximum number of microseconds per item,
+                      and exit with 1 if any benchmark is slower. A key of the form
+                      NAME@ENTRIES overrides the threshold for lists of that size.
+    -b, --benchmarks  Comma-separated list of benchmarks to run. Default: all of them.
+"""
+
+import getopt
+import json
+import logging
+import platform
+from struct import pack, unpack
+import sys
+import time
+
+import sstcs
+
+
+# Words to build channel titles from, with some non-ASCII characters thrown in so decoding
+# has something to do.
+TITLE_WORDS = u'Das Erste ZDF arte Sport Nachrichten Bayerisches Fernsehen Süd Österreich ' \
+              u'Kinderkanal Télévision Русский 日本 HD'.split(' ')
+
+
+def generate_title(i, title_len):
+    """Returns a UTF-8 channel title for the i-th channel of at most 'title_len' bytes."""
+
+    words = [u'%d' % i]
+    while len(u' '.join(words).encode('utf-8')) < title_len:
+        words.append(TITLE_WORDS[(i + len(words)) % len(TITLE_WORDS)])
+    # Cut at title_len bytes without leaving half a character behind.
+    return u' '.join(words).encode('utf-8')[:title_len].decode('utf-8', 'ignore').encode('utf-8')
+
+
+def generate_channel_list(num_channels, title_len=20):
+    """Returns a valid binary channel list with 'num_channels' entries with titles of
+    'title_len' bytes, see sstcs._parse_channel_list for the format."""
+
+    if not 0 < num_channels <= 0xffff:
+        raise ValueError('channel lists have 1 to 65535 entries')
+    if not 0 <= title_len <= 100:
+        raise ValueError('titles have 0 to 100 bytes')
+
+    entries = []
+    for i in xrange(num_channels):
+        title = generate_title(i, title_len)
+        entries.append(pack('<6H4s6xH100s', 4 if i % 2 else 3, i, 0, i % 1000, i, 0xffff,
+                            '%d' % (i % 10000), len(title), title))
+    return pack('<HH', 0, num_channels) + ''.join(entries)
+
+
+class LegacyChannel(object):
+    """What sstcs.Channel used to be: a plain object with all fields decoded eagerly."""
+    pass
+
+def _getint(buf, offset):
+    x = unpack('<H', buf[offset:offset+2])
+    return x[0]
+
+def legacy_parse_channel_list(channel_list):
+    """The per-field parser sstcs used before _parse_channel_list decoded entries in bulk: it
+    slices out every entry, unpacks each field from a slice of its own and decodes the title
+    right away. Validation is the same as in sstcs, so the comparison is fair."""
+
+    channels = []
+    for pos in xrange(4, len(channel_list), 124):
+        buf = channel_list[pos:pos+124]
+        channel = LegacyChannel()
+
+        t = _getint(buf, 0)
+        if t == 4:
+            channel.ch_type = 'CDTV'
+        elif t == 3:
+            channel.ch_type = 'CATV'
+        else:
+            raise sstcs.ParseException('Unknown channel type %d' % t)
+
+        channel.major_ch = _getint(buf, 2)
+        channel.minor_ch = _getint(buf, 4)
+        channel.ptc      = _getint(buf, 6)
+        channel.prog_num = _getint(buf, 8)
+
+        if _getint(buf, 10) != 0xffff:
+            raise sstcs.ParseException('reserved field mismatch (%04x)' % _getint(buf, 10))
+
+        channel.dispno = buf[12:16].rstrip('\x00')
+
+        title_len = _getint(buf, 22)
+        channel.title = buf[24:24+title_len].decode('utf-8')
+        channels.append(channel)
+    return channels
+
+
+def channel_size(channel):
+    """Returns the number of bytes a parsed channel takes, excluding the (shared) raw channel
+    list, but including its per-instance dict and the decoded strings it holds on to."""
+
+    size = sys.getsizeof(channel)
+    if hasattr(channel, '__dict__'):
+        size += sys.getsizeof(channel.__dict__)
+        size += sum(sys.getsizeof(v) for v in channel.__dict__.itervalues()
+                    if isinstance(v, basestring))
+    return size
+
+
+# Each benchmark is a function taking the generated channel list and returning a tuple of a
+# function to time (called without arguments) and the number of items it processes. Setup
+# happens outside the timed function; if that's impossible, the timed function returns the
+# number of seconds spent on setup, see best_time.
+
+def bench_parse(channel_list):
+    def _parse():
+        sstcs._parse_channel_list(channel_list)
+    return _parse, len(channel_list) / 124
+
+def bench_parse_legacy(channel_list):
+    def _parse():
+        legacy_parse_channel_list(channel_list)
+    return _parse, len(channel_list) / 124
+
+def bench_construct(channel_list):
+    def _construct():
+        for pos in xrange(4, len(channel_list), 124):
+            sstcs.Channel(channel_list, pos)
+    return _construct, len(channel_list) / 124
+
+def bench_index(channel_list):
+    channels = sstcs._parse_channel_list(channel_list)
+    def _index():
+        sstcs.ChannelIndex(channels)
+    return _index, len(channels)
+
+def _sample(channels):
+    return channels[::max(1, len(channels) / 100)]
+
+def bench_lookup(channel_list):
+    channels = sstcs._parse_channel_list(channel_list)
+    index = sstcs.ChannelIndex(channels)
+    queries = ([c.title for c in _sample(channels)] +                           # by title
+               ['%s %s' % (c.ch_type, c.dispno) for c in _sample(channels)])    # by number
+    def _lookup():
+        for query in queries:
+            index.lookup(query)
+    return _lookup, len(queries)
+
+def bench_search(channel_list):
+    channels = sstcs._parse_channel_list(channel_list)
+    index = sstcs.ChannelIndex(channels)
+    # Typos and prefixes, for which we have to go through the trigram index.
+    queries = ([c.title[:-2] + u'xy' for c in _sample(channels)] +
+               [c.title[:len(c.title)/2] for c in _sample(channels)])
+    def _search():
+        for query in queries:
+            index.search(query)
+    return _search, len(queries)
+
+def bench_diff(channel_list):
+    old = sstcs._parse_channel_list(channel_list)
+    # Every other channel renamed, so there's something to report.
+    new = sstcs._parse_channel_list(channel_list)
+    for channel in new[::2]:
+        channel._title = channel.title + u' HD'
+    def _diff():
+        sstcs.diff_channel_lists(old, new)
+    return _diff, len(new)
+
+def bench_as_xml(channel_list):
+    # as_xml is memoised, so it has to be timed on freshly parsed channels. Parsing them is
+    # not what we want to time, though.
+    def _as_xml():
+        start = time.time()
+        channels = sstcs._parse_channel_list(channel_list)
+        parse_s = time.time() - start
+        for channel in channels:
+            channel.as_xml
+        return parse_s
+    return _as_xml, len(channel_list) / 124
+
+def bench_display_string(channel_list):
+    channels = sstcs._parse_channel_list(channel_list)
+    def _display_string():
+        for channel in channels:
+            channel.display_string()
+    return _display_string, len(channels)
+
+def bench_log_format(channel_list):
+    channels = sstcs._parse_channel_list(channel_list)[:1000]
+    formatter = sstcs.LogFormatter()
+    records = [logging.LogRecord('sstcs', logging.DEBUG, 'sstcs.py', 0, 'Switching to %s\nline 2',
+                                 (c.display_string(),), None) for c in channels]
+    def _format():
+        for record in records:
+            formatter.format(record)
+    return _format, len(records)
+
+BENCHMARKS = [
+    ('parse',          bench_parse),
+    ('parse_legacy',   bench_parse_legacy),
+    ('construct',      bench_construct),
+    ('index',          bench_index),
+    ('lookup',         bench_lookup),
+    ('search',         bench_search),
+    ('diff',           bench_diff),
+    ('as_xml',         bench_as_xml),
+    ('display_string', bench_display_string),
+    ('log_format',     bench_log_format),
+]
+
+
+def best_time(fn, repeat):
+    """Returns the fastest of 'repeat' runs of fn(), in seconds. If fn returns a number, it's
+    the number of seconds to subtract from its run time."""
+
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        overhead = fn() or 0
+        elapsed = max(time.time() - start - overhead, 0)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run(sizes, repeat, title_len, names, out=sys.stdout):
+    """Runs the benchmarks 'names' on channel lists of each size in 'sizes', printing a table
+    of the results to the file 'out', and returns a list of result dicts."""
+
+    results = []
+    print >>out, '%-16s %8s %8s %12s %14s' % ('benchmark', 'entries', 'items', 'us/item', 'items/s')
+    for size in sizes:
+        channel_list = generate_channel_list(size, title_len)
+        for name, benchmark in BENCHMARKS:
+            if name not in names:
+                continue
+            fn, items = benchmark(channel_list)
+            seconds = best_time(fn, repeat)
+            result = {
+                'benchmark'  : name,
+                'entries'    : size,
+                'items'      : items,
+                'seconds'    : seconds,
+                'us_per_item': seconds * 1e6 / items,
+            }
+            results.append(result)
+            print >>out, '%-16s %8d %8d %12.3f %14.0f' % (
+                name, size, items, result['us_per_item'],
+                items / seconds if seconds else float('inf'))
+
+    if 'parse' in names:
+        channel_list = generate_channel_list(1, title_len)
+        legacy     = channel_size(legacy_parse_channel_list(channel_list)[0])
+        sstcs_size = channel_size(sstcs._parse_channel_list(channel_list)[0])
+        print >>out, 'bytes per parsed channel: %d (per-field parser: %d)' % (sstcs_size, legacy)
+
+    return results
+
+
+def check_thresholds(results, thresholds):
+    """Returns a list of messages for each result slower than its threshold."""
+
+    violations = []
+    for result in results:
+        limit = thresholds.get('%s@%d' % (result['benchmark'], result['entries']),
+                               thresholds.get(result['benchmark']))
+        if limit is not None and result['us_per_item'] > limit:
+            violations.append('%s on %d entries: %.3f us/item, threshold is %.3f us/item' %
+                              (result['benchmark'], result['entries'], result['us_per_item'],
+                               limit))
+    return violations
+
+
+def main():
+    try:
+        gopts, rest_ = getopt.getopt(sys.argv[1:], "s:r:l:j:t:b:",
+                                     ["sizes=", "repeat=", "title-len=", "json=", "thresholds=",
+                                      "benchmarks="])
+    except getopt.GetoptError as err:
+        print str(err)
+        sys.exit(1)
+
+    sizes      = [1000, 10000, 65535]
+    repeat     = 3
+    title_len  = 20
+    json_file  = None
+    thresholds = None
+    names      = [name for name, _ in BENCHMARKS]
+    for o, a in gopts:
+        if o in ['-s', '--sizes']:
+            sizes = [int(size) for size in a.split(',')]
+        elif o in ['-r', '--repeat']:
+            repeat = int(a)
+        elif o in ['-l', '--title-len']:
+            title_len = int(a)
+        elif o in ['-j', '--json']:
+            json_file = a
+        elif o in ['-t', '--thresholds']:
+            with open(a) as f:
+                thresholds = json.load(f)
+        elif o in ['-b', '--benchmarks']:
+            names = a.split(',')
+
+    # sstcs logs, so it needs a logger, but we don't want to benchmark logging (except for
+    # log_format, which doesn't emit anything).
+    sstcs.LOG = logging.getLogger('sstcs')
+    sstcs.LOG.setLevel(logging.WARNING)
+
+    results = run(sizes, repeat, title_len, names,
+                  sys.stderr if json_file == '-' else sys.stdout)
+
+    violations = check_thresholds(results, thresholds) if thresholds else []
+    if json_file:
+        report = json.dumps({
+            'python'    : platform.python_version(),
+            'platform'  : platform.platform(),
+            'title_len' : title_len,
+            'repeat'    : repeat,
+            'results'   : results,
+            'violations': violations,
+        }, indent=2, sort_keys=True)
+        if json_file == '-':
+            print report
+        else:
+            with open(json_file, 'w') as f:
+                f.write(report + '\n')
+
+    for violation in violations:
+        sys.stderr.write('REGRESSION: %s\n' % violation)
+    if violations:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,726 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""A simulator of Samsung TVs, so sstcs can be tested without one. Each simulated TV answers
+SSDP M-SEARCHs, serves a MainTVServer2 device description and the MainTVAgent2 service
+description, implements GetChannelListURL, SetMainTVChannel and GetCurrentMainTVChannel,
+serves generated channel lists (see sstcs_bench.generate_channel_list) and sends events to
+subscribers when its current channel list changes. Latency, packet loss and the channel list
+size are configurable, so discovery, switching, fallbacks and throughput can be load-tested
+on one machine, for example:
+
+    sstcs_sim.py -n 50 -A -a 127.0.1.1 --latency=0.05 --jitter=0.1 --loss=0.05 &
+    sstcs.py --tv=127.0.1.1 --tv=127.0.1.2 ... -c 'CDTV 1'
+
+Usage: sstcs_sim.py [-n TVS] [-a ADDRESS] [-p PORT] [-A] [-s ENTRIES] [-t TYPE] [--latency=S]
+                    [--jitter=S] [--loss=P] [--tune-time=S] [--list-change=S] [--seed=N]
+                    [--no-ssdp] [-v]
+
+    -n, --tvs         Number of TVs to simulate. Default: 1
+    -a, --address     Address the TVs listen on and announce. Default: 127.0.0.1
+    -p, --port        HTTP port of the first TV, the others get the following ones.
+                      Default: 18000
+    -A, --spread      Put each TV on an address of its own (ADDRESS, ADDRESS+1, ...), all on
+                      PORT, like on a real network, so M-SEARCHs sent to one (sstcs --host or
+                      --tv) are only answered by that TV. All of 127.0.0.0/8 is loopback on
+                      Linux, so this works without any network setup.
+    -s, --size        Number of entries in the full channel list, at most 65535. Default: 1000
+    -t, --list-type   Channel list type GetChannelListURL returns (the current one), see
+                      CHANNEL_LIST_TYPES. Default: 0x11
+    --latency         Seconds to wait before answering an M-SEARCH or HTTP request.
+                      Default: 0
+    --jitter          Up to this many more seconds to wait, uniformly distributed. Default: 0
+    --loss            Probability of dropping an M-SEARCH or HTTP request. Dropped HTTP
+                      requests are never answered; the connection stays open until the client
+                      gives up. Default: 0
+    --tune-time       Seconds after SetMainTVChannel until GetCurrentMainTVChannel reports
+                      the new channel. Default: 0.3
+    --list-change     Every this many seconds, each TV switches its current channel list to
+                      the next type in CHANNEL_LIST_TYPES, as if someone used the TV's menu,
+                      and sends an event to its subscribers. Default: never
+    --seed            Seed for latency and loss; each TV has its own random generator.
+                      Default: 0
+    --no-ssdp         Don't answer M-SEARCHs (for sstcs --location only).
+    -v, --verbose     Log every request.
+
+The SSDP responder binds port 1900, so it can't run next to another one (like minissdpd).
+When stopped, it prints how many requests of each kind every TV got.
+"""
+
+import BaseHTTPServer
+import collections
+import getopt
+import httplib
+import logging
+import random
+import select
+import signal
+import socket
+import SocketServer
+from struct import pack, unpack
+import sys
+import threading
+import time
+import urlparse
+
+from xml.etree import cElementTree as ElementTree
+from xml.sax.saxutils import escape
+
+import sstcs
+from sstcs_bench import generate_channel_list
+
+
+DEVICE_TYPE  = 'urn:samsung.com:device:MainTVServer2:1'
+SERVICE_TYPE = 'urn:samsung.com:service:MainTVAgent2:1'
+
+# The channel lists a simulated TV has, as channel list type -> every how many entries of the
+# full list are in it. All generated channels are TV channels, so 0x03 (TV) is the full list,
+# too. Favourites 1 (0x11) is a third of it. Every other type is empty. Like a real TV,
+# GetChannelListURL returns the URL of the full list but the type of the current one (see
+# --list-type), and SetMainTVChannel answers NOTOK_InvalidCh for channels that aren't in the
+# list of the type it's called with, so with the default type, switching to two thirds of the
+# channels takes falling back to other types (see sstcs.CL_TYPE_FALLBACKS).
+CHANNEL_LIST_TYPES = [
+    ('0x01', 1),
+    ('0x03', 1),
+    ('0x11', 3),
+]
+
+DEVICE_DESCRIPTION = '''<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <device>
+    <deviceType>%(device_type)s</deviceType>
+    <friendlyName>[TV] sstcs_sim %(index)d</friendlyName>
+    <manufacturer>Samsung Electronics</manufacturer>
+    <modelName>sstcs_sim</modelName>
+    <UDN>%(udn)s</UDN>
+    <serviceList>
+      <service>
+        <serviceType>%(service_type)s</serviceType>
+        <serviceId>%(service_id)s</serviceId>
+        <controlURL>/control/MainTVAgent2</controlURL>
+        <eventSubURL>/event/MainTVAgent2</eventSubURL>
+        <SCPDURL>/MainTVAgent2.xml</SCPDURL>
+      </service>
+    </serviceList>
+  </device>
+</root>
+'''
+
+# Action name -> (in arguments, out arguments), as in the real MainTVAgent2 (minus the actions
+# sstcs doesn't use).
+ACTIONS = collections.OrderedDict([
+    ('GetChannelListURL', ((), ('Result', 'ChannelListVersion', 'SupportChannelList',
+                                'ChannelListURL', 'ChannelListType', 'SatelliteID'))),
+    ('SetMainTVChannel', (('ChannelListType', 'SatelliteID', 'Channel'), ('Result',))),
+    ('GetCurrentMainTVChannel', ((), ('Result', 'CurrentChannel'))),
+])
+
+# The state variables a simulated TV sends events for.
+EVENTED_VARIABLES = ['ChannelListType', 'ChannelListVersion']
+
+# Longest subscription we grant, in seconds.
+MAX_SUBSCRIPTION_S = 1800
+
+def service_description():
+    """Returns the MainTVAgent2 service description for ACTIONS."""
+
+    actions = []
+    for name, (in_args, out_args) in ACTIONS.iteritems():
+        arguments = ''.join(
+            '<argument><name>%s</name><direction>%s</direction>'
+            '<relatedStateVariable>A_ARG_TYPE_%s</relatedStateVariable></argument>' %
+            (arg, direction, arg)
+            for args, direction in [(in_args, 'in'), (out_args, 'out')] for arg in args)
+        actions.append('<action><name>%s</name><argumentList>%s</argumentList></action>' %
+                       (name, arguments))
+    variables = sorted(set(arg for in_args, out_args in ACTIONS.itervalues()
+                           for arg in in_args + out_args))
+    variables = ['A_ARG_TYPE_%s' % variable for variable in variables] + EVENTED_VARIABLES
+    return ('<?xml version="1.0"?>\n'
+            '<scpd xmlns="urn:schemas-upnp-org:service-1-0">'
+            '<specVersion><major>1</major><minor>0</minor></specVersion>'
+            '<actionList>%s</actionList><serviceStateTable>%s</serviceStateTable></scpd>\n' %
+            (''.join(actions),
+             ''.join('<stateVariable sendEvents="%s"><name>%s</name>'
+                     '<dataType>string</dataType></stateVariable>' %
+                     ('yes' if variable in EVENTED_VARIABLES else 'no', variable)
+                     for variable in variables)))
+
+
+def channel_key(ch_type, major_ch, minor_ch, ptc, prog_num):
+    """Returns what identifies a channel to SetMainTVChannel."""
+
+    return (ch_type, int(major_ch), int(minor_ch), int(ptc), int(prog_num))
+
+
+class ChannelLists(object):
+    """The channel lists of the simulated TVs, see CHANNEL_LIST_TYPES. All TVs have the same
+    ones, so they're only generated once."""
+
+    def __init__(self, size):
+        full = generate_channel_list(size)
+        entries = [full[pos:pos+124] for pos in xrange(4, len(full), 124)]
+
+        self.lists    = {}
+        self.channels = {}
+        for cl_type, every in CHANNEL_LIST_TYPES:
+            channel_list = pack('<HH', 0, len(entries[::every])) + ''.join(entries[::every])
+            self.lists[cl_type] = channel_list
+            self.channels[cl_type] = frozenset(
+                channel_key(c.ch_type, c.major_ch, c.minor_ch, c.ptc, c.prog_num)
+                for c in sstcs._parse_channel_list(channel_list))
+        self.first = sstcs._parse_channel_list(full)[0].as_xml
+
+
+class UPnPError(Exception):
+    """An error to answer a SOAP request with, see UPnP Device Architecture 1.0, 3.2.2."""
+
+    def __init__(self, code, description):
+        super(UPnPError, self).__init__(description)
+        self.code = code
+
+
+class SimulatedTV(object):
+    """The state of a simulated TV: its channel lists, the channel it's tuned to and what it
+    has been asked so far. Requests come from many threads, so state changes hold the lock."""
+
+    def __init__(self, index, address, port, channel_lists, list_type, config):
+        self.index    = index
+        self.address  = address
+        self.port     = port
+        self.udn      = 'uuid:0f5c5b3e-5353-4354-8353-%012x' % index
+        self.location = 'http://%s:%d/desc.xml' % (address, port)
+        self.description = DEVICE_DESCRIPTION % {
+            'device_type' : DEVICE_TYPE,
+            'service_type': SERVICE_TYPE,
+            'service_id'  : sstcs.MAIN_TV_AGENT_SERVICE_ID,
+            'udn'         : self.udn,
+            'index'       : index,
+        }
+        self.channel_lists = channel_lists
+        self.list_type    = list_type
+        self.list_version = 1
+        self.config       = config
+        self.counts       = collections.Counter()
+
+        self._random  = random.Random(config['seed'] + index)
+        self._lock    = threading.Lock()
+        self._current = channel_lists.first
+        self._tuning  = None  # (when, channel XML) of the channel we're switching to
+        self._subscriptions = {}  # SID -> [callback URL, expiry time, next SEQ]
+        self._next_sid      = 0
+
+    def count(self, what):
+        with self._lock:
+            self.counts[what] += 1
+
+    def delay(self):
+        """Returns how many seconds to wait before answering, or None to drop the request."""
+
+        with self._lock:
+            if self._random.random() < self.config['loss']:
+                self.counts['dropped'] += 1
+                return None
+            return self.config['latency_s'] + self._random.uniform(0, self.config['jitter_s'])
+
+    def call(self, action, arguments):
+        """Calls 'action' with the dict 'arguments' and returns a list of out argument name,
+        value tuples, or raises a UPnPError."""
+
+        if action not in ACTIONS:
+            raise UPnPError(401, 'Invalid Action')
+        in_args, _ = ACTIONS[action]
+        if set(arguments) != set(in_args):
+            raise UPnPError(402, 'Invalid Args')
+        self.count(action)
+
+        if action == 'GetChannelListURL':
+            with self._lock:
+                list_type, list_version = self.list_type, self.list_version
+            return [
+                ('Result'            , 'OK'),
+                ('ChannelListVersion', str(list_version)),
+                ('SupportChannelList', '<SupportChannelList/>'),
+                ('ChannelListURL'    , 'http://%s:%d/channellist/0x01' % (self.address,
+                                                                          self.port)),
+                ('ChannelListType'   , list_type),
+                ('SatelliteID'       , '0'),
+            ]
+
+        elif action == 'SetMainTVChannel':
+            try:
+                channel = ElementTree.fromstring(arguments['Channel'].encode('utf-8'))
+                key = channel_key(*[channel.findtext(field) for field in
+                                    ['ChType', 'MajorCh', 'MinorCh', 'PTC', 'ProgNum']])
+            except (SyntaxError, TypeError, ValueError):
+                raise UPnPError(402, 'Invalid Args')
+            if key not in self.channel_lists.channels.get(arguments['ChannelListType'], ()):
+                return [('Result', 'NOTOK_InvalidCh')]
+            with self._lock:
+                self._tuning = (time.time() + self.config['tune_time_s'], arguments['Channel'])
+            return [('Result', 'OK')]
+
+        else:  # GetCurrentMainTVChannel
+            with self._lock:
+                if self._tuning and self._tuning[0] <= time.time():
+                    self._current = self._tuning[1]
+                    self._tuning  = None
+                return [('Result', 'OK'), ('CurrentChannel', self._current)]
+
+    def subscribe(self, callback, timeout_s):
+        """Subscribes 'callback' (a URL) to events for 'timeout_s' seconds and returns the
+        SID. The initial event is sent with notify, once the SID has been answered."""
+
+        with self._lock:
+            self._next_sid += 1
+            sid = 'uuid:5353-%d-%d' % (self.index, self._next_sid)
+            self._subscriptions[sid] = [callback, time.time() + timeout_s, 0]
+        self.count('SUBSCRIBE')
+        return sid
+
+    def renew(self, sid, timeout_s):
+        """Renews the subscription 'sid'. Returns False if there's no such subscription."""
+
+        with self._lock:
+            subscription = self._subscriptions.get(sid)
+            if subscription is None or subscription[1] < time.time():
+                self._subscriptions.pop(sid, None)
+                return False
+            subscription[1] = time.time() + timeout_s
+        self.count('renewal')
+        return True
+
+    def unsubscribe(self, sid):
+        """Cancels the subscription 'sid'. Returns False if there's no such subscription."""
+
+        with self._lock:
+            return self._subscriptions.pop(sid, None) is not None
+
+    def change_list(self):
+        """Switches to the next channel list type and tells the subscribers."""
+
+        types = [cl_type for cl_type, _ in CHANNEL_LIST_TYPES]
+        with self._lock:
+            self.list_type = types[(types.index(self.list_type) + 1) % len(types)]
+            self.list_version += 1
+        LOG.debug('TV %d: current channel list is now %s', self.index, self.list_type)
+        self.notify()
+
+    def notify(self, sids=None):
+        """Sends an event with the current values of EVENTED_VARIABLES to the subscriptions
+        'sids', or to all of them, each from a thread of its own."""
+
+        with self._lock:
+            body = ('<?xml version="1.0"?><e:propertyset xmlns:e="%s">%s</e:propertyset>' %
+                    (sstcs.UPNP_EVENT_NS, ''.join(
+                        '<e:property><%s>%s</%s></e:property>' % (name, escape(value), name)
+                        for name, value in [('ChannelListType', self.list_type),
+                                            ('ChannelListVersion', str(self.list_version))])))
+            now = time.time()
+            events = []
+            for sid, subscription in self._subscriptions.items():
+                if subscription[1] < now:
+                    del self._subscriptions[sid]
+                elif sids is None or sid in sids:
+                    events.append((sid, subscription[0], subscription[2]))
+                    # SEQ wraps around to 1, 0 is only for the initial event.
+                    subscription[2] = subscription[2] % 0xffffffff + 1
+        for sid, callback, seq in events:
+            thread = threading.Thread(target=self._send_event, args=(sid, callback, seq, body))
+            thread.daemon = True
+            thread.start()
+
+    def _send_event(self, sid, callback, seq, body):
+        url = urlparse.urlsplit(callback)
+        try:
+            connection = httplib.HTTPConnection(url.hostname, url.port or 80, timeout=5)
+            connection.request('NOTIFY', url.path or '/', body, {
+                'Content-Type': 'text/xml; charset="utf-8"',
+                'NT'          : 'upnp:event',
+                'NTS'         : 'upnp:propchange',
+                'SID'         : sid,
+                'SEQ'         : str(seq),
+            })
+            status = connection.getresponse().status
+            connection.close()
+        except (socket.error, httplib.HTTPException) as e:
+            LOG.debug('TV %d: unable to send event %d to %s: %s', self.index, seq, callback, e)
+            return
+        self.count('NOTIFY')
+        if status == 412:
+            self.unsubscribe(sid)
+
+
+def _soap_envelope(body):
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<s:Envelope xmlns:s="%s" s:encodingStyle="%s"><s:Body>%s</s:Body></s:Envelope>' %
+            (sstcs.SOAP_ENVELOPE_NS, 'http://schemas.xmlsoap.org/soap/encoding/', body))
+
+def soap_response(action, results):
+    return _soap_envelope('<u:%sResponse xmlns:u="%s">%s</u:%sResponse>' % (
+        action, SERVICE_TYPE,
+        ''.join('<%s>%s</%s>' % (name, escape(value), name) for name, value in results),
+        action))
+
+def soap_fault(error):
+    return _soap_envelope(
+        '<s:Fault><faultcode>s:Client</faultcode><faultstring>UPnPError</faultstring><detail>'
+        '<UPnPError xmlns="%s"><errorCode>%d</errorCode><errorDescription>%s</errorDescription>'
+        '</UPnPError></detail></s:Fault>' % (sstcs.UPNP_CONTROL_NS, error.code,
+                                             escape(str(error))))
+
+
+class TVRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves a SimulatedTV (self.server.tv) over HTTP."""
+
+    protocol_version = 'HTTP/1.1'
+    server_version   = 'sstcs_sim/1.0 UPnP/1.0'
+
+    def log_message(self, fmt, *args):
+        LOG.debug('TV %d: %s %s', self.server.tv.index, self.address_string(), fmt % args)
+
+    def _send(self, code, body, content_type='text/xml; charset="utf-8"', headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _delay(self):
+        """Waits as long as the TV is configured to. Returns False if the request is dropped,
+        in which case the connection is held open (and unanswered) until the client closes
+        it."""
+
+        delay_s = self.server.tv.delay()
+        if delay_s is None:
+            self.close_connection = 1
+            try:
+                while self.rfile.read(4096):
+                    pass
+            except socket.error:
+                pass
+            return False
+        time.sleep(delay_s)
+        return True
+
+    def do_GET(self):
+        tv = self.server.tv
+        if not self._delay():
+            return
+
+        if self.path == '/desc.xml':
+            tv.count('description')
+            self._send(200, tv.description)
+        elif self.path == '/MainTVAgent2.xml':
+            tv.count('service description')
+            self._send(200, self.server.scpd)
+        elif self.path.startswith('/channellist/'):
+            tv.count('channel list')
+            channel_list = tv.channel_lists.lists.get(self.path[len('/channellist/'):])
+            if channel_list is None:
+                self._send(404, 'No such channel list\n', 'text/plain')
+                return
+            etag = '"%x-%d"' % (hash(channel_list) & 0xffffffff, len(channel_list))
+            if self.headers.get('If-None-Match') == etag:
+                self._send(304, '', headers=[('ETag', etag)])
+            else:
+                self._send(200, channel_list, 'application/octet-stream', [('ETag', etag)])
+        else:
+            self._send(404, 'Not found\n', 'text/plain')
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        tv = self.server.tv
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self._delay():
+            return
+
+        if self.path != '/control/MainTVAgent2':
+            self._send(404, 'Not found\n', 'text/plain')
+            return
+
+        try:
+            try:
+                envelope = ElementTree.fromstring(body)
+            except SyntaxError:
+                raise UPnPError(402, 'Invalid Args')
+            request = envelope.find('{%s}Body/*' % sstcs.SOAP_ENVELOPE_NS)
+            if request is None or not request.tag.startswith('{%s}' % SERVICE_TYPE):
+                raise UPnPError(401, 'Invalid Action')
+            action = request.tag.split('}', 1)[1]
+            arguments = dict((argument.tag, argument.text or u'') for argument in request)
+            LOG.debug('TV %d: %s(%s)', tv.index, action,
+                      ', '.join('%s=%r' % item for item in sorted(arguments.iteritems())))
+            self._send(200, soap_response(action, tv.call(action, arguments)))
+        except UPnPError as e:
+            tv.count('error %d' % e.code)
+            self._send(500, soap_fault(e))
+
+
+    def do_SUBSCRIBE(self):
+        tv = self.server.tv
+        if not self._delay():
+            return
+        if self.path != '/event/MainTVAgent2':
+            self._send(404, 'Not found\n', 'text/plain')
+            return
+
+        timeout = self.headers.get('TIMEOUT', '')
+        try:
+            timeout_s = min(int(timeout.partition('-')[2]), MAX_SUBSCRIPTION_S)
+        except ValueError:
+            timeout_s = MAX_SUBSCRIPTION_S
+
+        sid = self.headers.get('SID')
+        callback = self.headers.get('CALLBACK', '').strip('<').partition('>')[0]
+        if sid:
+            if not tv.renew(sid, timeout_s):
+                self._send(412, '', 'text/plain')
+                return
+        elif callback and self.headers.get('NT') == 'upnp:event':
+            sid = tv.subscribe(callback, timeout_s)
+        else:
+            self._send(412, '', 'text/plain')
+            return
+        self._send(200, '', 'text/plain', [('SID', sid), ('TIMEOUT', 'Second-%d' % timeout_s)])
+        if not self.headers.get('SID'):
+            tv.notify([sid])
+
+    def do_UNSUBSCRIBE(self):
+        if not self._delay():
+            return
+        ok = self.path == '/event/MainTVAgent2' and \
+            self.server.tv.unsubscribe(self.headers.get('SID'))
+        self._send(200 if ok else 412, '', 'text/plain')
+
+
+class TVServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """The HTTP server of one SimulatedTV."""
+
+    daemon_threads      = True
+    allow_reuse_address = True
+    request_queue_size  = 128
+
+    def __init__(self, tv, scpd):
+        BaseHTTPServer.HTTPServer.__init__(self, (tv.address, tv.port), TVRequestHandler)
+        self.tv   = tv
+        self.scpd = scpd
+
+
+class SSDPResponder(threading.Thread):
+    """Answers M-SEARCHs for the TVs 'tvs': those sent to the multicast group for all of them,
+    and those sent to one of their addresses for the TVs on that address."""
+
+    def __init__(self, tvs):
+        super(SSDPResponder, self).__init__(name='SSDPResponder')
+        self.daemon = True
+
+        self._sockets = {}  # socket -> TVs it answers for
+        sock = self._socket('')
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            socket.inet_aton(sstcs.SSDP_ADDR) + socket.inet_aton('0.0.0.0'))
+        except socket.error as e:
+            LOG.warning('Unable to join the SSDP multicast group, only answering unicast '
+                        'M-SEARCHs: %s', e)
+        self._sockets[sock] = tvs
+
+        by_address = collections.defaultdict(list)
+        for tv in tvs:
+            by_address[tv.address].append(tv)
+        for address, address_tvs in by_address.iteritems():
+            if address not in ['', '0.0.0.0']:
+                self._sockets[self._socket(address)] = address_tvs
+
+    @staticmethod
+    def _socket(address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((address, sstcs.SSDP_PORT))
+        return sock
+
+    @staticmethod
+    def _answer(tv, st):
+        """Returns the answer of 'tv' to a search for 'st', or None if it doesn't match."""
+
+        if st == 'ssdp:all':
+            st = DEVICE_TYPE
+        if st not in ['upnp:rootdevice', DEVICE_TYPE, SERVICE_TYPE, tv.udn]:
+            return None
+        return ('HTTP/1.1 200 OK\r\n'
+                'CACHE-CONTROL: max-age=1800\r\n'
+                'EXT:\r\n'
+                'LOCATION: %s\r\n'
+                'SERVER: Linux/3.0 UPnP/1.0 sstcs_sim/1.0\r\n'
+                'ST: %s\r\n'
+                'USN: %s\r\n'
+                '\r\n' % (tv.location, st, tv.udn if st == tv.udn else '%s::%s' % (tv.udn, st)))
+
+    def run(self):
+        while True:
+            readable, _, _ = select.select(list(self._sockets), [], [])
+            for sock in readable:
+                try:
+                    datagram, address = sock.recvfrom(4096)
+                except socket.error as e:
+                    LOG.debug('Unable to receive an M-SEARCH: %s', e)
+                    continue
+                if not datagram.startswith('M-SEARCH '):
+                    continue
+                headers = sstcs._ssdp_headers(datagram)
+                if headers.get('man', '').strip('"') != 'ssdp:discover':
+                    continue
+
+                for tv in self._sockets[sock]:
+                    answer = self._answer(tv, headers.get('st', ''))
+                    if answer is None:
+                        continue
+                    tv.count('M-SEARCH')
+                    delay_s = tv.delay()
+                    if delay_s is not None:
+                        timer = threading.Timer(delay_s, self._send, (sock, answer, address))
+                        timer.daemon = True
+                        timer.start()
+
+    @staticmethod
+    def _send(sock, answer, address):
+        try:
+            sock.sendto(answer, address)
+        except socket.error as e:
+            LOG.debug('Unable to answer %s:%d: %s', address[0], address[1], e)
+
+
+def _add_to_address(address, n):
+    return socket.inet_ntoa(pack('!I', unpack('!I', socket.inet_aton(address))[0] + n))
+
+
+def print_counts(tvs):
+    """Prints how many requests of each kind each TV got."""
+
+    kinds = sorted(set(kind for tv in tvs for kind in tv.counts))
+    if not kinds:
+        return
+    print '%-21s' % 'TV' + ''.join(' %*s' % (max(len(kind), 6), kind) for kind in kinds)
+    for tv in tvs:
+        print '%-21s' % ('%s:%d' % (tv.address, tv.port)) + \
+            ''.join(' %*d' % (max(len(kind), 6), tv.counts[kind]) for kind in kinds)
+
+
+def main():
+    try:
+        gopts, rest_ = getopt.getopt(sys.argv[1:], "n:a:p:As:t:v",
+                                     ["tvs=", "address=", "port=", "spread", "size=",
+                                      "list-type=", "latency=", "jitter=", "loss=",
+                                      "tune-time=", "list-change=", "seed=", "no-ssdp",
+                                      "verbose"])
+    except getopt.GetoptError as err:
+        print str(err)
+        sys.exit(1)
+
+    num_tvs   = 1
+    address   = '127.0.0.1'
+    port      = 18000
+    spread    = False
+    size      = 1000
+    list_type = '0x11'
+    ssdp      = True
+    verbose   = False
+    config    = {
+        'latency_s'  : 0.0,
+        'jitter_s'   : 0.0,
+        'loss'       : 0.0,
+        'tune_time_s': 0.3,
+        'seed'       : 0,
+    }
+    list_change_s = None
+    try:
+        for o, a in gopts:
+            if o in ['-n', '--tvs']:
+                num_tvs = int(a)
+            elif o in ['-a', '--address']:
+                address = a
+            elif o in ['-p', '--port']:
+                port = int(a)
+            elif o in ['-A', '--spread']:
+                spread = True
+            elif o in ['-s', '--size']:
+                size = int(a)
+            elif o in ['-t', '--list-type']:
+                list_type = a
+            elif o in ['--latency', '--jitter', '--loss', '--tune-time']:
+                config[o[2:].replace('-', '_') + ('' if o == '--loss' else '_s')] = float(a)
+            elif o == '--list-change':
+                list_change_s = float(a)
+            elif o == '--seed':
+                config['seed'] = int(a)
+            elif o == '--no-ssdp':
+                ssdp = False
+            elif o in ['-v', '--verbose']:
+                verbose = True
+    except ValueError:
+        print 'Invalid value for %s: %s' % (o, a)
+        sys.exit(1)
+
+    if num_tvs < 1 or not 0 < size <= 0xffff:
+        print 'Simulate at least one TV, with 1 to 65535 channels.'
+        sys.exit(1)
+    if list_type not in dict(CHANNEL_LIST_TYPES):
+        print 'Unknown channel list type %s, use one of %s' % (
+            list_type, ', '.join(cl_type for cl_type, _ in CHANNEL_LIST_TYPES))
+        sys.exit(1)
+
+    sstcs.set_up_logging('debug' if verbose else 'info')
+
+    channel_lists = ChannelLists(size)
+    scpd = service_description()
+
+    tvs = []
+    for i in xrange(num_tvs):
+        if spread:
+            tv = SimulatedTV(i, _add_to_address(address, i), port, channel_lists, list_type,
+                             config)
+        else:
+            tv = SimulatedTV(i, address, port + i, channel_lists, list_type, config)
+        try:
+            server = TVServer(tv, scpd)
+        except socket.error as e:
+            LOG.critical('Unable to listen on %s:%d: %s', tv.address, tv.port, e)
+            sys.exit(2)
+        thread = threading.Thread(target=server.serve_forever, name='TV %d' % i)
+        thread.daemon = True
+        thread.start()
+        tvs.append(tv)
+        LOG.debug('TV %d at %s', i, tv.location)
+
+    if ssdp:
+        try:
+            SSDPResponder(tvs).start()
+        except socket.error as e:
+            LOG.critical('Unable to listen for M-SEARCHs on port %d: %s', sstcs.SSDP_PORT, e)
+            sys.exit(2)
+
+    LOG.info('Simulating %d TV(s) with %d channels, the first at %s', num_tvs, size,
+             tvs[0].location)
+
+    def _terminate(signum_, frame_):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        while True:
+            time.sleep(list_change_s or 3600)
+            if list_change_s:
+                for tv in tvs:
+                    tv.change_list()
+    except KeyboardInterrupt:
+        pass
+    print_counts(tvs)
+
+LOG = logging.getLogger('sstcs_sim')
+
+if __name__ == '__main__':
+    main()